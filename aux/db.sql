@@ -1,14 +1,17 @@
 CREATE TABLE IF NOT EXISTS "users" (
   "id" SERIAL NOT NULL PRIMARY KEY,
   "username" varchar(64) NOT NULL UNIQUE,
-  "password" char(60) NULL,
-  "hash" char(64) NULL UNIQUE,
+  "password" varchar(60) NULL,
+  "hash_digest" bytea NULL,
   "hash_time" timestamp NULL,
   "creator_time" timestamp NOT NULL,
   "creator_user" varchar(255) NOT NULL,
   "creator_zone" varchar(255) NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS "ix_users_hash_time" ON "users" ("hash_time");
+CREATE UNIQUE INDEX IF NOT EXISTS "ix_users_hash_digest" ON "users" ("hash_digest") WHERE "hash_digest" IS NOT NULL;
+
 
 CREATE TABLE IF NOT EXISTS "user_zones" (
   "user_id" INTEGER NOT NULL REFERENCES users(id),
@@ -17,3 +20,42 @@ CREATE TABLE IF NOT EXISTS "user_zones" (
   "inviter_time" timestamp NOT NULL,
   PRIMARY KEY (user_id, inviter_zone)
 );
+
+CREATE INDEX IF NOT EXISTS "ix_user_zones_inviter_zone" ON "user_zones" ("inviter_zone");
+
+
+CREATE TABLE IF NOT EXISTS "mail_outbox" (
+  "id" SERIAL NOT NULL PRIMARY KEY,
+  "recipient" varchar(255) NOT NULL,
+  "subject" varchar(255) NOT NULL,
+  "template_name" varchar(64) NOT NULL,
+  "template_data" text NOT NULL,
+  "status" varchar(16) NOT NULL,
+  "attempts" INTEGER NOT NULL,
+  "next_attempt_time" timestamp NOT NULL,
+  "last_error" text NULL,
+  "created_time" timestamp NOT NULL,
+  "sent_time" timestamp NULL
+);
+
+CREATE INDEX IF NOT EXISTS "ix_mail_outbox_status_next_attempt_time" ON "mail_outbox" ("status", "next_attempt_time");
+
+
+CREATE TABLE IF NOT EXISTS "throttle_buckets" (
+  "key" varchar(255) NOT NULL PRIMARY KEY,
+  "tokens" double precision NOT NULL,
+  "updated_time" double precision NOT NULL,
+  "full_time" double precision NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS "ix_throttle_buckets_full_time" ON "throttle_buckets" ("full_time");
+
+
+CREATE TABLE IF NOT EXISTS "schema_version" (
+  "version" INTEGER NOT NULL PRIMARY KEY,
+  "description" varchar(255) NOT NULL,
+  "applied_time" timestamp NOT NULL
+);
+
+INSERT INTO "schema_version" ("version", "description", "applied_time")
+  VALUES (5, 'Initial schema', now()) ON CONFLICT DO NOTHING;
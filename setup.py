@@ -15,6 +15,7 @@ setup(
     },
     extras_require={
         "test": ["pytest-flask==1.3.0", "pytest==8.0.1"],
+        "brotli": ["Brotli==1.1.0"],
     },
     install_requires=[
         "bcrypt==4.0.1",
@@ -23,8 +24,10 @@ setup(
         "Flask-session==0.6.0",
         "Flask-SQLAlchemy==3.0.3",
         "Flask-wtf==1.2.1",
+        "prometheus-client==0.20.0",
         "psycopg2-binary==2.9.5",
         "requests==2.31.0",
+        "SQLAlchemy>=2.0,<2.2",
         "Werkzeug==3.0.1"
     ],
 )
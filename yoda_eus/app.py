@@ -3,59 +3,44 @@
 __copyright__ = 'Copyright (c) 2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import functools
+import gzip
+import math
+import mimetypes
+import os
 import secrets
 import urllib.parse
 from datetime import datetime
 from os import path
-from typing import Any, Dict, Optional
+from typing import Any, Callable, cast, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 import bcrypt
-from flask import abort, Flask, jsonify, make_response, render_template, request, Response, send_from_directory
+import click
+from flask import abort, Flask, g, jsonify, make_response, render_template, request, Response, send_from_directory
 from flask_session import Session
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
 from jinja2 import ChoiceLoader, FileSystemLoader
-from yoda_eus.mail import is_email_valid, send_email_template_if_needed
+from sqlalchemy import bindparam, delete, event, insert, literal, select, String, Table, text, TIMESTAMP, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import CursorResult
+from sqlalchemy.pool import Pool
+from yoda_eus.bcrypt_pool import BcryptPool, BcryptPoolFullError, calibrate_rounds, get_hash_rounds
+from yoda_eus.credential_cache import CredentialCache, get_credentials_digest
+from yoda_eus.expiry import (DEFAULT_ACTIVATION_LINK_VALIDITY, DEFAULT_RESET_LINK_VALIDITY, get_expired_activation_condition,
+                             get_hash_cutoff, sweep_expired_users)
+from yoda_eus.health import CachedProbe
+from yoda_eus.lazy_session import LazySessionInterface
+from yoda_eus.mail import get_smtp_pool, is_email_valid, warm_mail_template_cache
+from yoda_eus.metrics import AUTH_CHECKS, BCRYPT_DURATION, generate_metrics, init_metrics, THROTTLE_HITS
+from yoda_eus.migrations import get_schema_version, LATEST_VERSION, migrate
+from yoda_eus.models import db, User, UserZone
+from yoda_eus.outbox import deliver_email_template_if_needed, is_outbox_enabled, run_outbox_dispatcher
+from yoda_eus.page_cache import PageCache
 from yoda_eus.password_complexity import check_password_complexity
-from yoda_eus.util import get_validated_static_path
-
-
-db = SQLAlchemy()
-
-
-class User(db.Model):  # type: ignore
-    """
-    This class provides the ORM model for the users table, which stores data about external users.
-    Their username is their email address. The hash columns refer to the secret hash value that is
-    used for authenticating account activation and password resets. The creator columns refer to
-    the Yoda user who invited this external user.
-    """
-
-    __tablename__ = "users"
-    id = db.Column(db.Integer, db.Sequence("users_id_seq"), primary_key=True)
-    username = db.Column(db.String(64), nullable=False, unique=True, index=True)
-    password = db.Column(db.String(60))
-    hash = db.Column(db.String(64), unique=True)
-    hash_time = db.Column(db.TIMESTAMP)
-    creator_time = db.Column(db.TIMESTAMP, nullable=False)
-    creator_user = db.Column(db.String(255), nullable=False)
-    creator_zone = db.Column(db.String(255), nullable=False)
-    user_zones = db.relationship("UserZone", back_populates="user")
-
-
-class UserZone(db.Model):  # type: ignore
-    """
-    This class provides the ORM model for the user_zones table, which stores data about invitations.
-    It is possible that external users have been invited by more than one Yoda user. For example, this can
-    happen if an EUS instance is shared by multiple Yoda instances. EUS keeps tracks of invitations in order
-    to determine when an account can be removed completely.
-    """
-    __tablename__ = "user_zones"
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
-    inviter_user = db.Column(db.String(255), nullable=False)
-    inviter_zone = db.Column(db.String(255), nullable=False, primary_key=True, index=True)
-    inviter_time = db.Column(db.TIMESTAMP, nullable=False)
-    user = db.relationship("User", back_populates="user_zones")
+from yoda_eus.single_flight import SingleFlight
+from yoda_eus.synthetic_data import generate_users
+from yoda_eus.throttle import DatabaseThrottleBackend, MemoryThrottleBackend, Throttle, ThrottleBackend, ThrottledError
+from yoda_eus.util import get_compressors, get_hash_digest, precompress_static_files, StaticAssetIndex
 
 
 def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> Flask:
@@ -82,13 +67,79 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
                                       app.config.get("DB_HOST"),
                                       app.config.get("DB_NAME"))
 
+    # Configure database connection pool
+    if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        engine_options = {"pool_size": int(app.config.get("DB_POOL_SIZE", 5)),
+                          "max_overflow": int(app.config.get("DB_POOL_MAX_OVERFLOW", 10)),
+                          "pool_timeout": float(app.config.get("DB_POOL_TIMEOUT", 30)),
+                          "pool_recycle": int(app.config.get("DB_POOL_RECYCLE", 1800)),
+                          "pool_pre_ping": app.config.get("DB_POOL_PRE_PING", "true").lower() != "false"}
+        if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql"):
+            connect_args: Dict[str, Any] = {"connect_timeout": int(app.config.get("DB_CONNECT_TIMEOUT", 10))}
+            statement_timeout = int(app.config.get("DB_STATEMENT_TIMEOUT", 0))
+            if statement_timeout > 0:
+                connect_args["options"] = "-c statement_timeout={}".format(statement_timeout)
+            engine_options["connect_args"] = connect_args
+        engine_options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+
     # Initialize database
     db.init_app(app)
 
-    # Create database schema, if needed
+    # Collect request and database query metrics
+    metrics_enabled = app.config.get("METRICS_ENABLED", "true").lower() != "false"
+    if metrics_enabled:
+        init_metrics(app)
+
+    # Prepare the password hash lookup of authentication checks on new PostgreSQL connections
     with app.app_context():
-        db.create_all()
-        db.session.commit()
+        if db.engine.dialect.name == "postgresql" and db.engine.dialect.driver == "psycopg2":
+            event.listen(db.engine, "connect", prepare_password_hash_query)
+
+    # Check database schema version. Migrations are normally run explicitly with "flask migrate-db".
+    schema_version: Optional[int]
+    with app.app_context():
+        if app.config.get("DB_AUTO_MIGRATE", "false").lower() != "false":
+            migrate(db.engine)
+            schema_version = LATEST_VERSION
+        else:
+            schema_version = get_schema_version(db.engine)
+    schema_outdated = schema_version is None or schema_version < LATEST_VERSION
+    if schema_outdated:
+        app.logger.error("Database schema version is {}, but version {} is required. "
+                         "Please run \"flask migrate-db\".".format(schema_version, LATEST_VERSION))
+    elif schema_version is not None and schema_version > LATEST_VERSION:
+        app.logger.warning("Database schema version {} is newer than version {} of this EUS version."
+                           .format(schema_version, LATEST_VERSION))
+
+    @app.before_request
+    def check_schema_version() -> Optional[Response]:
+        """
+        Refuses requests (except liveness checks) while the database schema is outdated.
+        The schema version is only queried again while it is outdated.
+
+        :Returns: Flask response (optionally)
+        """
+        nonlocal schema_outdated
+        if not schema_outdated or request.path == "/healthz":
+            return None
+        schema_version = get_schema_version(db.engine)
+        if schema_version is not None and schema_version >= LATEST_VERSION:
+            schema_outdated = False
+            return None
+        return make_response(jsonify({"status": "error", "message": "Database schema is outdated."}), 503)
+
+    @app.cli.command("migrate-db")
+    def migrate_db() -> None:
+        """Migrate the database schema to the latest version."""
+        with app.app_context():
+            old_version, new_version = migrate(db.engine)
+        if old_version is None:
+            click.echo("Created database schema version {}.".format(new_version))
+        elif old_version == new_version:
+            click.echo("Database schema version {} is up to date.".format(new_version))
+        else:
+            click.echo("Migrated database schema from version {} to {}.".format(old_version, new_version))
 
     # Add CSRF protection
     if app.config.get("CSRF_TOKENS_ENABLED").lower() != "false":
@@ -119,27 +170,161 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
     ])
     app.jinja_loader = theme_loader
 
-    # Initialize sessions
+    # Write compressed variants of static assets, if enabled
+    static_dirs = [path.join(full_theme_path, "static")]
+    if app.static_folder is not None:
+        static_dirs.append(app.static_folder)
+    if app.config.get("STATIC_PRECOMPRESS", "false").lower() != "false":
+        written, failed = precompress_static_files(static_dirs, int(app.config.get("STATIC_PRECOMPRESS_MIN_SIZE", 1024)))
+        if failed > 0:
+            app.logger.warning("Could not write {} compressed static asset variants.".format(failed))
+
+    # Index static assets, so that theme overrides can be resolved without file system access
+    static_index = StaticAssetIndex(static_dirs,
+                                    refresh_interval=float(app.config.get("STATIC_INDEX_REFRESH_INTERVAL", 5)))
+
+    # Cache pages that do not depend on request data, e.g. the index page that is used by load balancer health checks
+    if app.config.get("PAGE_CACHE_ENABLED", "true").lower() != "false":
+        page_cache = PageCache([full_theme_path, path.join(app.root_path, app.template_folder)],
+                               check_interval=float(app.config.get("PAGE_CACHE_CHECK_INTERVAL", 10)))
+    else:
+        page_cache = None
+
+    def render_static_page(template_name: str) -> str:
+        """
+        Renders a page that does not depend on request data, using the page cache if enabled.
+
+        :param template_name: Name of the template to render
+
+        :Returns: rendered page
+        """
+        if page_cache is None:
+            return render_template(template_name)
+        static_index.refresh_if_needed()
+        return page_cache.render(template_name, static_index.generation)
+
+    # Initialize sessions. Sessions are only read from the session store when a view uses them,
+    # and API requests, static assets, health checks and metrics never get a session.
     Session(app)
+    app.session_interface = LazySessionInterface(app.session_interface,
+                                                 stateless_prefixes=("/api/", "/assets/", "/healthz", "/readyz", "/metrics"))
+
+    # Compile mail templates, so that sending the first emails does not have to wait for it
+    if app.config.get("MAIL_ENABLED").lower() != "false":
+        warm_mail_template_cache(app)
+
+    # Initialize cache of verified credentials, if enabled
+    if app.config.get("AUTH_CACHE_ENABLED", "false").lower() != "false":
+        credential_cache: Optional[CredentialCache] = CredentialCache(
+            max_size=int(app.config.get("AUTH_CACHE_SIZE", 1024)),
+            ttl=float(app.config.get("AUTH_CACHE_TTL", 300)))
+    else:
+        credential_cache = None
+
+    # Coalesce concurrent verifications of the same credentials within this process, if enabled.
+    # Credentials are identified by a keyed digest, with the same key as the credential cache.
+    if app.config.get("AUTH_COALESCING_ENABLED", "true").lower() != "false":
+        auth_flights: Optional[SingleFlight] = SingleFlight()
+        if credential_cache is not None:
+            get_flight_digest = credential_cache.password_digest
+        else:
+            get_flight_digest = functools.partial(get_credentials_digest, secrets.token_bytes(32))
+    else:
+        auth_flights = None
+
+    # Initialize worker pool for bcrypt computations
+    bcrypt_pool = BcryptPool(workers=int(app.config.get("BCRYPT_POOL_SIZE", 4)),
+                             queue_size=int(app.config.get("BCRYPT_POOL_QUEUE_SIZE", 32)))
+    bcrypt_rounds = int(app.config.get("BCRYPT_ROUNDS", 12))
+
+    # Initialize throttles of authentication checks and password reset requests, keyed by username, and
+    # for password reset requests also by client address. Authentication checks are sent by the Yoda
+    # portal, so their client address is always that of the portal. A capacity of 0 disables a throttle.
+    throttles: Dict[Tuple[str, str], Throttle] = {}
+    if app.config.get("THROTTLE_ENABLED", "true").lower() != "false":
+        if app.config.get("THROTTLE_BACKEND", "memory") == "database":
+            throttle_backend: ThrottleBackend = DatabaseThrottleBackend(lambda: db.engine)
+        else:
+            throttle_backend = MemoryThrottleBackend(max_size=int(app.config.get("THROTTLE_MEMORY_MAX_SIZE", 100000)))
+        throttle_defaults = {("AUTH_CHECK", "USER"): (10, 0.1),
+                             ("FORGOT_PASSWORD", "USER"): (3, 0.001),
+                             ("FORGOT_PASSWORD", "ADDRESS"): (20, 0.01)}
+        for (endpoint, key_type), (default_capacity, default_rate) in throttle_defaults.items():
+            prefix = "THROTTLE_{}_{}_".format(endpoint, key_type)
+            capacity = float(app.config.get(prefix + "CAPACITY", default_capacity))
+            if capacity > 0:
+                throttles[(endpoint.lower(), key_type.lower())] = Throttle(
+                    throttle_backend, capacity, float(app.config.get(prefix + "RATE", default_rate)))
+
+    def throttle_request(endpoint: str, username: str, consume: bool = True) -> None:
+        """
+        Takes a token from the throttle buckets of the client address and of the username of a request,
+        so that excess attempts are rejected before any database lookups or bcrypt computations.
+
+        :param endpoint: Throttled endpoint ("auth_check" or "forgot_password")
+        :param username: Username in the request
+        :param consume:  Whether to take a token, or only check that the buckets are not empty
+
+        :raises ThrottledError: If the attempt exceeds a throttle limit
+        """
+        for key_type, key in [("address", request.remote_addr or ""), ("user", username)]:
+            throttle = throttles.get((endpoint, key_type))
+            if throttle is None:
+                continue
+            bucket_key = "{}:{}:{}".format(endpoint, key_type, key)
+            retry_after = throttle.consume(bucket_key) if consume else throttle.peek(bucket_key)
+            if retry_after > 0:
+                THROTTLE_HITS.labels(endpoint, key_type).inc()
+                raise ThrottledError(retry_after)
+
+    @app.cli.command("calibrate-bcrypt")
+    @click.option("--target-ms", default=250, show_default=True,
+                  help="Target duration of a single password verification in milliseconds.")
+    def calibrate_bcrypt(target_ms: int) -> None:
+        """Measure bcrypt on this host and propose a BCRYPT_ROUNDS setting."""  # noqa DAR101
+        proposal, measurements = calibrate_rounds(target_ms / 1000)
+        for rounds, duration in measurements:
+            click.echo("Cost factor {:2d}: {:8.1f} ms".format(rounds, duration * 1000))
+        click.echo("Proposed setting (target {} ms): BCRYPT_ROUNDS = {}".format(target_ms, proposal))
+
+    def rehash_password(username: str, password: str, old_hash: str) -> None:
+        """
+        Replaces the password hash of a user with a hash that has the configured cost factor.
+        This runs on the bcrypt worker pool, outside of the request that verified the password.
+        The hash is only replaced if the password of the user has not been changed in the meantime.
+
+        :param username: Username
+        :param password: Verified password of the user
+        :param old_hash: Password hash that the password was verified against
+        """
+        with BCRYPT_DURATION.labels("hash").time():
+            new_hash = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(bcrypt_rounds)).decode("utf-8")
+        with app.app_context():
+            updated = User.query.filter_by(username=username, password=old_hash).update({"password": new_hash})
+            db.session.commit()
+        if updated == 1:
+            app.logger.info("Rehashed password of user {} with cost factor {}.".format(username, bcrypt_rounds))
+            if credential_cache is not None:
+                credential_cache.store(username, password, new_hash)
 
     # Load test data if required for integration tests
     if app.config.get("LOAD_TEST_DATA", "false").lower() != "false":
         with app.app_context():
             now = datetime.now()
-            hashed_password = bcrypt.hashpw("Test123456!!!".encode("utf-8"), bcrypt.gensalt())
+            hashed_password = bcrypt.hashpw("Test123456!!!".encode("utf-8"), bcrypt.gensalt(bcrypt_rounds))
             for n in range(1, 6):
                 unactivated_user = User(username="unactivateduser" + str(n),
                                         creator_time=now,
                                         creator_user="creator",
                                         creator_zone="testZone",
-                                        hash="goodhash" + str(n),
+                                        hash_digest=get_hash_digest("goodhash" + str(n)),
                                         hash_time=now)
                 db.session.add(unactivated_user)
             activated_user = User(username="activateduser",
                                   creator_time=now,
                                   creator_user="creator",
                                   creator_zone="testZone",
-                                  hash="resethash",
+                                  hash_digest=get_hash_digest("resethash"),
                                   hash_time=now,
                                   password=hashed_password.decode('utf-8'))
             db.session.add(activated_user)
@@ -151,6 +336,54 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
                                          inviter_zone="testZone")
                 db.session.add(new_user_zone)
 
+    @app.cli.command("dispatch-mail")
+    @click.option("--batch-size", type=int, default=None, help="Maximum number of messages per batch.")
+    @click.option("--once", is_flag=True, help="Deliver the messages that are currently due, then exit.")
+    def dispatch_mail(batch_size: Optional[int], once: bool) -> None:
+        """Deliver queued emails from the mail outbox."""  # noqa DAR101
+        run_outbox_dispatcher(app,
+                              batch_size or int(app.config.get("MAIL_OUTBOX_BATCH_SIZE", 50)),
+                              float(app.config.get("MAIL_OUTBOX_POLL_INTERVAL", 5)),
+                              once)
+
+    @app.cli.command("sweep-users")
+    @click.option("--batch-size", type=int, default=None, help="Maximum number of users per transaction.")
+    def sweep_users(batch_size: Optional[int]) -> None:
+        """Clear expired password reset links and delete users that never activated their account."""  # noqa DAR101
+        with app.app_context():
+            cleared, deleted = sweep_expired_users(app, batch_size or int(app.config.get("SWEEP_BATCH_SIZE", 500)))
+        click.echo("Cleared {} expired password reset links, deleted {} unactivated users.".format(cleared, deleted))
+
+    @app.cli.command("generate-test-data")
+    @click.option("--users", type=int, default=1000000, show_default=True, help="Number of users to generate.")
+    @click.option("--zones", type=int, default=100, show_default=True, help="Number of zones to register users in.")
+    @click.option("--batch-size", type=int, default=10000, show_default=True, help="Number of users per transaction.")
+    @click.option("--seed", type=int, default=None, help="Seed of the random number generator.")
+    @click.option("--yes", is_flag=True, help="Generate users even if test data is not enabled (LOAD_TEST_DATA).")
+    def generate_test_data(users: int, zones: int, batch_size: int, seed: Optional[int], yes: bool) -> None:
+        """Add synthetic users and zone registrations to the database for scale testing."""  # noqa DAR101
+        # Generated users share a published password, so they must not end up in a production database
+        if app.config.get("LOAD_TEST_DATA", "false").lower() == "false" and not yes:
+            raise click.ClickException("Test data is not enabled for this instance (LOAD_TEST_DATA). "
+                                       "Use --yes to generate users anyway.")
+        with app.app_context():
+            for generated_users, generated_user_zones in generate_users(db.engine, users, zones, batch_size,
+                                                                        bcrypt_rounds, seed):
+                click.echo("Generated {} users with {} zone registrations.".format(generated_users,
+                                                                                   generated_user_zones))
+
+    # Dependency checks for the readiness endpoint, cached so that health checks cannot flood the database
+    # or the mail server
+    def check_database() -> bool:
+        with db.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        return True
+
+    database_probe = CachedProbe(check_database, ttl=float(app.config.get("HEALTH_DB_PROBE_TTL", 5)))
+    mail_probe_timeout = float(app.config.get("HEALTH_MAIL_PROBE_TIMEOUT", 5))
+    mail_probe = CachedProbe(lambda: get_smtp_pool(app).check(timeout=mail_probe_timeout),
+                             ttl=float(app.config.get("HEALTH_MAIL_PROBE_TTL", 30)))
+
     @app.route('/')
     @csrf_exempt
     def index() -> Response:
@@ -160,7 +393,44 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
 
         :Returns: Flask response (shows themed empty page)
         """
-        return render_template('index.html')
+        return render_static_page('index.html')
+
+    @app.route('/healthz')
+    @csrf_exempt
+    def healthz() -> Response:
+        """
+        Liveness check, which only determines whether this worker process can handle requests.
+
+        :Returns: Flask response (JSON content with status)
+        """
+        response = make_response(jsonify({"status": "ok"}), 200)
+        response.cache_control.no_store = True
+        return response
+
+    @app.route('/readyz')
+    @csrf_exempt
+    def readyz() -> Response:
+        """
+        Readiness check, which can be used by load balancers to drain nodes that cannot handle
+        requests (database unreachable or bcrypt worker pool saturated). Mail server reachability
+        is reported, but does not affect readiness.
+
+        :Returns: Flask response (200 if ready, 503 if not + JSON content with status per dependency)
+        """
+        pool_stats = bcrypt_pool.stats()
+        bcrypt_saturated = (pool_stats["active"] + pool_stats["queue_depth"]
+                            >= pool_stats["workers"] + pool_stats["queue_size"])
+        checks = {"database": database_probe.get(),
+                  "mail": mail_probe.get() if app.config.get("MAIL_ENABLED").lower() != "false" else {"status": "disabled"},
+                  "bcrypt_pool": {"status": "saturated" if bcrypt_saturated else "ok",
+                                  "active": pool_stats["active"],
+                                  "queue_depth": pool_stats["queue_depth"],
+                                  "queue_size": pool_stats["queue_size"]}}
+        ready = checks["database"]["status"] == "ok" and not bcrypt_saturated
+        response = make_response(jsonify({"status": "ok" if ready else "unavailable", "checks": checks}),
+                                 200 if ready else 503)
+        response.cache_control.no_store = True
+        return response
 
     @app.route('/api/user/auth-check', methods=['POST'])
     @csrf_exempt
@@ -182,22 +452,82 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
             return response
 
         def fail_incorrect_credentials():
+            # Only failed attempts count towards the throttle limit, so that users who log in
+            # frequently (e.g. with WebDAV clients) are not throttled.
+            throttle_request("auth_check", username or "")
             response_content = {"status": "error", "message": "Incorrect credentials."}
             response = make_response(jsonify(response_content), 401)
             response.headers["WWW-Authenticate"] = "Basic realm = \"yoda-extuser\""
             return response
 
-        user = User.query.filter_by(username=username).first()
-        if user is None or user.password == "":
+        throttle_request("auth_check", username or "", consume=False)
+
+        password_hash = get_password_hash(username)
+        if password_hash is None or password_hash == "":
+            AUTH_CHECKS.labels("unknown_user").inc()
             return fail_incorrect_credentials()
 
-        password_to_check = password.rstrip('\n\r\0').encode("utf-8")
-        hash_to_check = user.password.encode('utf-8')
-        if bcrypt.checkpw(password_to_check, hash_to_check):
+        password_to_check = password.rstrip('\n\r\0')
+        if credential_cache is not None and credential_cache.lookup(username, password_to_check, password_hash):
+            AUTH_CHECKS.labels("success").inc()
+            return make_response("Authenticated", 200)
+
+        def verify_password() -> bool:
+            if not bcrypt_pool.checkpw(password_to_check.encode("utf-8"), password_hash.encode("utf-8")):
+                return False
+            if credential_cache is not None:
+                credential_cache.store(username, password_to_check, password_hash)
+            if get_hash_rounds(password_hash) != bcrypt_rounds:
+                try:
+                    bcrypt_pool.submit(rehash_password, username, password_to_check, password_hash)
+                except BcryptPoolFullError:
+                    # Not urgent; the password will be rehashed on a later login.
+                    pass
+            return True
+
+        if auth_flights is not None:
+            flight_key = (username, get_flight_digest(username, password_to_check), password_hash)
+            verified = auth_flights.run(flight_key, verify_password)
+        else:
+            verified = verify_password()
+
+        if verified:
+            AUTH_CHECKS.labels("success").inc()
             return make_response("Authenticated", 200)
         else:
+            AUTH_CHECKS.labels("bad_password").inc()
             return fail_incorrect_credentials()
 
+    if enable_api and metrics_enabled:
+        @app.route('/metrics', methods=['GET'])
+        @csrf_exempt
+        def metrics() -> Response:
+            """
+            Metrics endpoint for Prometheus. It is only available on the interface that has the API
+            enabled, so that access can be restricted on a TCP level.
+
+            :Returns: Flask response (metrics in Prometheus text format)
+            """
+            data, content_type = generate_metrics()
+            return Response(data, status=200, content_type=content_type)
+
+    @app.route('/api/stats', methods=['GET'])
+    @csrf_exempt
+    def stats() -> Response:
+        """
+        API endpoint that reports runtime statistics of this worker process, which can be used
+        for sizing caches and pools.
+
+        :Returns: Flask response (JSON content with statistics per component)
+        """
+        response = {"pid": os.getpid(),
+                    "auth_cache": credential_cache.stats() if credential_cache is not None else None,
+                    "auth_coalescing": auth_flights.stats() if auth_flights is not None else None,
+                    "bcrypt_pool": bcrypt_pool.stats(),
+                    "page_cache": page_cache.stats() if page_cache is not None else None,
+                    "db_pool": get_db_pool_stats(db.engine.pool)}
+        return jsonify(response), 200
+
     @app.route('/api/user/delete', methods=['POST'])
     @csrf_exempt
     def delete_user() -> Response:
@@ -216,24 +546,171 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
                 response = {"status": "error", "message": "Missing input field: " + field}
                 return jsonify(response), 401
 
-        user = User.query.filter_by(username=content['username']).first()
+        user_ids = get_user_ids({content['username']})
 
-        if user is None:
+        if content['username'] not in user_ids:
             response = {"status": "error", "message": "User not found."}
             return jsonify(response), 404
 
-        # Delete zone registration
-        UserZone.query.filter_by(user_id=user.id, inviter_zone=content["userzone"]).delete()
+        # Delete zone registration, and user account if no registrations left
+        delete_zone_registrations(list(user_ids.values()), content["userzone"])
+        deleted_usernames = delete_unregistered_users(list(user_ids.values()))
+        db.session.commit()
 
-        # Delete user account if no registrations left
-        if len(UserZone.query.filter_by(user_id=user.id).all()) == 0:
-            User.query.filter_by(username=content['username']).delete()
+        if credential_cache is not None:
+            for username in deleted_usernames:
+                credential_cache.invalidate(username)
 
         # Return result
         response = {"status": "ok", "message": "User {} deleted from zone {}.".format(content["username"],
                                                                                       content["userzone"])}
         return jsonify(response), 204
 
+    @app.route('/api/user/delete-batch', methods=['POST'])
+    @csrf_exempt
+    def delete_user_batch() -> Response:
+        """
+        API endpoint used by Yoda to delete many external users at once. It should get a POST request
+        with a JSON array of objects that have the same fields as the content of a request to
+        /api/user/delete. Registrations and orphaned accounts are deleted with set-based statements
+        in a single transaction.
+
+        :Returns: Flask response (JSON content with status ("ok" or "error") and a results array
+                  with a status and message for each item, in request order.
+        """
+        content = request.get_json(force=True)
+
+        if not isinstance(content, list):
+            response = {"status": "error", "message": "Expected a JSON array of users."}
+            return jsonify(response), 400
+
+        max_batch_size = int(app.config.get("API_BATCH_MAX_SIZE", 1000))
+        if len(content) > max_batch_size:
+            response = {"status": "error", "message": "Batch is too large: at most {} users are allowed.".format(
+                max_batch_size)}
+            return jsonify(response), 400
+
+        compulsory_fields = ["username", "userzone"]
+        missing_fields = [[field for field in compulsory_fields
+                           if not isinstance(item, dict) or not isinstance(item.get(field), str)]
+                          for item in content]
+        valid_items = [item for item, missing in zip(content, missing_fields) if len(missing) == 0]
+        user_ids = get_user_ids({item["username"] for item in valid_items})
+
+        # Delete zone registrations per zone, then the accounts that have no registrations left
+        usernames_per_zone: Dict[str, Set[str]] = {}
+        for item in valid_items:
+            if item["username"] in user_ids:
+                usernames_per_zone.setdefault(item["userzone"], set()).add(item["username"])
+        for zone, usernames in usernames_per_zone.items():
+            delete_zone_registrations([user_ids[username] for username in usernames], zone)
+        deleted_usernames = delete_unregistered_users(list(user_ids.values()))
+        db.session.commit()
+
+        if credential_cache is not None:
+            for username in deleted_usernames:
+                credential_cache.invalidate(username)
+
+        results = []
+        for item, missing in zip(content, missing_fields):
+            if len(missing) > 0:
+                username = item.get("username", "") if isinstance(item, dict) else ""
+                results.append({"username": username, "status": "error",
+                                "message": "Missing input field: " + missing[0]})
+            elif item["username"] not in user_ids:
+                results.append({"username": item["username"], "status": "error", "message": "User not found."})
+            else:
+                results.append({"username": item["username"], "status": "ok",
+                                "message": "User {} deleted from zone {}.".format(item["username"], item["userzone"])})
+
+        response = {"status": "ok", "results": results}
+        return jsonify(response), 200
+
+    @app.route('/api/zone/purge', methods=['POST'])
+    @csrf_exempt
+    def purge_zone() -> Response:
+        """
+        API endpoint used when a Yoda zone is decommissioned. It should get a POST request with JSON
+        content containing a zone key. All registrations of that zone are deleted, as well as the
+        accounts that have no registrations in other zones left.
+
+        :Returns: Flask response (JSON content with status ("ok" or "error"), message field and
+                  numbers of deleted registrations and users.
+        """
+        content = request.get_json(force=True)
+
+        if not isinstance(content, dict) or not isinstance(content.get("zone"), str):
+            response = {"status": "error", "message": "Missing input field: zone"}
+            return jsonify(response), 401
+
+        if supports_returning():
+            user_ids = list(db.session.execute(delete(UserZone)
+                                               .where(UserZone.inviter_zone == content["zone"])
+                                               .returning(UserZone.user_id)).scalars())
+        else:
+            user_ids = list(db.session.execute(select(UserZone.user_id)
+                                               .where(UserZone.inviter_zone == content["zone"])).scalars())
+            delete_zone_registrations(user_ids, content["zone"])
+        deleted_usernames = delete_unregistered_users(user_ids)
+        db.session.commit()
+
+        if credential_cache is not None:
+            for username in deleted_usernames:
+                credential_cache.invalidate(username)
+
+        response = {"status": "ok",
+                    "message": "Zone {} purged.".format(content["zone"]),
+                    "registrations_deleted": len(user_ids),
+                    "users_deleted": len(deleted_usernames)}
+        return jsonify(response), 200
+
+    def commit_with_emails(deliver_emails: Callable[[], None]) -> None:
+        """
+        Commits the current transaction, and sends (or queues) the emails about it.
+
+        With the outbox, emails are queued in the same transaction as the changes they are about.
+        Otherwise they are sent after the commit, so that a failing mail server cannot roll back
+        changes that recipients have already been notified of.
+
+        :param deliver_emails: Function that sends (or queues) the emails
+        """
+        if is_outbox_enabled(app):
+            deliver_emails()
+            db.session.commit()
+        else:
+            db.session.commit()
+            deliver_emails()
+
+    def deliver_invitation_emails(username: str, creator_user: str, secret_hash: str) -> None:
+        """
+        Sends (or queues) the invitation for a new external user, as well as the confirmation
+        for the Yoda user who invited them.
+
+        :param username:     Username (email address) of the new external user
+        :param creator_user: Yoda user who invited the external user
+        :param secret_hash:  Account activation secret of the new external user
+        """
+        # Send invitation
+        hash_url = "https://{}/user/activate/{}".format(app.config.get("YODA_EUS_FQDN"),
+                                                        secret_hash)
+        invitation_data = {'USERNAME': username,
+                           'CREATOR': creator_user,
+                           'HASH_URL': hash_url}
+        deliver_email_template_if_needed(app,
+                                         username,
+                                         'Welcome to Yoda!',
+                                         "invitation",
+                                         invitation_data)
+
+        # Send invitation confirmation
+        confirmation_data = {"USERNAME": username,
+                             "CREATOR": creator_user}
+        deliver_email_template_if_needed(app,
+                                         creator_user,
+                                         'You have invited an external user to Yoda',
+                                         'invitation-sent',
+                                         confirmation_data)
+
     @app.route("/api/user/add", methods=['POST'])
     @csrf_exempt
     def add_user() -> Response:
@@ -255,68 +732,136 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
                 response = {"status": "error", "message": "Missing input field: " + field}
                 return jsonify(response), 401
 
-        user = User.query.filter_by(username=content['username']).first()
+        # Create new account, if needed. An existing account whose activation link has expired
+        # gets a new one.
+        secret_hash = get_random_hash()
+        new_user = {"username": content["username"],
+                    "creator_time": now,
+                    "creator_user": content["creator_user"],
+                    "creator_zone": content["creator_zone"],
+                    "hash_digest": get_hash_digest(secret_hash),
+                    "hash_time": now}
+        created = create_users_if_missing([new_user])
+        renewed = set() if len(created) > 0 else renew_expired_invitations(
+            [new_user], get_hash_cutoff(app, "ACTIVATION_LINK_VALIDITY", DEFAULT_ACTIVATION_LINK_VALIDITY))
+
+        # Log invitation
+        register_user_zone(content["username"], content["creator_user"], content["creator_zone"], now)
+
+        def deliver_emails() -> None:
+            if len(created) > 0 or len(renewed) > 0:
+                deliver_invitation_emails(content['username'], content['creator_user'], secret_hash)
+
+        commit_with_emails(deliver_emails)
+
+        # Send response
+        if len(created) > 0:
+            response = {"status": "ok", "message": "User created."}
+            return jsonify(response), 201
+        elif len(renewed) > 0:
+            response = {"status": "ok", "message": "Invitation renewed."}
+            return jsonify(response), 200
+        else:
+            response = {"status": "ok", "message": "User already exists."}
+            return jsonify(response), 200
 
-        if user is None:
+    @app.route("/api/user/add-batch", methods=['POST'])
+    @csrf_exempt
+    def add_user_batch() -> Response:
+        """
+        API endpoint used by Yoda to create many external users at once, e.g. when inviting a whole
+        course. It should get a POST request with a JSON array of objects that have the same fields
+        as the content of a request to /api/user/add. New users and invitations are inserted with
+        set-based statements in a single transaction.
 
-            # Create new account
-            secret_hash = get_random_hash()
-            new_user = User(username=content["username"],
-                            creator_time=now,
-                            creator_user=content["creator_user"],
-                            creator_zone=content["creator_zone"],
-                            hash=secret_hash,
-                            hash_time=now)
-            db.session.add(new_user)
-
-            created_user = User.query.filter_by(username=content['username']).first()
-
-            # Log invitation
-            new_user_zone = UserZone(user_id=created_user.id,
-                                     inviter_time=now,
-                                     inviter_user=content["creator_user"],
-                                     inviter_zone=content["creator_zone"])
-            db.session.add(new_user_zone)
+        :Returns: Flask response (JSON content with status ("ok" or "error") and a results array
+                  with a status and message for each item, in request order.
+        """
+        content = request.get_json(force=True)
+        now = datetime.now()
 
-            db.session.commit()
+        if not isinstance(content, list):
+            response = {"status": "error", "message": "Expected a JSON array of users."}
+            return jsonify(response), 400
 
-            # Send invitation
-            hash_url = "https://{}/user/activate/{}".format(app.config.get("YODA_EUS_FQDN"),
-                                                            secret_hash)
-            invitation_data = {'USERNAME': content['username'],
-                               'CREATOR': content["creator_user"],
-                               'HASH_URL': hash_url}
-            send_email_template_if_needed(app,
-                                          content['username'],
-                                          'Welcome to Yoda!',
-                                          "invitation",
-                                          invitation_data)
-
-            # Send invitation confirmation
-            confirmation_data = {"USERNAME": content['username'],
-                                 "CREATOR": content['creator_user']}
-            send_email_template_if_needed(app,
-                                          content["creator_user"],
-                                          'You have invited an external user to Yoda',
-                                          'invitation-sent',
-                                          confirmation_data)
-
-            # Send response
-            response = {"status": "ok", "message": "User created."}
-            return jsonify(response), 201
+        max_batch_size = int(app.config.get("API_BATCH_MAX_SIZE", 1000))
+        if len(content) > max_batch_size:
+            response = {"status": "error", "message": "Batch is too large: at most {} users are allowed.".format(
+                max_batch_size)}
+            return jsonify(response), 400
 
-        else:
+        results: List[Dict[str, str]] = []
+        invitations: Dict[Tuple[str, str], Dict[str, str]] = {}
+        compulsory_fields = ["username", "creator_user", "creator_zone"]
+        for item in content:
+            missing_fields = [field for field in compulsory_fields
+                              if not isinstance(item, dict) or not isinstance(item.get(field), str)]
+            if len(missing_fields) > 0:
+                username = item.get("username", "") if isinstance(item, dict) else ""
+                results.append({"username": username, "status": "error",
+                                "message": "Missing input field: " + missing_fields[0]})
+            else:
+                results.append({"username": item["username"], "status": "ok"})
+                invitations.setdefault((item["username"], item["creator_zone"]), item)
+
+        # Create new accounts
+        new_users: Dict[str, Dict[str, Any]] = {}
+        secret_hashes: Dict[str, str] = {}
+        for (username, zone), item in invitations.items():
+            if username not in new_users:
+                secret_hashes[username] = get_random_hash()
+                new_users[username] = {"username": username,
+                                       "creator_time": now,
+                                       "creator_user": item["creator_user"],
+                                       "creator_zone": zone,
+                                       "hash_digest": get_hash_digest(secret_hashes[username]),
+                                       "hash_time": now}
+        created = create_users_if_missing(list(new_users.values()))
+        renewed = renew_expired_invitations([user for username, user in new_users.items() if username not in created],
+                                            get_hash_cutoff(app, "ACTIVATION_LINK_VALIDITY", DEFAULT_ACTIVATION_LINK_VALIDITY))
+        invited = created | renewed
+        user_ids = get_user_ids(set(new_users))
+
+        # Log invitations
+        register_user_zones([{"user_id": user_ids[username],
+                              "inviter_time": now,
+                              "inviter_user": item["creator_user"],
+                              "inviter_zone": zone}
+                             for (username, zone), item in invitations.items()])
+
+        # With the outbox, emails are queued in the same transaction as the accounts. Otherwise they are
+        # sent after the commit, so that a failing mail server cannot leave invitees with activation
+        # links to accounts that have been rolled back.
+        outbox_enabled = is_outbox_enabled(app)
+        if outbox_enabled:
+            for username in invited:
+                deliver_invitation_emails(username, new_users[username]["creator_user"], secret_hashes[username])
 
-            # Log invitation
-            new_user_zone = UserZone(user_id=user.id,
-                                     inviter_time=now,
-                                     inviter_user=content["creator_user"],
-                                     inviter_zone=content["creator_zone"])
-            db.session.add(new_user_zone)
+        db.session.commit()
 
-            # Send response
-            response = {"status": "ok", "message": "User already exists."}
-            return jsonify(response), 200
+        undelivered: Set[str] = set()
+        if not outbox_enabled:
+            for username in invited:
+                try:
+                    deliver_invitation_emails(username, new_users[username]["creator_user"], secret_hashes[username])
+                except Exception as e:
+                    app.logger.error("Could not send invitation to user {}: {}".format(username, e))
+                    undelivered.add(username)
+
+        for result in results:
+            if result["status"] == "ok":
+                if result["username"] in created:
+                    result["message"] = "User created."
+                elif result["username"] in renewed:
+                    result["message"] = "Invitation renewed."
+                else:
+                    result["message"] = "User already exists."
+                if result["username"] in undelivered:
+                    result["status"] = "error"
+                    result["message"] = result["message"][:-1] + ", but the invitation email could not be sent."
+
+        response = {"status": "ok", "results": results}
+        return jsonify(response), 200
 
     @app.route("/user/forgot-password", methods=['GET'])
     def show_forgot_password_form() -> Response:
@@ -326,7 +871,11 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
 
          :Returns: Flask response
         """
-        return render_template('forgot-password.html'), 200
+        # The form contains a per-session CSRF token if CSRF protection is enabled, so it can only be
+        # cached without CSRF protection.
+        if app.config.get("CSRF_TOKENS_ENABLED").lower() != "false":
+            return render_template('forgot-password.html'), 200
+        return render_static_page('forgot-password.html'), 200
 
     @app.route("/user/forgot-password", methods=['POST'])
     def process_forgot_password() -> Response:
@@ -342,6 +891,8 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
             errors = {"errors": ["Please enter your user name (email address)"]}
             return render_template('forgot-password.html', **errors)
 
+        throttle_request("forgot_password", username)
+
         user = User.query.filter_by(username=username).first()
 
         if user is None:
@@ -361,20 +912,19 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
 
         # Generate and update user hash
         secret_hash = get_random_hash()
-        user.hash = secret_hash
+        user.hash_digest = get_hash_digest(secret_hash)
         user.hash_time = datetime.now()
-        db.session.commit()
 
         # Send password reset email
         hash_url = "https://{}/user/reset-password/{}".format(app.config.get("YODA_EUS_FQDN"),
                                                               secret_hash)
-        reset_data = {'USERNAME': user.username,
+        reset_data = {'USERNAME': username,
                       'HASH_URL': hash_url}
-        send_email_template_if_needed(app,
-                                      user.username,
-                                      'Yoda password reset',
-                                      "reset-password",
-                                      reset_data)
+        commit_with_emails(lambda: deliver_email_template_if_needed(app,
+                                                                    username,
+                                                                    'Yoda password reset',
+                                                                    "reset-password",
+                                                                    reset_data))
 
         return render_template("forgot-password-successful.html"), 200
 
@@ -397,21 +947,15 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
         params: Dict[str, Any] = {"secret_hash": hash}
 
         # Validate secret hash and handle errors
-        users = User.query.filter_by(hash=hash).all()
-
-        if len(users) > 1:
-            # Failsafe - it should not be possible that two users have
-            # the same hash.
-            params = {"activation_error_message": "Internal error."}
-            return render_template('activation-error.html', **params), 500
-        elif len(users) == 0:
-            params = {"activation_error_message": "Activation link is invalid."}
+        user = get_user_by_hash(hash, get_hash_cutoff(app, "ACTIVATION_LINK_VALIDITY", DEFAULT_ACTIVATION_LINK_VALIDITY))
+
+        if user is None:
+            params = {"activation_error_message": "Activation link is invalid or has expired."}
             return render_template('activation-error.html', **params), 403
-        elif users[0].password != "" and users[0].password is not None:
+        elif user.password != "" and user.password is not None:
             params = {"activation_error_message": "Sorry, your activation link is no longer valid."}
             return render_template('activation-error.html', **params), 403
 
-        user = users[0]
         params["username"] = user.username
 
         # If form wasn't submitted, show it
@@ -440,26 +984,34 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
             return render_template("activate.html", **params), 422
 
         # Activate account
-        salt = bcrypt.gensalt()
+        salt = bcrypt.gensalt(bcrypt_rounds)
         password = form_inputs["password"]
-        user.hash = None
-        user.hashtime = None
-        user.password = bcrypt.hashpw(password.encode('utf8'), salt).decode('utf-8')
-        db.session.commit()
+        user.hash_digest = None
+        user.hash_time = None
+        user.password = bcrypt_pool.hashpw(password.encode('utf8'), salt).decode('utf-8')
 
         # Send confirmation emails
-        activation_data = {'USERNAME': user.username}
-        send_email_template_if_needed(app,
-                                      user.username,
-                                      'You have successfully activated your Yoda account',
-                                      "activation-successful",
-                                      activation_data)
-        activation_data["CREATOR"] = user.creator_user
-        send_email_template_if_needed(app,
-                                      user.creator_user,
-                                      'An external user has activated their Yoda account',
-                                      "invitation-accepted",
-                                      activation_data)
+        username = user.username
+        creator_user = user.creator_user
+
+        def deliver_emails() -> None:
+            activation_data = {'USERNAME': username}
+            deliver_email_template_if_needed(app,
+                                             username,
+                                             'You have successfully activated your Yoda account',
+                                             "activation-successful",
+                                             activation_data)
+            activation_data = {'USERNAME': username, 'CREATOR': creator_user}
+            deliver_email_template_if_needed(app,
+                                             creator_user,
+                                             'An external user has activated their Yoda account',
+                                             "invitation-accepted",
+                                             activation_data)
+
+        commit_with_emails(deliver_emails)
+
+        if credential_cache is not None:
+            credential_cache.invalidate(username)
 
         # Confirm activation to user
         return render_template("activation-successful.html", **params), 200
@@ -484,18 +1036,12 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
         params: Dict[str, Any] = {"secret_hash": hash}
 
         # Validate secret hash and handle errors
-        users = User.query.filter_by(hash=hash).all()
-
-        if len(users) > 1:
-            # Failsafe - it should not be possible that two users have
-            # the same hash.
-            params = {"reset_error_message": "Internal error."}
-            return render_template('reset-password-error.html', **params), 500
-        elif len(users) == 0:
-            params = {"reset_error_message": "Password reset link is invalid."}
+        user = get_user_by_hash(hash, get_hash_cutoff(app, "RESET_LINK_VALIDITY", DEFAULT_RESET_LINK_VALIDITY))
+
+        if user is None:
+            params = {"reset_error_message": "Password reset link is invalid or has expired."}
             return render_template('reset-password-error.html', **params), 403
 
-        user = users[0]
         params["username"] = user.username
 
         # If form wasn't submitted, show it
@@ -520,27 +1066,63 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
             return render_template("reset-password.html", **params), 422
 
         # Reset password account
-        salt = bcrypt.gensalt()
+        salt = bcrypt.gensalt(bcrypt_rounds)
         password = form_inputs["password"]
-        user.hash = None
-        user.hashtime = None
-        user.password = bcrypt.hashpw(password.encode('utf8'), salt).decode('utf-8')
+        user.hash_digest = None
+        user.hash_time = None
+        user.password = bcrypt_pool.hashpw(password.encode('utf8'), salt).decode('utf-8')
         db.session.commit()
 
+        if credential_cache is not None:
+            credential_cache.invalidate(user.username)
+
         # Confirm activation to user
         return render_template("reset-password-successful.html", **params), 200
 
     @ app.errorhandler(403)
     def access_forbidden(e: Exception) -> Response:
-        return render_template('403.html'), 403
+        return render_static_page('403.html'), 403
 
     @ app.errorhandler(404)
     def page_not_found(e: Exception) -> Response:
-        return render_template('404.html'), 404
+        return render_static_page('404.html'), 404
 
     @ app.errorhandler(500)
     def internal_error(e: Exception) -> Response:
-        return render_template('500.html'), 500
+        return render_static_page('500.html'), 500
+
+    @ app.errorhandler(BcryptPoolFullError)
+    def service_overloaded(e: Exception) -> Response:
+        """
+        Sheds load when the bcrypt worker pool is saturated, so that clients can retry later
+        instead of piling up requests.
+
+        :param e: Exception raised by the bcrypt worker pool
+
+        :Returns: Flask response (503 + JSON content for API requests, error page otherwise)
+        """
+        if request.path.startswith("/api/"):
+            response = make_response(jsonify({"status": "error", "message": "Service is overloaded."}), 503)
+        else:
+            response = make_response(render_template('503.html'), 503)
+        response.headers["Retry-After"] = str(app.config.get("BCRYPT_POOL_RETRY_AFTER", 1))
+        return response
+
+    @ app.errorhandler(ThrottledError)
+    def too_many_requests(e: ThrottledError) -> Response:
+        """
+        Rejects attempts that exceed a throttle limit.
+
+        :param e: Exception raised by the throttle
+
+        :Returns: Flask response (429 + JSON content for API requests, error page otherwise)
+        """
+        if request.path.startswith("/api/"):
+            response = make_response(jsonify({"status": "error", "message": "Too many requests."}), 429)
+        else:
+            response = make_response(render_template('429.html'), 429)
+        response.headers["Retry-After"] = str(math.ceil(e.retry_after))
+        return response
 
     @ app.after_request
     def add_security_headers(response: Response) -> Response:
@@ -552,8 +1134,40 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
         # X-Content-Type-Options
         response.headers['X-Content-Type-Options'] = 'nosniff'
 
+        compress_html_if_needed(response)
+
         return response
 
+    def compress_html_if_needed(response: Response) -> None:
+        """
+        Compresses rendered HTML pages on the fly, if enabled and accepted by the client.
+
+        Pages that contain a CSRF token are not compressed: compressing a secret together with
+        content that an attacker can influence (e.g. a username in a query parameter) allows
+        recovering the secret from the compressed response sizes (BREACH).
+
+        :param response: Flask response to compress
+        """
+        if (app.config.get("HTML_COMPRESSION_ENABLED", "false").lower() == "false"
+                or (app.config.get("CSRF_TOKENS_ENABLED").lower() != "false"
+                    and app.config.get("WTF_CSRF_FIELD_NAME", "csrf_token") in g)
+                or response.mimetype != "text/html"
+                or response.direct_passthrough
+                or response.status_code < 200 or response.status_code in (204, 304)
+                or "Content-Encoding" in response.headers):
+            return
+
+        response.vary.add("Accept-Encoding")
+        if request.accept_encodings["gzip"] == 0:
+            return
+
+        data = response.get_data()
+        if len(data) < int(app.config.get("HTML_COMPRESSION_MIN_SIZE", 1024)):
+            return
+
+        response.set_data(gzip.compress(data, compresslevel=int(app.config.get("HTML_COMPRESSION_LEVEL", 6))))
+        response.headers["Content-Encoding"] = "gzip"
+
     if not enable_api:
         @app.before_request
         def refuse_api_requests() -> Response:
@@ -594,33 +1208,327 @@ def create_app(config_filename: str = "flask.cfg", enable_api: bool = True) -> F
         Static files handling - recognisable through '/assets/'
         Override requested static file if present in user_static_area
         If not present fall back to the standard supplied static file
+        Both are resolved through the in-memory static asset index
 
         /assets - for the root of the application
         /static - for the static files
 
         :returns: Static file
         """
-        result = get_validated_static_path(
-            request.full_path,
-            request.path,
-            app.config.get('YODA_THEME_PATH'),
-            app.config.get('YODA_THEME')
-        )
-        if result is not None:
-            static_dir, asset_name = result
-            return send_from_directory(static_dir, asset_name)
-
-        return None
+        if not request.path.startswith("/assets/"):
+            return None
+
+        asset = static_index.resolve(request.path[len("/assets/"):])
+        if asset is None:
+            return None
+
+        # Serve a precompressed variant, if the client accepts one
+        encoding = request.accept_encodings.best_match(asset.encodings) if len(asset.encodings) > 0 else None
+        if encoding is not None:
+            filename = asset.filename + get_compressors()[encoding][0]
+            etag = asset.fingerprint + "-" + encoding
+        else:
+            filename = asset.filename
+            etag = asset.fingerprint
+
+        # Fingerprinted URLs always refer to the same content, so they can be cached indefinitely.
+        # Other URLs are revalidated using the ETag.
+        fingerprinted = request.args.get("v") == asset.fingerprint
+        response = send_from_directory(asset.directory, filename,
+                                       mimetype=mimetypes.guess_type(asset.filename)[0] or "application/octet-stream",
+                                       etag=etag,
+                                       max_age=31536000 if fingerprinted else 0)
+        if fingerprinted:
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+        if len(asset.encodings) > 0:
+            response.vary.add("Accept-Encoding")
+        return response
 
     @ app.url_defaults
     def add_cache_buster(endpoint: str, values: Dict[str, str]) -> None:
-        """Add cache buster to asset (static) URLs."""
+        """Add content fingerprint (or commit, for unindexed assets) as cache buster to asset (static) URLs."""
         if endpoint.endswith("static"):
-            values['q'] = app.config.get('YODA_EUS_COMMIT')
+            asset = static_index.resolve(values.get("filename", ""))
+            if asset is not None:
+                values['v'] = asset.fingerprint
+            else:
+                values['q'] = app.config.get('YODA_EUS_COMMIT')
 
     return app
 
 
+# Lookup of the password hash of a user for authentication checks. The statement is constructed once,
+# so that its compiled form is reused from the compiled statement cache of the engine.
+PASSWORD_HASH_QUERY = select(User.password).where(User.username == bindparam("username"))
+PREPARED_PASSWORD_HASH_QUERY = text("EXECUTE eus_password_hash(:username)")
+
+
+def prepare_password_hash_query(dbapi_connection: Any, connection_record: Any) -> None:
+    """
+    Creates a server-side prepared statement for the password hash lookup on a new PostgreSQL
+    connection, so that the query is not parsed and planned again for each authentication check.
+    If the users table does not exist yet (e.g. before the initial migration), the connection
+    falls back to the regular query.
+
+    :param dbapi_connection:  New DBAPI connection
+    :param connection_record: Pool record of the connection
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('PREPARE eus_password_hash(varchar) AS SELECT "password" FROM "users" WHERE "username" = $1')
+        connection_record.info["password_hash_prepared"] = True
+    except Exception:
+        connection_record.info["password_hash_prepared"] = False
+    finally:
+        cursor.close()
+        dbapi_connection.rollback()
+
+
+def get_password_hash(username: str) -> Optional[str]:
+    """
+    Looks up the password hash of a user, without loading an ORM instance into the session. The query
+    runs on a connection of its own that is returned to the pool right after the read. On PostgreSQL, the
+    connection is in autocommit mode, so that the lookup takes a single round trip.
+
+    :param username: Username
+
+    :Returns: password hash of the user, or None if the user does not exist
+    """
+    with db.engine.connect() as connection:
+        if connection.dialect.name == "postgresql":
+            connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+            if connection.connection.info.get("password_hash_prepared"):
+                return connection.execute(PREPARED_PASSWORD_HASH_QUERY, {"username": username}).scalar()
+        return connection.execute(PASSWORD_HASH_QUERY, {"username": username}).scalar()
+
+
+def get_user_ids(usernames: Set[str]) -> Dict[str, int]:
+    """
+    :param usernames: Usernames to look up
+
+    :Returns: dictionary that maps usernames of existing users to their user ids.
+    """
+    user_ids: Dict[str, int] = {}
+    for chunk in chunked(sorted(usernames)):
+        rows = db.session.execute(select(User.username, User.id).where(User.username.in_(chunk)))
+        user_ids.update({row.username: row.id for row in rows})
+    return user_ids
+
+
+def get_user_by_hash(secret_hash: str, cutoff: Optional[datetime]) -> Optional[User]:
+    """
+    :param secret_hash: Secret hash from an activation or password reset link
+    :param cutoff:      Hashes created before this time are expired, None if hashes do not expire
+
+    :Returns: user with this secret hash, or None if there is no such user or the hash has expired
+    """
+    query = User.query.filter(User.hash_digest == get_hash_digest(secret_hash))
+    if cutoff is not None:
+        query = query.filter(User.hash_time >= cutoff)
+    return query.first()
+
+
+def get_db_pool_stats(pool: Pool) -> Dict[str, Any]:
+    """
+    :param pool: Connection pool of the database engine
+
+    :Returns: dictionary with the connection counts of the pool (None for counts that the type of
+              pool does not keep track of).
+    """
+    stats: Dict[str, Any] = {"class": type(pool).__name__}
+    for name in ["size", "checkedout", "checkedin", "overflow"]:
+        stats[name] = getattr(pool, name)() if hasattr(pool, name) else None
+    stats["max_overflow"] = getattr(pool, "_max_overflow", None)
+    return stats
+
+
+def supports_returning() -> bool:
+    """
+    :Returns: whether the current database supports RETURNING clauses. SQLite supports these
+              from version 3.35 onward.
+    """
+    dialect = db.session.get_bind().dialect
+    if dialect.name == "postgresql":
+        return True
+    version = dialect.server_version_info
+    return dialect.name == "sqlite" and version is not None and version >= (3, 35)
+
+
+def get_conflict_insert(table: Table) -> Optional[Union[postgresql.Insert, sqlite.Insert]]:
+    """
+    :param table: Table to insert into
+
+    :Returns: INSERT statement that supports ON CONFLICT DO NOTHING and RETURNING on the
+              current database, or None if the database does not support these.
+    """
+    if not supports_returning():
+        return None
+    elif db.session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def create_users_if_missing(users: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Creates the accounts of users that do not exist yet. Existing accounts are left untouched,
+    so that repeated invitations are idempotent.
+
+    :param users: Column values of the accounts to create
+
+    :Returns: usernames of the accounts that have been created.
+    """
+    created: Set[str] = set()
+    for chunk in chunked(users):
+        statement = get_conflict_insert(User.__table__)
+        if statement is not None:
+            rows = db.session.execute(statement.values(chunk)
+                                      .on_conflict_do_nothing(index_elements=["username"])
+                                      .returning(User.__table__.c.username))
+            created.update(rows.scalars())
+        else:
+            existing = get_user_ids({user["username"] for user in chunk})
+            missing = [user for user in chunk if user["username"] not in existing]
+            if len(missing) > 0:
+                db.session.execute(insert(User.__table__), missing)
+            created.update(user["username"] for user in missing)
+    return created
+
+
+def renew_expired_invitations(users: List[Dict[str, Any]], cutoff: Optional[datetime]) -> Set[str]:
+    """
+    Gives existing accounts that have not been activated before their activation link expired the
+    activation hash of a repeated invitation, so that the invitation can be sent again.
+
+    :param users:  Column values of the accounts from the invitations
+    :param cutoff: Activation hashes created before this time are expired, or None if they do not expire
+
+    :Returns: usernames of the accounts that have a renewed activation hash.
+    """
+    renewed: Set[str] = set()
+    if cutoff is None:
+        return renewed
+    expired = get_expired_activation_condition(cutoff)
+    users_by_username = {user["username"]: user for user in users}
+    for chunk in chunked(list(users_by_username)):
+        usernames = db.session.execute(select(User.username).where(User.username.in_(chunk), expired)).scalars().all()
+        for username in usernames:
+            # The condition is checked again, in case the account has been activated in the meantime
+            result = cast("CursorResult[Any]", db.session.execute(
+                update(User)
+                .where(User.username == username, expired)
+                .values(hash_digest=users_by_username[username]["hash_digest"],
+                        hash_time=users_by_username[username]["hash_time"])
+                .execution_options(synchronize_session=False)))
+            if result.rowcount > 0:
+                renewed.add(username)
+    return renewed
+
+
+def register_user_zone(username: str, inviter_user: str, inviter_zone: str, inviter_time: datetime) -> None:
+    """
+    Registers the invitation of a user in a zone, unless the user is already registered in that zone.
+    The user id is looked up as part of the insert, so that this takes a single round trip.
+
+    :param username:     Username of the invited user
+    :param inviter_user: Yoda user who invited the user
+    :param inviter_zone: Zone of the Yoda user who invited the user
+    :param inviter_time: Time of the invitation
+    """
+    statement = get_conflict_insert(UserZone.__table__)
+    if statement is not None:
+        invitation = select(User.id,
+                            literal(inviter_user, String),
+                            literal(inviter_zone, String),
+                            literal(inviter_time, TIMESTAMP)).where(User.username == username)
+        db.session.execute(statement.from_select(["user_id", "inviter_user", "inviter_zone", "inviter_time"], invitation)
+                           .on_conflict_do_nothing(index_elements=["user_id", "inviter_zone"]))
+    else:
+        user_id = get_user_ids({username})[username]
+        register_user_zones([{"user_id": user_id,
+                              "inviter_user": inviter_user,
+                              "inviter_zone": inviter_zone,
+                              "inviter_time": inviter_time}])
+
+
+def register_user_zones(user_zones: List[Dict[str, Any]]) -> None:
+    """
+    Registers invitations of users in zones. Invitations of users that are already registered in
+    the zone are skipped.
+
+    :param user_zones: Column values of the user_zones rows to create
+    """
+    for chunk in chunked(user_zones):
+        statement = get_conflict_insert(UserZone.__table__)
+        if statement is not None:
+            db.session.execute(statement.values(chunk)
+                               .on_conflict_do_nothing(index_elements=["user_id", "inviter_zone"]))
+        else:
+            rows = db.session.execute(select(UserZone.user_id, UserZone.inviter_zone)
+                                      .where(UserZone.user_id.in_({user_zone["user_id"] for user_zone in chunk})))
+            registered = {(row.user_id, row.inviter_zone) for row in rows}
+            missing = {(user_zone["user_id"], user_zone["inviter_zone"]): user_zone for user_zone in chunk
+                       if (user_zone["user_id"], user_zone["inviter_zone"]) not in registered}
+            if len(missing) > 0:
+                db.session.execute(insert(UserZone.__table__), list(missing.values()))
+
+
+def delete_zone_registrations(user_ids: List[int], zone: str) -> None:
+    """
+    Deletes the registrations of users in a zone.
+
+    :param user_ids: User ids of the users
+    :param zone:     Zone to delete the registrations of
+    """
+    for chunk in chunked(user_ids):
+        db.session.execute(delete(UserZone)
+                           .where(UserZone.inviter_zone == zone, UserZone.user_id.in_(chunk))
+                           .execution_options(synchronize_session=False))
+
+
+def delete_unregistered_users(user_ids: List[int]) -> List[str]:
+    """
+    Deletes the accounts of users that have no zone registrations left.
+
+    :param user_ids: User ids of the users to consider
+
+    :Returns: usernames of the deleted accounts.
+    """
+    registrations = select(UserZone.user_id).where(UserZone.user_id == User.id).exists()
+    deleted_usernames: List[str] = []
+    for chunk in chunked(user_ids):
+        if supports_returning():
+            rows = db.session.execute(delete(User)
+                                      .where(User.id.in_(chunk), ~registrations)
+                                      .returning(User.username)
+                                      .execution_options(synchronize_session=False))
+            deleted_usernames.extend(rows.scalars())
+        else:
+            rows = db.session.execute(select(User.id, User.username).where(User.id.in_(chunk), ~registrations))
+            users = {row.id: row.username for row in rows}
+            db.session.execute(delete(User)
+                               .where(User.id.in_(list(users)), ~registrations)
+                               .execution_options(synchronize_session=False))
+            deleted_usernames.extend(users.values())
+    return deleted_usernames
+
+
+def chunked(values: List[Any], size: int = 500) -> Iterator[List[Any]]:
+    """
+    Splits a list into chunks, so that IN clauses stay below database parameter limits.
+
+    :param values: List to split
+    :param size:   Maximum chunk size
+
+    :yields: chunks of the list
+    """
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
 def get_random_hash():
     """
     :Returns: random value for the password reset and account activation secrets.
@@ -0,0 +1,165 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import bcrypt
+from yoda_eus.metrics import BCRYPT_DURATION
+
+
+class BcryptPoolFullError(Exception):
+    """Raised when the bcrypt worker pool cannot accept more work."""
+
+
+class BcryptPool:
+    """Dedicated thread pool for bcrypt computations with a bounded queue.
+
+    bcrypt releases the GIL while hashing, so running it on a separate pool keeps request threads
+    free for cheap requests (e.g. health checks) during login bursts. Work is only admitted if a
+    worker or queue slot is available; otherwise BcryptPoolFullError is raised, so that callers can
+    shed load instead of piling up requests.
+    """
+
+    def __init__(self, workers: int = 4, queue_size: int = 32) -> None:
+        """
+        :param workers:    Number of worker threads
+        :param queue_size: Maximum number of jobs waiting for a worker
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._started = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> "Future[Any]":
+        """Submits a job to the pool.
+
+        :param fn:   Function to run on a worker thread
+        :param args: Arguments of the function
+
+        :returns: Future of the result of the function
+
+        :raises BcryptPoolFullError: If all workers are busy and the queue is full
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise BcryptPoolFullError("bcrypt worker pool is saturated")
+
+        with self._lock:
+            self._queued += 1
+        submit_time = time.monotonic()
+
+        def run_job() -> Any:
+            wait = time.monotonic() - submit_time
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+                self._started += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+                self._slots.release()
+
+        return self._executor.submit(run_job)
+
+    def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Runs a job on the pool and waits for its result.
+
+        :param fn:   Function to run on a worker thread
+        :param args: Arguments of the function
+
+        :returns: Result of the function
+        """
+        return self.submit(fn, *args).result()
+
+    def checkpw(self, password: bytes, hashed_password: bytes) -> bool:
+        """Checks a password against a bcrypt hash on the pool.
+
+        :param password:        Password to check
+        :param hashed_password: bcrypt hash to check the password against
+
+        :returns: boolean value that indicates whether the password matches the hash
+        """
+        return self.run(BCRYPT_DURATION.labels("verify").time()(bcrypt.checkpw), password, hashed_password)
+
+    def hashpw(self, password: bytes, salt: bytes) -> bytes:
+        """Hashes a password on the pool.
+
+        :param password: Password to hash
+        :param salt:     bcrypt salt, as generated by bcrypt.gensalt()
+
+        :returns: bcrypt hash of the password
+        """
+        return self.run(BCRYPT_DURATION.labels("hash").time()(bcrypt.hashpw), password, salt)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :returns: dictionary with queue depth, wait time and throughput counters of the pool
+        """
+        with self._lock:
+            return {"workers": self.workers,
+                    "queue_size": self.queue_size,
+                    "queue_depth": self._queued,
+                    "active": self._active,
+                    "completed": self._completed,
+                    "rejected": self._rejected,
+                    "wait_time_avg": self._total_wait / self._started if self._started > 0 else None,
+                    "wait_time_max": self._max_wait}
+
+
+def get_hash_rounds(hashed_password: str) -> Optional[int]:
+    """Determines the cost factor of a bcrypt hash.
+
+    :param hashed_password: bcrypt hash, e.g. "$2b$12$..."
+
+    :returns: cost factor (log2 of the number of rounds), or None if the hash is not a bcrypt hash
+    """
+    parts = hashed_password.split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def calibrate_rounds(target_seconds: float,
+                     min_rounds: int = 4,
+                     max_rounds: int = 16) -> Tuple[int, List[Tuple[int, float]]]:
+    """Measures bcrypt hashing time on this host and proposes a cost factor.
+
+    The cost factor is increased until hashing takes longer than the target time. The proposed cost
+    factor is the highest one that still meets the target (or the minimum cost factor, if none does).
+
+    :param target_seconds: Target duration of a single password verification, in seconds
+    :param min_rounds:     Minimum cost factor to consider
+    :param max_rounds:     Maximum cost factor to consider
+
+    :returns: tuple of proposed cost factor and list of measured (cost factor, duration) pairs
+    """
+    password = b"Calibration-Password-123!"
+    measurements = []
+    proposal = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        salt = bcrypt.gensalt(rounds)
+        start_time = time.perf_counter()
+        bcrypt.hashpw(password, salt)
+        duration = time.perf_counter() - start_time
+        measurements.append((rounds, duration))
+        if duration > target_seconds:
+            break
+        proposal = rounds
+    return proposal, measurements
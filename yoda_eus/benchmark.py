@@ -0,0 +1,330 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import bcrypt
+from flask import Flask
+from flask.testing import FlaskClient
+from sqlalchemy import insert
+from werkzeug.test import TestResponse
+from yoda_eus.app import create_app
+from yoda_eus.models import db, User, UserZone
+from yoda_eus.util import get_hash_digest
+
+SCENARIOS = ["auth_check", "add", "delete", "activate", "reset", "assets"]
+
+API_SECRET = "benchmark_api_secret"
+PASSWORD = "Benchmark-Password-123!"
+ZONE = "benchmarkZone"
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server session, which accepts and discards all messages."""
+
+    def reply(self, line: str) -> None:
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self) -> None:
+        self.reply("220 localhost Fake SMTP server")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii", errors="replace").strip().upper()
+            if command.startswith("EHLO"):
+                self.wfile.write(b"250-localhost\r\n250 8BITMIME\r\n")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                self.server.messages += 1  # type: ignore
+                self.reply("250 OK")
+            elif command.startswith("QUIT"):
+                self.reply("221 Bye")
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET and NOOP
+                self.reply("250 OK")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """In-process SMTP server on a free local port, so that mail delivery can be benchmarked
+    without an actual mail server."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.messages = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> None:
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def get_percentile(sorted_values: List[float], percentile: float) -> Optional[float]:
+    """
+    :param sorted_values: Values in ascending order
+    :param percentile:    Percentile to compute (0-100)
+
+    :returns: percentile of the values (nearest rank method, rounded to three decimals), or None if
+              there are no values
+    """
+    if len(sorted_values) == 0:
+        return None
+    rank = max(1, math.ceil(percentile / 100 * len(sorted_values)))
+    return round(sorted_values[rank - 1], 3)
+
+
+def run_scenario(app: Flask,
+                 request_fn: Callable[[FlaskClient, int], TestResponse],
+                 expected_status: int,
+                 requests: int,
+                 concurrency: int) -> Dict[str, Any]:
+    """Runs requests concurrently and measures their latency.
+
+    :param app:             Flask application to send requests to
+    :param request_fn:      Function that sends the n-th request using a test client
+    :param expected_status: HTTP status of successful requests
+    :param requests:        Number of requests
+    :param concurrency:     Number of concurrent clients
+
+    :returns: dictionary with throughput (requests per second), errors and latency percentiles (ms)
+    """
+    local = threading.local()
+
+    def send_request(n: int) -> Optional[float]:
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        start_time = time.perf_counter()
+        response = request_fn(local.client, n)
+        duration = time.perf_counter() - start_time
+        response.close()
+        return duration if response.status_code == expected_status else None
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        durations = list(executor.map(send_request, range(requests)))
+    elapsed = time.perf_counter() - start_time
+
+    latencies = sorted(duration * 1000 for duration in durations if duration is not None)
+    return {"requests": requests,
+            "errors": requests - len(latencies),
+            "throughput": round(requests / elapsed, 2),
+            "mean": round(sum(latencies) / len(latencies), 3) if len(latencies) > 0 else None,
+            "p50": get_percentile(latencies, 50),
+            "p95": get_percentile(latencies, 95),
+            "p99": get_percentile(latencies, 99)}
+
+
+def write_config(work_dir: str, database_uri: str, smtp_port: int, bcrypt_rounds: int, auth_cache: bool) -> str:
+    """Writes a configuration file for the benchmark, based on the test configuration.
+
+    :param work_dir:      Directory for the configuration file and theme
+    :param database_uri:  Database URI
+    :param smtp_port:     Port of the fake SMTP server
+    :param bcrypt_rounds: bcrypt cost factor of password hashes
+    :param auth_cache:    Whether the verified-credential cache is enabled
+
+    :returns: path of the configuration file
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(package_dir, "tests", "flask.test.cfg")) as f:
+        config = f.read()
+
+    theme_static_dir = os.path.join(work_dir, "themes", "uu", "static", "css")
+    os.makedirs(theme_static_dir)
+    with open(os.path.join(theme_static_dir, "benchmark.css"), "w") as f:
+        f.write("body { color: black; }\n" * 200)
+
+    overrides = {"API_SECRET": API_SECRET,
+                 "YODA_THEME_PATH": os.path.join(work_dir, "themes"),
+                 "AUTH_CACHE_ENABLED": "true" if auth_cache else "false",
+                 "BCRYPT_ROUNDS": bcrypt_rounds,
+                 "BCRYPT_POOL_SIZE": os.cpu_count() or 2,
+                 "BCRYPT_POOL_QUEUE_SIZE": 1024,
+                 "SMTP_SERVER": "smtp://127.0.0.1:{}".format(smtp_port),
+                 "MAIL_ENABLED": "true",
+                 "MAIL_TEMPLATE_DIR": os.path.join(package_dir, "templates", "mail"),
+                 "DB_OVERRIDE_URI": database_uri,
+                 "THROTTLE_ENABLED": "false",
+                 "LOAD_TEST_DATA": "false"}
+    config_filename = os.path.join(work_dir, "flask.cfg")
+    with open(config_filename, "w") as f:
+        f.write(config + "\n" + "\n".join("{} = {!r}".format(key, value) for key, value in overrides.items()) + "\n")
+    return config_filename
+
+
+def seed_users(app: Flask, count: int, bcrypt_rounds: int) -> None:
+    """Inserts users for the authentication, activation and password reset scenarios.
+
+    :param app:           Flask application
+    :param count:         Number of users per scenario
+    :param bcrypt_rounds: bcrypt cost factor of password hashes
+    """
+    now = datetime.now()
+    password_hash = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(bcrypt_rounds)).decode("utf-8")
+    users = []
+    for n in range(count):
+        common = {"creator_time": now, "creator_user": "benchmark", "creator_zone": ZONE, "hash_time": now}
+        users.append({"username": "auth-{}@example.com".format(n), "password": password_hash,
+                      "hash_digest": None, **common})
+        users.append({"username": "activate-{}@example.com".format(n), "password": None,
+                      "hash_digest": get_hash_digest("activate-{}".format(n)), **common})
+        users.append({"username": "reset-{}@example.com".format(n), "password": password_hash,
+                      "hash_digest": get_hash_digest("reset-{}".format(n)), **common})
+    with app.app_context():
+        db.session.execute(insert(User.__table__), users)
+        db.session.execute(insert(UserZone.__table__),
+                           [{"user_id": user.id, "inviter_user": "benchmark", "inviter_zone": ZONE, "inviter_time": now}
+                            for user in User.query.all()])
+        db.session.commit()
+
+
+def get_scenarios() -> Dict[str, Any]:
+    """
+    :returns: dictionary that maps scenario names to (request function, expected HTTP status) tuples
+    """
+    api_headers = {"X-Yoda-External-User-Secret": API_SECRET}
+
+    def auth_check(client: FlaskClient, n: int) -> TestResponse:
+        credentials = base64.b64encode("auth-{}@example.com:{}".format(n, PASSWORD).encode("utf-8")).decode("utf-8")
+        return client.post("/api/user/auth-check",
+                           headers={**api_headers, "Authorization": "Basic " + credentials})
+
+    def add(client: FlaskClient, n: int) -> TestResponse:
+        return client.post("/api/user/add", headers=api_headers,
+                           json={"username": "new-{}@example.com".format(n),
+                                 "creator_user": "benchmark",
+                                 "creator_zone": ZONE})
+
+    def delete(client: FlaskClient, n: int) -> TestResponse:
+        return client.post("/api/user/delete", headers=api_headers,
+                           json={"username": "new-{}@example.com".format(n), "userzone": ZONE})
+
+    def activate(client: FlaskClient, n: int) -> TestResponse:
+        return client.post("/user/activate/activate-{}".format(n),
+                           data={"username": "activate-{}@example.com".format(n),
+                                 "password": PASSWORD,
+                                 "password_again": PASSWORD,
+                                 "cb-activation-tou": "on"})
+
+    def reset(client: FlaskClient, n: int) -> TestResponse:
+        return client.post("/user/reset-password/reset-{}".format(n),
+                           data={"username": "reset-{}@example.com".format(n),
+                                 "password": PASSWORD,
+                                 "password_again": PASSWORD})
+
+    def assets(client: FlaskClient, n: int) -> TestResponse:
+        return client.get("/assets/css/benchmark.css")
+
+    return {"auth_check": (auth_check, 200),
+            "add": (add, 201),
+            "delete": (delete, 204),
+            "activate": (activate, 200),
+            "reset": (reset, 200),
+            "assets": (assets, 200)}
+
+
+def run_benchmark(scenarios: List[str],
+                  requests: int,
+                  concurrency: int,
+                  database_uri: Optional[str],
+                  bcrypt_rounds: int,
+                  auth_cache: bool) -> Dict[str, Any]:
+    """Runs benchmark scenarios against a fresh EUS instance.
+
+    :param scenarios:     Names of the scenarios to run, in order (deletes are of users created by "add")
+    :param requests:      Number of requests per scenario
+    :param concurrency:   Number of concurrent clients
+    :param database_uri:  URI of an empty database, or None to use a temporary SQLite database
+    :param bcrypt_rounds: bcrypt cost factor of password hashes
+    :param auth_cache:    Whether the verified-credential cache is enabled
+
+    :returns: dictionary with benchmark settings and results per scenario
+    """
+    smtp_server = FakeSMTPServer()
+    smtp_server.start()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            uri = database_uri or "sqlite:///" + os.path.join(work_dir, "eus.db")
+            config_filename = write_config(work_dir, uri, smtp_server.port, bcrypt_rounds, auth_cache)
+            app = create_app(config_filename=config_filename)
+            seed_users(app, requests, bcrypt_rounds)
+
+            available_scenarios = get_scenarios()
+            results = {}
+            for scenario in scenarios:
+                request_fn, expected_status = available_scenarios[scenario]
+                results[scenario] = run_scenario(app, request_fn, expected_status, requests, concurrency)
+    finally:
+        smtp_server.shutdown()
+        smtp_server.server_close()
+
+    return {"time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {"requests": requests,
+                         "concurrency": concurrency,
+                         "database": uri.split(":")[0],
+                         "bcrypt_rounds": bcrypt_rounds,
+                         "auth_cache": auth_cache},
+            "emails_sent": smtp_server.messages,
+            "results": results}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Command line interface of the benchmark.
+
+    :param argv: Command line arguments
+
+    :returns: exit code
+    """
+    parser = argparse.ArgumentParser(
+        description="Measure throughput and latency (ms) of EUS endpoints and report them as JSON.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="Scenario to run (can be repeated; default: all)")
+    parser.add_argument("--requests", type=int, default=200, help="Number of requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of concurrent clients")
+    parser.add_argument("--database-uri", default=None,
+                        help="URI of an empty throwaway database (default: temporary SQLite database)")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12, help="bcrypt cost factor of password hashes")
+    parser.add_argument("--auth-cache", action="store_true", help="Enable the verified-credential cache")
+    parser.add_argument("--output", default=None, help="File to write the results to (default: standard output)")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.scenario or SCENARIOS,
+                           args.requests,
+                           args.concurrency,
+                           args.database_uri,
+                           args.bcrypt_rounds,
+                           args.auth_cache)
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
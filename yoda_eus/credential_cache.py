@@ -0,0 +1,116 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+def get_credentials_digest(key: bytes, username: str, password: str) -> bytes:
+    """Computes a keyed digest of a username and password combination, which can be used to
+    recognize credentials without keeping the plaintext password.
+
+    :param key:      HMAC key, which should be secret and random
+    :param username: Username
+    :param password: Password submitted by the user
+
+    :returns: HMAC-SHA256 digest of the credentials
+    """
+    message = username.encode("utf-8") + b"\0" + password.encode("utf-8")
+    return hmac.new(key, message, hashlib.sha256).digest()
+
+
+class CredentialCache:
+    """Bounded in-process cache of recently verified credentials.
+
+    Entries are keyed on the username and a keyed HMAC of the submitted password, so plaintext
+    passwords are never kept in memory. The HMAC key is generated per process and never leaves it.
+    Each entry also records the stored password hash that the password was verified against. A cache
+    hit only counts if that hash is still the current one, so that password changes made by other
+    worker processes invalidate entries as well.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0) -> None:
+        """
+        :param max_size: Maximum number of entries in the cache
+        :param ttl:      Number of seconds that a verification result stays valid
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._key = secrets.token_bytes(32)
+        self._entries: "OrderedDict[Tuple[str, bytes], Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def password_digest(self, username: str, password: str) -> bytes:
+        """Computes the keyed digest of a username and password combination.
+
+        :param username: Username
+        :param password: Password submitted by the user
+
+        :returns: HMAC-SHA256 digest of the credentials
+        """
+        return get_credentials_digest(self._key, username, password)
+
+    def lookup(self, username: str, password: str, password_hash: str) -> bool:
+        """Checks whether credentials have recently been verified against a password hash.
+
+        :param username:      Username
+        :param password:      Password submitted by the user
+        :param password_hash: Current password hash of the user in the database
+
+        :returns: boolean value that indicates whether a valid cache entry was found
+        """
+        key = (username, self.password_digest(username, password))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now and hmac.compare_digest(entry[0], password_hash):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False
+
+    def store(self, username: str, password: str, password_hash: str) -> None:
+        """Remembers a successful verification of credentials against a password hash.
+
+        :param username:      Username
+        :param password:      Password submitted by the user
+        :param password_hash: Password hash that the password was verified against
+        """
+        key = (username, self.password_digest(username, password))
+        with self._lock:
+            self._entries[key] = (password_hash, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str) -> None:
+        """Removes all cache entries of a user, e.g. after their account has been changed.
+
+        :param username: Username
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == username]:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """
+        :returns: dictionary with size and hit/miss counters of the cache
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._entries),
+                    "max_size": self.max_size,
+                    "ttl": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_ratio": self.hits / total if total > 0 else None}
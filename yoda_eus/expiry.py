@@ -0,0 +1,121 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+from datetime import datetime, timedelta
+from typing import Any, cast, Optional, Tuple
+
+from flask import Flask
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.engine import CursorResult
+from sqlalchemy.sql.elements import ColumnElement
+from yoda_eus.models import db, User, UserZone
+
+# Default number of seconds that activation links (invitations) and password reset links are valid
+DEFAULT_ACTIVATION_LINK_VALIDITY = 14 * 24 * 3600
+DEFAULT_RESET_LINK_VALIDITY = 24 * 3600
+
+
+def get_hash_cutoff(app: Flask, validity_key: str, default_validity: int) -> Optional[datetime]:
+    """Determines the creation time of the oldest secret hash that is still valid.
+
+    :param app:              Flask application, used for retrieving configuration
+    :param validity_key:     Configuration key of the validity period, in seconds (0 means no expiry)
+    :param default_validity: Default validity period, in seconds
+
+    :returns: creation time of the oldest valid hash, or None if hashes do not expire
+    """
+    validity = int(app.config.get(validity_key, default_validity))
+    if validity <= 0:
+        return None
+    return datetime.now() - timedelta(seconds=validity)
+
+
+def get_expired_activation_condition(cutoff: datetime) -> "ColumnElement[bool]":
+    """
+    :param cutoff: Activation hashes created before this time are expired
+
+    :returns: condition that matches users that have not activated their account, and whose activation
+              link has expired
+    """
+    return and_(or_(User.password.is_(None), User.password == ""),
+                User.hash_time < cutoff)
+
+
+def clear_expired_hashes(cutoff: datetime, batch_size: int) -> int:
+    """Clears a batch of expired password reset hashes of activated users, in its own transaction.
+
+    :param cutoff:     Hashes created before this time are expired
+    :param batch_size: Maximum number of hashes to clear
+
+    :returns: number of cleared hashes
+    """
+    expired = and_(User.hash_digest.is_not(None),
+                   User.password.is_not(None),
+                   User.password != "",
+                   User.hash_time < cutoff)
+    user_ids = db.session.execute(select(User.id).where(expired).limit(batch_size)).scalars().all()
+    if len(user_ids) > 0:
+        db.session.execute(update(User)
+                           .where(User.id.in_(user_ids), expired)
+                           .values(hash_digest=None, hash_time=None)
+                           .execution_options(synchronize_session=False))
+    db.session.commit()
+    return len(user_ids)
+
+
+def delete_unactivated_users(cutoff: datetime, batch_size: int) -> int:
+    """Deletes a batch of users that did not activate their account before their activation link expired,
+    along with their zone registrations, in its own transaction.
+
+    :param cutoff:     Activation hashes created before this time are expired
+    :param batch_size: Maximum number of users to delete
+
+    :returns: number of deleted users
+    """
+    unactivated = get_expired_activation_condition(cutoff)
+    user_ids = db.session.execute(select(User.id).where(unactivated).limit(batch_size)).scalars().all()
+    deleted = 0
+    if len(user_ids) > 0:
+        # Conditions are checked again, in case a user has activated their account in the meantime
+        stale_user_ids = select(User.id).where(User.id.in_(user_ids), unactivated)
+        db.session.execute(delete(UserZone)
+                           .where(UserZone.user_id.in_(stale_user_ids))
+                           .execution_options(synchronize_session=False))
+        result = db.session.execute(delete(User)
+                                    .where(User.id.in_(user_ids), unactivated)
+                                    .execution_options(synchronize_session=False))
+        deleted = cast("CursorResult[Any]", result).rowcount
+    db.session.commit()
+    return deleted
+
+
+def sweep_expired_users(app: Flask, batch_size: int) -> Tuple[int, int]:
+    """Clears expired password reset hashes and deletes users with expired activation links.
+
+    Work is done in batches with a transaction per batch, so that locks on the users table are
+    only held briefly.
+
+    :param app:        Flask application, used for retrieving configuration
+    :param batch_size: Maximum number of users per batch
+
+    :returns: tuple of number of cleared hashes and number of deleted users
+    """
+    cleared = 0
+    reset_cutoff = get_hash_cutoff(app, "RESET_LINK_VALIDITY", DEFAULT_RESET_LINK_VALIDITY)
+    if reset_cutoff is not None:
+        while True:
+            count = clear_expired_hashes(reset_cutoff, batch_size)
+            cleared += count
+            if count < batch_size:
+                break
+
+    deleted = 0
+    activation_cutoff = get_hash_cutoff(app, "ACTIVATION_LINK_VALIDITY", DEFAULT_ACTIVATION_LINK_VALIDITY)
+    if activation_cutoff is not None:
+        while True:
+            count = delete_unactivated_users(activation_cutoff, batch_size)
+            deleted += count
+            if count < batch_size:
+                break
+
+    return cleared, deleted
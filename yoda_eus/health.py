@@ -0,0 +1,52 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class CachedProbe:
+    """Dependency check whose result is cached for a short time.
+
+    Health checks of load balancers can arrive several times per second per node, so the check
+    itself (e.g. a database round trip) runs at most once per TTL. While one thread runs the check,
+    other threads get the previous result instead of starting another check.
+    """
+
+    def __init__(self, check: Callable[[], bool], ttl: float = 5.0) -> None:
+        """
+        :param check: Function that returns whether the dependency is available. Exceptions count as unavailable.
+        :param ttl:   Number of seconds that a check result stays valid
+        """
+        self.check = check
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._result: Optional[bool] = None
+        self._checked_time = 0.0
+
+    def _is_fresh(self) -> bool:
+        """
+        :returns: boolean value that indicates whether the cached result is still valid
+        """
+        return self._result is not None and time.monotonic() - self._checked_time < self.ttl
+
+    def get(self) -> Dict[str, Any]:
+        """Returns the cached result of the check, running the check if the result has expired.
+
+        :returns: dictionary with status ("ok" or "error") and age of the result in seconds
+        """
+        if not self._is_fresh() and self._lock.acquire(blocking=self._result is None):
+            try:
+                if not self._is_fresh():
+                    try:
+                        result = bool(self.check())
+                    except Exception:
+                        result = False
+                    self._result = result
+                    self._checked_time = time.monotonic()
+            finally:
+                self._lock.release()
+
+        return {"status": "ok" if self._result else "error",
+                "age": round(time.monotonic() - self._checked_time, 3)}
@@ -0,0 +1,125 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+from typing import Any, Iterator, Optional, Tuple
+
+from flask import Flask, Request, Response
+from flask.sessions import SessionInterface, SessionMixin
+
+
+class LazySession(SessionMixin):
+    """Session proxy that only opens the underlying session when it is first used.
+
+    Opening a server-side session reads it from the session store, so views that never use the
+    session (e.g. the index page) should not pay for that. The session attributes of SessionMixin
+    are forwarded to the underlying session.
+    """
+
+    def __init__(self, interface: SessionInterface, app: Flask, request: Request) -> None:
+        """
+        :param interface: Session interface that opens the underlying session
+        :param app:       Flask application
+        :param request:   Request the session belongs to
+        """
+        self._interface = interface
+        self._app = app
+        self._request = request
+        self._session: Optional[SessionMixin] = None
+
+    @property
+    def loaded(self) -> bool:
+        """
+        :returns: boolean value that indicates whether the underlying session has been opened
+        """
+        return self._session is not None
+
+    def load(self) -> SessionMixin:
+        """Opens the underlying session, if it has not been opened yet.
+
+        :returns: underlying session
+        """
+        if self._session is None:
+            session = self._interface.open_session(self._app, self._request)
+            self._session = session if session is not None else self._interface.make_null_session(self._app)
+        return self._session
+
+    @property
+    def permanent(self) -> bool:
+        return self.load().permanent
+
+    @permanent.setter
+    def permanent(self, value: bool) -> None:
+        self.load().permanent = value
+
+    @property
+    def new(self) -> bool:
+        return self.load().new
+
+    @new.setter
+    def new(self, value: bool) -> None:
+        self.load().new = value
+
+    @property
+    def accessed(self) -> bool:
+        return self.loaded and self.load().accessed
+
+    @accessed.setter
+    def accessed(self, value: bool) -> None:
+        self.load().accessed = value
+
+    @property
+    def modified(self) -> bool:
+        return self.load().modified
+
+    @modified.setter
+    def modified(self, value: bool) -> None:
+        self.load().modified = value
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.load()[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.load()[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self.load()[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.load())
+
+    def __len__(self) -> int:
+        return len(self.load())
+
+
+class LazySessionInterface(SessionInterface):
+    """Session interface that defers opening sessions until they are used.
+
+    Requests for stateless paths (e.g. the API) get no session at all: they receive a null session,
+    which can be read but not written. Other requests get a LazySession, which is only read from and
+    saved to the session store if the view actually uses it.
+    """
+
+    def __init__(self, interface: SessionInterface, stateless_prefixes: Tuple[str, ...] = ()) -> None:
+        """
+        :param interface:          Session interface of the session store (e.g. from Flask-Session)
+        :param stateless_prefixes: Path prefixes of requests that do not get a session
+        """
+        self.interface = interface
+        self.stateless_prefixes = stateless_prefixes
+
+    def open_session(self, app: Flask, request: Request) -> Optional[SessionMixin]:
+        if request.path.startswith(self.stateless_prefixes):
+            return None
+        return LazySession(self.interface, app, request)
+
+    def save_session(self, app: Flask, session: SessionMixin, response: Response) -> None:
+        if not isinstance(session, LazySession) or not session.loaded:
+            return
+        underlying_session = session.load()
+        if not self.interface.is_null_session(underlying_session):
+            self.interface.save_session(app, underlying_session, response)
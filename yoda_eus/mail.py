@@ -5,12 +5,15 @@ import email
 import os
 import re
 import smtplib
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from pathlib import Path
 
 from email_validator import EmailNotValidError, validate_email
 from jinja2 import BaseLoader, Environment
+from yoda_eus.metrics import SMTP_DURATION
 
 
 def is_email_valid(address):
@@ -45,18 +48,31 @@ def send_email_template_if_needed(app, to, subject, template_name, template_data
     :param template_name:      Name of the template in the template directory to use, excluding extensions
     :param template_data:      Variables to interpolate, as a dictionary
 
+    """
+    if is_email_delivery_needed(app, to, subject):
+        send_email_template(app, to, subject, template_name, template_data)
+
+
+def is_email_delivery_needed(app, to, subject):
+    """Determines whether an e-mail should be delivered, and logs a warning if not.
+
+    :param app:     Flask application, used for logging and retrieving configuration
+    :param to:      Recipient of the mail
+    :param subject: Subject of mail
+
+    :returns: boolean value that indicates whether the email should be delivered
     """
     if app.config.get("MAIL_ENABLED").lower() == "false":
         app.logger.warning("Not sending email to '{}' with subject '{}', because email delivery is disabled.".format(
                            to, subject))
-        return
+        return False
 
     if (not is_email_valid(to) and app.config.get("MAIL_ONLY_TO_VALID_ADDRESS").lower() == "true"):
         app.logger.warning("Not sending email to '{}' with subject '{}', because recipient address is invalid.".format(
             to, subject))
-        return
+        return False
 
-    send_email_template(app, to, subject, template_name, template_data)
+    return True
 
 
 def send_email_template(app, to, subject, template_name, template_data):
@@ -73,18 +89,9 @@ def send_email_template(app, to, subject, template_name, template_data):
     :param template_data:      Variables to interpolate, as a dictionary
 
     """
-    template_path = os.path.join(app.config.get("MAIL_TEMPLATE_DIR"),
-                                 app.config.get("MAIL_TEMPLATE"))
-
-    text_template = Path(os.path.join(template_path, template_name + ".txt.j2")).read_text()
-    html_main_template = Path(os.path.join(template_path, template_name + ".html.j2")).read_text()
-    html_header_template = Path(os.path.join(template_path, "common-start.html.j2")).read_text()
-    html_footer_template = Path(os.path.join(template_path, "common-end.html.j2")).read_text()
-    html_full_template = html_header_template + html_main_template + html_footer_template
-
-    plain_body_template = Environment(loader=BaseLoader).from_string(text_template)
+    plain_body_template, html_body_template = get_mail_template_cache(app).get(
+        app.config.get("MAIL_TEMPLATE_DIR"), app.config.get("MAIL_TEMPLATE"), template_name)
     plain_body = plain_body_template.render(**template_data)
-    html_body_template = Environment(loader=BaseLoader).from_string(html_full_template)
     html_body = html_body_template.render(**template_data)
 
     send_email(app, to, subject, plain_body, html_body)
@@ -94,7 +101,8 @@ def send_email(app, to, subject, plain_body, html_body):
     """Send an e-mail with specified recipient, subject and body.
 
     The originating address and mail server credentials are taken from the
-    app configuration file.
+    app configuration file. The mail is sent over a pooled connection; errors
+    during sending are raised as exceptions by the pool.
 
     :param app:        Flask application, used for logging and retrieving configuration
     :param to:         Recipient of the mail
@@ -102,8 +110,6 @@ def send_email(app, to, subject, plain_body, html_body):
     :param plain_body: Body of mail (plain text)
     :param html_body:  Body of mail (HTML)
 
-    :raises Exception: For errors during sending the email
-
     """
     app.logger.info('Sending mail to <{}>, subject <{}>'.format(to, subject))
 
@@ -118,43 +124,344 @@ def send_email(app, to, subject, plain_body, html_body):
     mp_msg['To'] = to
     mp_msg['Subject'] = subject
 
-    # e.g. 'smtps://smtp.gmail.com:465' for SMTP over TLS, or
-    # 'smtp://smtp.gmail.com:587' for STARTTLS on the mail submission port.
-    proto, host, port = re.search(r'^(smtps?)://([^:]+)(?::(\d+))?$',
-                                  app.config.get('SMTP_SERVER')).groups()
+    mp_msg.attach(MIMEText(plain_body, 'plain'))
+    mp_msg.attach(MIMEText(html_body, 'html'))
 
-    # Default to port 465 for SMTP over TLS, and 587 for standard mail
-    # submission with STARTTLS.
-    port = int(port or (465 if proto == 'smtps' else 587))
+    get_smtp_pool(app).sendmail(app.config.get("SMTP_FROM_EMAIL"), [to], mp_msg.as_string())
 
-    try:
-        smtp = (smtplib.SMTP_SSL if proto == 'smtps' else smtplib.SMTP)(host, port)
 
-        if proto != 'smtps' and app.config.get("SMTP_STARTTLS").lower() == "true":
-            # Enforce TLS.
-            smtp.starttls()
+# Names of all mail templates that EUS uses
+MAIL_TEMPLATE_NAMES = ["invitation", "invitation-sent", "invitation-accepted", "activation-successful", "reset-password"]
 
-    except Exception as e:
-        raise Exception('[EMAIL] Could not connect to mail server at {}://{}:{}: {}'.format(proto, host, port, e))
 
-    try:
-        if app.config.get("SMTP_AUTH").lower() == "true":
-            smtp.login(app.config.get("SMTP_USERNAME"),
-                       app.config.get("SMTP_PASSWORD"))
+_mail_template_cache_lock = threading.Lock()
 
-    except Exception:
-        raise Exception('[EMAIL] Could not login to mail server with configured credentials')
 
-    mp_msg.attach(MIMEText(plain_body, 'plain'))
-    mp_msg.attach(MIMEText(html_body, 'html'))
+def get_mail_template_cache(app):
+    """Returns the mail template cache of an application, creating it if needed.
 
-    try:
-        smtp.sendmail(app.config.get("SMTP_FROM_EMAIL"), [to], mp_msg.as_string())
+    :param app: Flask application, used for retrieving configuration
 
-    except Exception as e:
-        raise Exception('[EMAIL] Could not send mail: {}'.format(e))
+    :returns: mail template cache
+    """
+    with _mail_template_cache_lock:
+        if "yoda_eus_mail_templates" not in app.extensions:
+            app.extensions["yoda_eus_mail_templates"] = MailTemplateCache(
+                check_interval=float(app.config.get("MAIL_TEMPLATE_CHECK_INTERVAL", 10)))
+        return app.extensions["yoda_eus_mail_templates"]
 
-    try:
-        smtp.quit()
-    except Exception:
-        pass
+
+def warm_mail_template_cache(app):
+    """Compiles all mail templates of the configured template set, so that the first
+    emails do not have to wait for it.
+
+    :param app: Flask application, used for logging and retrieving configuration
+    """
+    cache = get_mail_template_cache(app)
+    for template_name in MAIL_TEMPLATE_NAMES:
+        try:
+            cache.get(app.config.get("MAIL_TEMPLATE_DIR"), app.config.get("MAIL_TEMPLATE"), template_name)
+        except OSError as e:
+            app.logger.warning("Could not load mail template '{}': {}".format(template_name, e))
+
+
+class MailTemplateCache:
+    """Per-process cache of compiled mail templates.
+
+    Templates are keyed by template directory, template set (MAIL_TEMPLATE) and template name.
+    The modification times of the template files are checked at most once per check interval;
+    templates are recompiled if any of their files have changed.
+    """
+
+    def __init__(self, check_interval=10.0):
+        """
+        :param check_interval: Minimum number of seconds between checks for changed template files
+        """
+        self.check_interval = check_interval
+        self._environment = Environment(loader=BaseLoader())
+        self._lock = threading.Lock()
+        # Compiled templates, as [plain text template, HTML template, file mtimes, last check time] lists.
+        self._templates = {}
+
+    def _get_files(self, template_dir, template_set, template_name):
+        """
+        :param template_dir:  Mail template directory
+        :param template_set:  Name of the template set in the template directory
+        :param template_name: Name of the template, excluding extensions
+
+        :returns: paths of the plain text, HTML, HTML header and HTML footer template files
+        """
+        template_path = os.path.join(template_dir, template_set)
+        return [os.path.join(template_path, template_name + ".txt.j2"),
+                os.path.join(template_path, template_name + ".html.j2"),
+                os.path.join(template_path, "common-start.html.j2"),
+                os.path.join(template_path, "common-end.html.j2")]
+
+    def get(self, template_dir, template_set, template_name):
+        """Returns compiled templates, compiling them if they are not cached or have changed.
+
+        :param template_dir:  Mail template directory
+        :param template_set:  Name of the template set in the template directory
+        :param template_name: Name of the template, excluding extensions
+
+        :returns: tuple of compiled plain text and HTML templates
+        """
+        key = (template_dir, template_set, template_name)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._templates.get(key)
+            if entry is not None and now - entry[3] < self.check_interval:
+                return entry[0], entry[1]
+
+        files = self._get_files(template_dir, template_set, template_name)
+        mtimes = [os.stat(filename).st_mtime_ns for filename in files]
+        if entry is None or entry[2] != mtimes:
+            text_template, html_main_template, html_header_template, html_footer_template = \
+                [Path(filename).read_text() for filename in files]
+            html_full_template = html_header_template + html_main_template + html_footer_template
+            entry = [self._environment.from_string(text_template),
+                     self._environment.from_string(html_full_template),
+                     mtimes,
+                     now]
+        else:
+            entry[3] = now
+
+        with self._lock:
+            self._templates[key] = entry
+        return entry[0], entry[1]
+
+
+_smtp_pool_lock = threading.Lock()
+
+
+def get_smtp_pool(app):
+    """Returns the SMTP connection pool of an application, creating it if needed.
+
+    :param app: Flask application, used for retrieving configuration
+
+    :returns: SMTP connection pool
+    """
+    with _smtp_pool_lock:
+        if "yoda_eus_smtp_pool" not in app.extensions:
+            app.extensions["yoda_eus_smtp_pool"] = SMTPConnectionPool(
+                app.config.get("SMTP_SERVER"),
+                starttls=app.config.get("SMTP_STARTTLS").lower() == "true",
+                username=app.config.get("SMTP_USERNAME") if app.config.get("SMTP_AUTH").lower() == "true" else None,
+                password=app.config.get("SMTP_PASSWORD"),
+                max_connections=int(app.config.get("SMTP_POOL_SIZE", 2)),
+                max_messages=int(app.config.get("SMTP_POOL_MAX_MESSAGES", 100)),
+                max_idle=float(app.config.get("SMTP_POOL_MAX_IDLE", 60)),
+                timeout=float(app.config.get("SMTP_TIMEOUT", 30)))
+        return app.extensions["yoda_eus_smtp_pool"]
+
+
+class SMTPConnectionPool:
+    """Thread-safe pool of authenticated SMTP connections.
+
+    Connections are kept open between messages, so that the TLS and AUTH handshakes only happen
+    once per connection. Idle connections are checked with NOOP before reuse. Connections are
+    closed after a maximum number of messages or idle time, and replaced transparently if the
+    server has dropped them.
+    """
+
+    def __init__(self, server, starttls=False, username=None, password=None,
+                 max_connections=2, max_messages=100, max_idle=60.0, timeout=30.0):
+        """
+        :param server:          Mail server URL, e.g. 'smtps://smtp.gmail.com:465' for SMTP over TLS,
+                                or 'smtp://smtp.gmail.com:587' for STARTTLS on the mail submission port
+        :param starttls:        Whether to enforce STARTTLS (only for smtp:// servers)
+        :param username:        Username for SMTP authentication, or None if no authentication is needed
+        :param password:        Password for SMTP authentication
+        :param max_connections: Maximum number of simultaneous connections
+        :param max_messages:    Maximum number of messages to send over a single connection
+        :param max_idle:        Maximum number of seconds that a connection can be idle before it is closed
+        :param timeout:         Number of seconds to wait for the mail server on each socket operation, and
+                                for a free connection slot
+        """
+        self.proto, self.host, port = re.search(r'^(smtps?)://([^:]+)(?::(\d+))?$', server).groups()
+
+        # Default to port 465 for SMTP over TLS, and 587 for standard mail
+        # submission with STARTTLS.
+        self.port = int(port or (465 if self.proto == 'smtps' else 587))
+
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        # Idle connections, as [smtp, number of messages sent, last use time] lists.
+        self._idle = []
+
+    def _set_timeout(self, smtp, timeout):
+        """Changes the timeout of socket operations on a connection.
+
+        :param smtp:    SMTP connection
+        :param timeout: Number of seconds to wait for the mail server on each socket operation
+        """
+        smtp.timeout = timeout
+        if getattr(smtp, "sock", None) is not None:
+            smtp.sock.settimeout(timeout)
+
+    def _connect(self, timeout=None):
+        """Opens a new authenticated connection to the mail server.
+
+        :param timeout: Number of seconds to wait for the mail server on each socket operation while
+                        connecting, instead of the timeout of the pool
+
+        :returns: SMTP connection
+
+        :raises Exception: For errors during connecting or logging in
+        """
+        with SMTP_DURATION.labels("connect").time():
+            try:
+                smtp = (smtplib.SMTP_SSL if self.proto == 'smtps' else smtplib.SMTP)(
+                    self.host, self.port, timeout=self.timeout if timeout is None else timeout)
+
+                if self.proto != 'smtps' and self.starttls:
+                    # Enforce TLS.
+                    smtp.starttls()
+
+            except Exception as e:
+                raise Exception('[EMAIL] Could not connect to mail server at {}://{}:{}: {}'.format(
+                    self.proto, self.host, self.port, e))
+
+            try:
+                if self.username is not None:
+                    smtp.login(self.username, self.password)
+
+            except Exception:
+                self._close(smtp)
+                raise Exception('[EMAIL] Could not login to mail server with configured credentials')
+
+        if timeout is not None:
+            self._set_timeout(smtp, self.timeout)
+        return [smtp, 0, time.monotonic()]
+
+    def _close(self, smtp):
+        """Closes a connection, ignoring errors.
+
+        :param smtp: SMTP connection
+        """
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _is_alive(self, connection, timeout=None):
+        """Checks whether an idle connection can be reused.
+
+        :param connection: Idle connection
+        :param timeout:    Number of seconds to wait for the reply to NOOP, instead of the timeout of the pool
+
+        :returns: boolean value that indicates whether the connection can be reused
+        """
+        if time.monotonic() - connection[2] > self.max_idle:
+            return False
+        try:
+            if timeout is not None:
+                self._set_timeout(connection[0], timeout)
+            alive = connection[0].noop()[0] == 250
+            if timeout is not None:
+                self._set_timeout(connection[0], self.timeout)
+            return alive
+        except Exception:
+            return False
+
+    def _acquire(self, timeout=None):
+        """Takes a live idle connection from the pool, or opens a new one.
+
+        :param timeout: Number of seconds to wait for the mail server on each socket operation while
+                        checking or opening the connection, instead of the timeout of the pool
+
+        :returns: connection
+        """
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if len(self._idle) > 0 else None
+            if connection is None:
+                return self._connect(timeout)
+            if self._is_alive(connection, timeout):
+                return connection
+            self._close(connection[0])
+
+    def _release(self, connection):
+        """Returns a connection to the pool, or closes it if it has sent the maximum number of messages.
+
+        :param connection: connection
+        """
+        if connection[1] >= self.max_messages:
+            self._close(connection[0])
+            return
+        connection[2] = time.monotonic()
+        with self._lock:
+            self._idle.append(connection)
+
+    def sendmail(self, from_addr, to_addrs, message):
+        """Sends a message over a pooled connection.
+
+        If the server turns out to have dropped the connection, the message is sent again
+        over a new connection.
+
+        :param from_addr: Envelope sender address
+        :param to_addrs:  List of envelope recipient addresses
+        :param message:   Message to send, as a string
+
+        :raises Exception: For errors during sending the email, or if no connection slot became available
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise Exception('[EMAIL] Could not send mail: all connections to the mail server are busy')
+        try:
+            connection = self._acquire()
+            try:
+                try:
+                    with SMTP_DURATION.labels("send").time():
+                        connection[0].sendmail(from_addr, to_addrs, message)
+                except smtplib.SMTPServerDisconnected:
+                    self._close(connection[0])
+                    connection = self._connect()
+                    with SMTP_DURATION.labels("send").time():
+                        connection[0].sendmail(from_addr, to_addrs, message)
+            except Exception as e:
+                self._close(connection[0])
+                raise Exception('[EMAIL] Could not send mail: {}'.format(e))
+
+            connection[1] += 1
+            self._release(connection)
+        finally:
+            self._slots.release()
+
+    def check(self, timeout=None):
+        """Checks whether the mail server is reachable and accepts the configured credentials.
+
+        An idle connection is checked with NOOP; otherwise a new connection is opened and kept
+        in the pool for sending mail.
+
+        :param timeout: Number of seconds to wait for the mail server on each socket operation of the
+                        check, instead of the timeout of the pool (e.g. a shorter timeout for health checks)
+
+        :returns: boolean value that indicates whether the mail server is reachable
+        """
+        if not self._slots.acquire(blocking=False):
+            # All connections are in use for sending mail
+            return True
+        try:
+            connection = self._acquire(timeout)
+            self._release(connection)
+            return True
+        except Exception:
+            return False
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._close(connection[0])
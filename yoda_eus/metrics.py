@@ -0,0 +1,103 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import os
+import time
+from typing import Any, Tuple
+
+from flask import Flask, g, has_request_context, request, Response
+from prometheus_client import CollectorRegistry, CONTENT_TYPE_LATEST, Counter, generate_latest, Histogram, REGISTRY
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUEST_DURATION = Histogram("eus_request_duration_seconds",
+                             "Duration of HTTP requests",
+                             ["endpoint", "method", "status"])
+
+REQUEST_DB_QUERIES = Histogram("eus_request_db_queries",
+                               "Number of database queries per HTTP request",
+                               ["endpoint"],
+                               buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100, float("inf")))
+
+REQUEST_DB_DURATION = Histogram("eus_request_db_duration_seconds",
+                                "Total duration of database queries per HTTP request",
+                                ["endpoint"])
+
+BCRYPT_DURATION = Histogram("eus_bcrypt_duration_seconds",
+                            "Duration of bcrypt computations",
+                            ["operation"],
+                            buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0, float("inf")))
+
+SMTP_DURATION = Histogram("eus_smtp_duration_seconds",
+                          "Duration of SMTP operations",
+                          ["operation"])
+
+AUTH_CHECKS = Counter("eus_auth_checks_total",
+                      "Number of authentication checks of external users",
+                      ["outcome"])
+
+THROTTLE_HITS = Counter("eus_throttle_hits_total",
+                        "Number of requests rejected by a throttle",
+                        ["endpoint", "key_type"])
+
+
+def before_cursor_execute(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool) -> None:
+    """Records the start time of a database query."""  # noqa DAR101
+    if context is not None:
+        context.eus_query_start_time = time.perf_counter()
+
+
+def after_cursor_execute(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool) -> None:
+    """Adds the duration of a database query to the statistics of the current request."""  # noqa DAR101
+    start_time = getattr(context, "eus_query_start_time", None)
+    if start_time is None or not has_request_context():
+        return
+    g.db_queries = g.get("db_queries", 0) + 1
+    g.db_duration = g.get("db_duration", 0.0) + time.perf_counter() - start_time
+
+
+def init_metrics(app: Flask) -> None:
+    """Collects request and database query metrics of an application.
+
+    :param app: Flask application
+    """
+    # Database queries are counted for all engines, so that this also covers engines that
+    # are created lazily.
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    @app.before_request
+    def start_request_timer() -> None:
+        g.request_start_time = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response: Response) -> Response:
+        """Records duration and database queries of a request."""  # noqa DAR101 DAR201
+        start_time = g.get("request_start_time")
+        if start_time is not None:
+            endpoint = request.endpoint or "none"
+            REQUEST_DURATION.labels(endpoint, request.method, str(response.status_code)) \
+                .observe(time.perf_counter() - start_time)
+            REQUEST_DB_QUERIES.labels(endpoint).observe(g.get("db_queries", 0))
+            REQUEST_DB_DURATION.labels(endpoint).observe(g.get("db_duration", 0.0))
+        return response
+
+
+def generate_metrics() -> Tuple[bytes, str]:
+    """Generates the metrics exposition in Prometheus text format.
+
+    If the EUS runs in multiple WSGI worker processes, the PROMETHEUS_MULTIPROC_DIR environment
+    variable should point to an empty directory that is writable by all workers before they start.
+    Each worker then writes its samples to that directory, and the metrics of all workers are
+    aggregated here, regardless of which worker handles the request.
+
+    :returns: tuple of metrics and their content type
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
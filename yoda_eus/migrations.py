@@ -0,0 +1,134 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import func, insert, inspect, LargeBinary, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import SQLAlchemyError
+from yoda_eus.models import db, MailOutbox, SchemaVersion, ThrottleBucket, User
+from yoda_eus.util import get_hash_digest
+
+# Version of databases that were created before schema versioning was introduced, either with
+# aux/db.sql or by create_all().
+BASELINE_VERSION = 1
+
+
+def align_legacy_schema(connection: Connection) -> None:
+    """Aligns databases created with aux/db.sql with the ORM models.
+
+    :param connection: Database connection, in a transaction
+    """
+    MailOutbox.__table__.create(connection, checkfirst=True)
+    connection.execute(text('CREATE INDEX IF NOT EXISTS "ix_user_zones_inviter_zone" ON "user_zones" ("inviter_zone")'))
+    if connection.dialect.name == "postgresql":
+        connection.execute(text('ALTER TABLE "users" ALTER COLUMN "password" TYPE varchar(60), '
+                                'ALTER COLUMN "hash" TYPE varchar(64)'))
+
+
+def index_hash_time(connection: Connection) -> None:
+    """Adds an index for finding expired secret hashes.
+
+    :param connection: Database connection, in a transaction
+    """
+    connection.execute(text('CREATE INDEX IF NOT EXISTS "ix_users_hash_time" ON "users" ("hash_time")'))
+
+
+def store_hash_digests(connection: Connection) -> None:
+    """Replaces plaintext secret hashes with their SHA-256 digests, indexed with a partial unique index.
+
+    :param connection: Database connection, in a transaction
+    """
+    column_type = LargeBinary(32).compile(dialect=connection.dialect)
+    connection.execute(text('ALTER TABLE "users" ADD COLUMN "hash_digest" {}'.format(column_type)))
+    rows = connection.execute(text('SELECT "id", "hash" FROM "users" WHERE "hash" IS NOT NULL')).all()
+    if len(rows) > 0:
+        connection.execute(text('UPDATE "users" SET "hash_digest" = :digest WHERE "id" = :id'),
+                           [{"id": row.id, "digest": get_hash_digest(row.hash.strip())} for row in rows])
+    next(index for index in User.__table__.indexes if index.name == "ix_users_hash_digest").create(connection)
+    if connection.dialect.name == "postgresql":
+        connection.execute(text('ALTER TABLE "users" DROP COLUMN "hash"'))
+    else:
+        # SQLite cannot drop columns with a unique constraint
+        connection.execute(text('UPDATE "users" SET "hash" = NULL'))
+
+
+def add_throttle_buckets(connection: Connection) -> None:
+    """Adds the table for request throttle state that is shared between worker processes.
+
+    :param connection: Database connection, in a transaction
+    """
+    ThrottleBucket.__table__.create(connection, checkfirst=True)
+
+
+# Migrations, as (version, description, function) tuples in order of version. Each migration
+# runs in the same transaction as the update of the schema version.
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (2, "Add mail outbox, index zones and use varchar columns for hashes", align_legacy_schema),
+    (3, "Index creation time of secret hashes", index_hash_time),
+    (4, "Store digests of secret hashes", store_hash_digests),
+    (5, "Add request throttle buckets", add_throttle_buckets),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0] if len(MIGRATIONS) > 0 else BASELINE_VERSION
+
+
+def get_schema_version(engine: Engine) -> Optional[int]:
+    """Determines the schema version of a database with a single query.
+
+    :param engine: Database engine
+
+    :returns: schema version, or None if the database has no schema version table
+    """
+    try:
+        with engine.connect() as connection:
+            return connection.execute(select(func.max(SchemaVersion.version))).scalar()
+    except SQLAlchemyError:
+        return None
+
+
+def record_schema_version(connection: Connection, version: int, description: str) -> None:
+    """
+    :param connection:  Database connection, in a transaction
+    :param version:     Schema version
+    :param description: Description of the migration to this version
+    """
+    connection.execute(insert(SchemaVersion.__table__).values(version=version,
+                                                              description=description,
+                                                              applied_time=datetime.now()))
+
+
+def migrate(engine: Engine) -> Tuple[Optional[int], int]:
+    """Migrates a database to the latest schema version.
+
+    Empty databases get the complete schema at once. Databases without a schema version table
+    are assumed to be at the baseline version, and get all later migrations.
+
+    :param engine: Database engine
+
+    :returns: tuple of schema version before and after migration (None if the database was empty)
+    """
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # Serialize concurrent migration runs
+            connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('yoda_eus_schema_version'))"))
+
+        inspector = inspect(connection)
+        if inspector.has_table(SchemaVersion.__tablename__):
+            old_version = connection.execute(select(func.max(SchemaVersion.version))).scalar() or BASELINE_VERSION
+        elif inspector.has_table("users"):
+            SchemaVersion.__table__.create(connection)
+            record_schema_version(connection, BASELINE_VERSION, "Baseline schema")
+            old_version = BASELINE_VERSION
+        else:
+            db.metadata.create_all(connection)
+            record_schema_version(connection, LATEST_VERSION, "Initial schema")
+            return None, LATEST_VERSION
+
+        for version, description, migration in MIGRATIONS:
+            if version > old_version:
+                migration(connection)
+                record_schema_version(connection, version, description)
+
+    return old_version, max(old_version, LATEST_VERSION)
@@ -0,0 +1,93 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+from flask_sqlalchemy import SQLAlchemy
+
+
+db = SQLAlchemy()
+
+
+class User(db.Model):  # type: ignore
+    """
+    This class provides the ORM model for the users table, which stores data about external users.
+    Their username is their email address. The hash columns refer to the secret hash value that is
+    used for authenticating account activation and password resets. Only the SHA-256 digest of the
+    secret is stored. The creator columns refer to the Yoda user who invited this external user.
+    """
+
+    __tablename__ = "users"
+    __table_args__ = (db.Index("ix_users_hash_digest", "hash_digest", unique=True,
+                               postgresql_where=db.text("hash_digest IS NOT NULL"),
+                               sqlite_where=db.text("hash_digest IS NOT NULL")),)
+    id = db.Column(db.Integer, db.Sequence("users_id_seq"), primary_key=True)
+    username = db.Column(db.String(64), nullable=False, unique=True, index=True)
+    password = db.Column(db.String(60))
+    hash_digest = db.Column(db.LargeBinary(32))
+    hash_time = db.Column(db.TIMESTAMP, index=True)
+    creator_time = db.Column(db.TIMESTAMP, nullable=False)
+    creator_user = db.Column(db.String(255), nullable=False)
+    creator_zone = db.Column(db.String(255), nullable=False)
+    user_zones = db.relationship("UserZone", back_populates="user")
+
+
+class UserZone(db.Model):  # type: ignore
+    """
+    This class provides the ORM model for the user_zones table, which stores data about invitations.
+    It is possible that external users have been invited by more than one Yoda user. For example, this can
+    happen if an EUS instance is shared by multiple Yoda instances. EUS keeps tracks of invitations in order
+    to determine when an account can be removed completely.
+    """
+    __tablename__ = "user_zones"
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    inviter_user = db.Column(db.String(255), nullable=False)
+    inviter_zone = db.Column(db.String(255), nullable=False, primary_key=True, index=True)
+    inviter_time = db.Column(db.TIMESTAMP, nullable=False)
+    user = db.relationship("User", back_populates="user_zones")
+
+
+class MailOutbox(db.Model):  # type: ignore
+    """
+    This class provides the ORM model for the mail_outbox table, which stores outgoing emails. Emails are
+    added to the outbox in the same transaction as the account changes that they report on, and are
+    delivered asynchronously by the mail dispatcher. Messages that could not be delivered after the
+    maximum number of attempts are kept with status "dead" for inspection. The template data of
+    messages that are no longer pending is cleared, as it can contain activation and reset links.
+    """
+    __tablename__ = "mail_outbox"
+    __table_args__ = (db.Index("ix_mail_outbox_status_next_attempt_time", "status", "next_attempt_time"),)
+    id = db.Column(db.Integer, db.Sequence("mail_outbox_id_seq"), primary_key=True)
+    recipient = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    template_name = db.Column(db.String(64), nullable=False)
+    template_data = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_time = db.Column(db.TIMESTAMP, nullable=False)
+    last_error = db.Column(db.Text)
+    created_time = db.Column(db.TIMESTAMP, nullable=False)
+    sent_time = db.Column(db.TIMESTAMP)
+
+
+class SchemaVersion(db.Model):  # type: ignore
+    """
+    This class provides the ORM model for the schema_version table, which records the database migrations
+    that have been applied. The current schema version is the highest version in the table.
+    """
+    __tablename__ = "schema_version"
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255), nullable=False)
+    applied_time = db.Column(db.TIMESTAMP, nullable=False)
+
+
+class ThrottleBucket(db.Model):  # type: ignore
+    """
+    This class provides the ORM model for the throttle_buckets table, which stores the token buckets
+    of the request throttle if its state is shared between worker processes through the database.
+    Times are in seconds since the epoch. Buckets that have been refilled completely are equivalent to
+    missing buckets, and can be removed.
+    """
+    __tablename__ = "throttle_buckets"
+    key = db.Column(db.String(255), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_time = db.Column(db.Float, nullable=False)
+    full_time = db.Column(db.Float, nullable=False, index=True)
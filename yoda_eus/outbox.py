@@ -0,0 +1,172 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import json
+import time
+from datetime import datetime, timedelta
+
+from yoda_eus.mail import is_email_delivery_needed, send_email_template
+from yoda_eus.models import db, MailOutbox
+
+# Template data of messages that are no longer pending
+CLEARED_TEMPLATE_DATA = "{}"
+
+# Default number of seconds that sent and dead messages are kept in the outbox
+DEFAULT_OUTBOX_RETENTION = 7 * 24 * 3600
+
+# Minimum number of seconds between purges of old messages by the mail dispatcher
+OUTBOX_PURGE_INTERVAL = 3600
+
+
+def is_outbox_enabled(app):
+    """Determines whether outgoing mail is queued in the outbox rather than sent directly.
+
+    :param app: Flask application, used for retrieving configuration
+
+    :returns: boolean value that indicates whether the outbox is enabled
+    """
+    return app.config.get("MAIL_OUTBOX_ENABLED", "false").lower() != "false"
+
+
+def deliver_email_template_if_needed(app, to, subject, template_name, template_data):
+    """Deliver an e-mail with specified recipient, subject and body using templates if
+       application is configured to deliver it.
+
+    If the outbox is enabled, the e-mail is added to the outbox in the current database
+    session, so that it is only queued if the caller commits its transaction. The mail
+    dispatcher delivers it later on. Otherwise the e-mail is sent immediately.
+
+    :param app:                Flask application, used for logging and retrieving configuration
+    :param to:                 Recipient of the mail
+    :param subject:            Subject of mail
+    :param template_name:      Name of the template in the template directory to use, excluding extensions
+    :param template_data:      Variables to interpolate, as a dictionary
+    """
+    if not is_email_delivery_needed(app, to, subject):
+        return
+
+    if is_outbox_enabled(app):
+        now = datetime.now()
+        db.session.add(MailOutbox(recipient=to,
+                                  subject=subject,
+                                  template_name=template_name,
+                                  template_data=json.dumps(template_data),
+                                  status="pending",
+                                  attempts=0,
+                                  next_attempt_time=now,
+                                  created_time=now))
+    else:
+        send_email_template(app, to, subject, template_name, template_data)
+
+
+def get_retry_delay(app, attempts):
+    """Computes the delay before the next delivery attempt, using exponential backoff.
+
+    :param app:      Flask application, used for retrieving configuration
+    :param attempts: Number of failed delivery attempts so far
+
+    :returns: delay before the next attempt
+    """
+    base_delay = int(app.config.get("MAIL_OUTBOX_RETRY_DELAY", 60))
+    max_delay = int(app.config.get("MAIL_OUTBOX_MAX_RETRY_DELAY", 3600))
+    return timedelta(seconds=min(max_delay, base_delay * 2 ** (attempts - 1)))
+
+
+def dispatch_outbox_batch(app, batch_size):
+    """Deliver a batch of due e-mails from the outbox.
+
+    Messages are locked while the batch is processed, so that multiple dispatchers can run
+    in parallel on PostgreSQL. Failed messages are retried with exponential backoff, until
+    the maximum number of attempts has been reached. They are then marked as "dead".
+
+    The template data of messages that have been sent or marked as "dead" is cleared, because it
+    can contain activation and password reset links.
+
+    :param app:        Flask application, used for logging and retrieving configuration
+    :param batch_size: Maximum number of messages to deliver
+
+    :returns: number of messages that have been processed
+    """
+    max_attempts = int(app.config.get("MAIL_OUTBOX_MAX_ATTEMPTS", 8))
+    now = datetime.now()
+    messages = (MailOutbox.query
+                .filter(MailOutbox.status == "pending", MailOutbox.next_attempt_time <= now)
+                .order_by(MailOutbox.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+                .all())
+
+    for message in messages:
+        try:
+            send_email_template(app,
+                                message.recipient,
+                                message.subject,
+                                message.template_name,
+                                json.loads(message.template_data))
+            message.status = "sent"
+            message.sent_time = datetime.now()
+            message.template_data = CLEARED_TEMPLATE_DATA
+        except Exception as e:
+            message.attempts += 1
+            message.last_error = str(e)
+            if message.attempts >= max_attempts:
+                message.status = "dead"
+                message.template_data = CLEARED_TEMPLATE_DATA
+                app.logger.error("Giving up on mail {} to <{}> after {} attempts: {}".format(
+                    message.id, message.recipient, message.attempts, e))
+            else:
+                message.next_attempt_time = datetime.now() + get_retry_delay(app, message.attempts)
+                app.logger.warning("Could not deliver mail {} to <{}> (attempt {}): {}".format(
+                    message.id, message.recipient, message.attempts, e))
+
+    db.session.commit()
+    return len(messages)
+
+
+def purge_outbox_batch(app, batch_size):
+    """Delete a batch of messages that have been sent or marked as "dead", and that were queued
+    longer ago than the retention period, in its own transaction.
+
+    :param app:        Flask application, used for retrieving configuration
+    :param batch_size: Maximum number of messages to delete
+
+    :returns: number of deleted messages
+    """
+    retention = int(app.config.get("MAIL_OUTBOX_RETENTION", DEFAULT_OUTBOX_RETENTION))
+    if retention <= 0:
+        return 0
+    cutoff = datetime.now() - timedelta(seconds=retention)
+    message_ids = [message_id for (message_id,) in
+                   (db.session.query(MailOutbox.id)
+                    .filter(MailOutbox.status.in_(["sent", "dead"]), MailOutbox.created_time < cutoff)
+                    .limit(batch_size)
+                    .all())]
+    if len(message_ids) > 0:
+        MailOutbox.query.filter(MailOutbox.id.in_(message_ids)).delete(synchronize_session=False)
+    db.session.commit()
+    return len(message_ids)
+
+
+def run_outbox_dispatcher(app, batch_size, poll_interval, once=False):
+    """Deliver e-mails from the outbox until interrupted. Whenever the outbox has no due
+    messages, old sent and dead messages are deleted, at most once per purge interval.
+
+    :param app:           Flask application, used for logging and retrieving configuration
+    :param batch_size:    Maximum number of messages to deliver per batch
+    :param poll_interval: Number of seconds to wait when the outbox has no due messages
+    :param once:          Only deliver the messages that are currently due, then return
+    """
+    last_purge = None
+    while True:
+        with app.app_context():
+            processed = dispatch_outbox_batch(app, batch_size)
+        if processed == batch_size:
+            continue
+        if last_purge is None or time.monotonic() - last_purge >= OUTBOX_PURGE_INTERVAL:
+            with app.app_context():
+                while purge_outbox_batch(app, batch_size) == batch_size:
+                    pass
+            last_purge = time.monotonic()
+        if once:
+            return
+        time.sleep(poll_interval)
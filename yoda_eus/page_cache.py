@@ -0,0 +1,99 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from flask import current_app, render_template
+
+
+class PageCache:
+    """Per-process cache of fully rendered pages that do not depend on request data.
+
+    Pages are keyed by template name and by the generation of the static asset index, because
+    rendered pages contain fingerprinted asset URLs. The modification times of the files in the
+    template directories (theme and default templates) are checked at most once per check interval.
+    If any of them has changed, all cached pages are dropped, along with the compiled templates of
+    the Jinja environment, so that the new theme templates are loaded.
+
+    Only the response body is cached, so that security headers are still added per response.
+    """
+
+    def __init__(self, template_dirs: List[str], check_interval: float = 10.0) -> None:
+        """
+        :param template_dirs:  Template directories that the theme loader loads templates from
+        :param check_interval: Minimum number of seconds between checks for changed template files
+        """
+        self.template_dirs = template_dirs
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pages: Dict[Tuple[str, int], str] = {}
+        self._mtimes = self._get_mtimes()
+        self._last_check = time.monotonic()
+
+    def _get_mtimes(self) -> Dict[str, int]:
+        """
+        :returns: dictionary that maps paths of all files in the template directories to their modification times
+        """
+        mtimes = {}
+        for template_dir in self.template_dirs:
+            for dirpath, dirnames, filenames in os.walk(template_dir):
+                for filename in filenames:
+                    filepath = os.path.join(dirpath, filename)
+                    try:
+                        mtimes[filepath] = os.stat(filepath).st_mtime_ns
+                    except OSError:
+                        continue
+        return mtimes
+
+    def refresh_if_needed(self) -> None:
+        """Drops all cached pages if template files have changed since the last check."""
+        if time.monotonic() - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._last_check < self.check_interval:
+                return
+            mtimes = self._get_mtimes()
+            if mtimes != self._mtimes:
+                self._pages.clear()
+                if current_app.jinja_env.cache is not None:
+                    current_app.jinja_env.cache.clear()
+                self._mtimes = mtimes
+            self._last_check = time.monotonic()
+
+    def render(self, template_name: str, generation: int = 0) -> str:
+        """Returns a rendered page, rendering it if it is not cached.
+
+        Must be called within an application context.
+
+        :param template_name: Name of the template to render
+        :param generation:    Generation of the static asset index
+
+        :returns: rendered page
+        """
+        self.refresh_if_needed()
+        key = (template_name, generation)
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self.hits += 1
+                return page
+            self.misses += 1
+
+        page = render_template(template_name)
+        with self._lock:
+            self._pages[key] = page
+        return page
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :returns: dictionary with size and hit / miss counters of the cache
+        """
+        with self._lock:
+            return {"size": len(self._pages),
+                    "hits": self.hits,
+                    "misses": self.misses}
@@ -0,0 +1,76 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class Flight:
+    """Call that is in progress, along with its outcome once it has finished."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key within a process.
+
+    The first caller for a key runs the function. Callers that arrive with the same key while it
+    is running wait for it to finish, and get the same result (or exception) instead of running the
+    function again. Results are not kept once the call has finished.
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.coalesced = 0
+        self._flights: Dict[Hashable, Flight] = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        """Runs a function, or waits for a concurrent call of a function with the same key.
+
+        :param key:      Key that identifies equivalent calls
+        :param function: Function to run
+
+        :returns: result of the function
+
+        :raises BaseException: If the function raised an exception
+        """  # noqa DAR401
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                flight = Flight()
+                self._flights[key] = flight
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :returns: dictionary with number of calls that ran, calls that were coalesced and calls in progress
+        """
+        with self._lock:
+            return {"calls": self.calls,
+                    "coalesced": self.coalesced,
+                    "in_flight": len(self._flights)}
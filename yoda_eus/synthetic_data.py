@@ -0,0 +1,178 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import csv
+import io
+import random
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import bcrypt
+from sqlalchemy import func, insert, select, Table, text
+from sqlalchemy.engine import Connection, Engine
+from yoda_eus.models import User, UserZone
+
+# Shape of the generated data set. Ages are in days.
+ACCOUNT_AGE_MAX = 5 * 365
+ACTIVATED_FRACTION = 0.85
+PENDING_RESET_FRACTION = 0.02
+ACTIVATION_HASH_AGE_MEAN = 10.0
+RESET_HASH_AGE_MEAN = 1.0
+EXTRA_REGISTRATION_PROBABILITY = 0.3
+
+# Password of all generated users. Its hash is computed once, as hashing millions of passwords
+# would take days.
+PASSWORD = "Generated-Password-123!"
+
+
+def get_zone_weights(zones: int) -> List[float]:
+    """Determines the relative number of registrations per zone, following Zipf's law, so that
+    a few zones have most users and there is a long tail of small zones.
+
+    :param zones: Number of zones
+
+    :returns: list of cumulative weights, in order of zone number
+    """
+    weights = []
+    total = 0.0
+    for rank in range(1, zones + 1):
+        total += 1 / rank
+        weights.append(total)
+    return weights
+
+
+def generate_rows(rng: random.Random,
+                  first_id: int,
+                  count: int,
+                  zones: int,
+                  password_hash: str,
+                  now: datetime) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Generates a batch of users and their zone registrations.
+
+    Most users are activated. Unactivated users have an activation hash with an exponentially
+    distributed age, so that some of their activation links have expired. A small fraction of
+    activated users have a recent password reset hash. Users are registered in one zone, and
+    sometimes in a few more.
+
+    :param rng:           Random number generator
+    :param first_id:      ID of the first user in the batch
+    :param count:         Number of users in the batch
+    :param zones:         Number of zones
+    :param password_hash: bcrypt hash of the password of activated users
+    :param now:           Current time
+
+    :returns: tuple of user rows and user zone rows
+    """
+    zone_weights = get_zone_weights(zones)
+    users = []
+    user_zones = []
+    for user_id in range(first_id, first_id + count):
+        creator_time = now - timedelta(days=rng.uniform(0, ACCOUNT_AGE_MAX))
+        user_zone_numbers = rng.choices(range(zones), cum_weights=zone_weights)
+        while rng.random() < EXTRA_REGISTRATION_PROBABILITY and len(user_zone_numbers) < zones:
+            zone_number = rng.choices(range(zones), cum_weights=zone_weights)[0]
+            if zone_number not in user_zone_numbers:
+                user_zone_numbers.append(zone_number)
+
+        if rng.random() < ACTIVATED_FRACTION:
+            password: Optional[str] = password_hash
+            hash_age = rng.expovariate(1 / RESET_HASH_AGE_MEAN) if rng.random() < PENDING_RESET_FRACTION else None
+        else:
+            password = None
+            hash_age = rng.expovariate(1 / ACTIVATION_HASH_AGE_MEAN)
+            creator_time = now - timedelta(days=hash_age)
+
+        creator_zone = "zone{}".format(user_zone_numbers[0])
+        users.append({"id": user_id,
+                      "username": "generated{}@example.org".format(user_id),
+                      "password": password,
+                      "hash_digest": None if hash_age is None else rng.getrandbits(256).to_bytes(32, "big"),
+                      "hash_time": None if hash_age is None else now - timedelta(days=hash_age),
+                      "creator_time": creator_time,
+                      "creator_user": "creator@{}".format(creator_zone),
+                      "creator_zone": creator_zone})
+        for zone_number in user_zone_numbers:
+            zone = "zone{}".format(zone_number)
+            user_zones.append({"user_id": user_id,
+                               "inviter_user": "inviter@{}".format(zone),
+                               "inviter_zone": zone,
+                               "inviter_time": creator_time + timedelta(days=rng.uniform(0, (now - creator_time).days))})
+    return users, user_zones
+
+
+def copy_rows(connection: Connection, table: Table, rows: List[Dict[str, Any]]) -> None:
+    """Loads rows into a PostgreSQL table with COPY, which is much faster than INSERT statements.
+
+    :param connection: Database connection with the psycopg2 driver, in a transaction
+    :param table:      Table to load rows into
+    :param rows:       Rows to load
+    """
+    columns = [column.name for column in table.columns]
+
+    def format_value(value: Any) -> Any:
+        if isinstance(value, bytes):
+            return "\\x" + value.hex()
+        elif isinstance(value, datetime):
+            return value.isoformat()
+        return value
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([format_value(row[column]) for column in columns])
+    buffer.seek(0)
+
+    # Empty unquoted fields are NULL in CSV format. csv.writer writes None as an empty field.
+    cursor = connection.connection.cursor()
+    cursor.copy_expert('COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table.name, ", ".join('"{}"'.format(column) for column in columns)), buffer)
+    cursor.close()
+
+
+def generate_users(engine: Engine,
+                   count: int,
+                   zones: int,
+                   batch_size: int,
+                   bcrypt_rounds: int,
+                   seed: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+    """Adds synthetic users and zone registrations to the database for scale testing, in batches
+    with a transaction per batch. IDs of generated users follow the highest existing user ID.
+
+    :param engine:        Database engine
+    :param count:         Number of users to generate
+    :param zones:         Number of zones that users are registered in
+    :param batch_size:    Number of users per batch
+    :param bcrypt_rounds: bcrypt cost factor of the password hash of activated users
+    :param seed:          Seed of the random number generator, for reproducible data sets
+
+    :yields: number of generated users and zone registrations after each batch
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    password_hash = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(bcrypt_rounds)).decode("utf-8")
+    use_copy = engine.dialect.name == "postgresql" and engine.dialect.driver == "psycopg2"
+
+    with engine.connect() as connection:
+        next_id = (connection.execute(select(func.max(User.id))).scalar() or 0) + 1
+
+    generated_users = 0
+    generated_user_zones = 0
+    for batch_start in range(0, count, batch_size):
+        batch_count = min(batch_size, count - batch_start)
+        users, user_zones = generate_rows(rng, next_id, batch_count, zones, password_hash, now)
+        with engine.begin() as connection:
+            if use_copy:
+                copy_rows(connection, User.__table__, users)
+                copy_rows(connection, UserZone.__table__, user_zones)
+            else:
+                connection.execute(insert(User.__table__), users)
+                connection.execute(insert(UserZone.__table__), user_zones)
+        next_id += batch_count
+        generated_users += batch_count
+        generated_user_zones += len(user_zones)
+        yield generated_users, generated_user_zones
+
+    if engine.dialect.name == "postgresql" and generated_users > 0:
+        # Explicit IDs do not advance the sequence of the users table
+        with engine.begin() as connection:
+            connection.execute(text("SELECT setval('users_id_seq', :id)"), {"id": next_id - 1})
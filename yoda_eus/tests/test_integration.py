@@ -2,9 +2,21 @@ __copyright__ = 'Copyright (c) 2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import base64
-
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import bcrypt
 import pytest
-from yoda_eus.app import create_app
+from prometheus_client import REGISTRY
+from yoda_eus import benchmark
+from yoda_eus.app import create_app, db, get_password_hash, prepare_password_hash_query, User
+from yoda_eus.bcrypt_pool import BcryptPool, get_hash_rounds
+from yoda_eus.models import MailOutbox, UserZone
 
 
 class TestMain:
@@ -268,3 +280,740 @@ class TestMain:
             assert response4.status_code == 401
             response5 = c.post('/api/user/auth-check', headers=new_auth_headers)
             assert response5.status_code == 200
+
+    def test_auth_check_cache(self, test_client):
+        credentials = "activateduser:Test123456!!!"
+        credentials_base64 = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
+        api_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret',
+                        'Authorization': 'Basic ' + credentials_base64}
+
+        with test_client as c:
+            response1 = c.post('/api/user/auth-check', headers=auth_headers)
+            assert response1.status_code == 200
+            response2 = c.post('/api/user/auth-check', headers=auth_headers)
+            assert response2.status_code == 200
+            response3 = c.get('/api/stats', headers=api_headers)
+            assert response3.status_code == 200
+            assert response3.json["auth_cache"]["hits"] == 1
+            assert response3.json["auth_cache"]["misses"] == 1
+            assert response3.json["bcrypt_pool"]["completed"] == 1
+
+    def test_auth_check_rehash(self, app, test_client):
+        credentials = "activateduser:Test123456!!!"
+        credentials_base64 = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
+        api_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret',
+                        'Authorization': 'Basic ' + credentials_base64}
+        with app.app_context():
+            user = User.query.filter_by(username="activateduser").first()
+            user.password = bcrypt.hashpw(b"Test123456!!!", bcrypt.gensalt(5)).decode('utf-8')
+            db.session.commit()
+
+        with test_client as c:
+            response1 = c.post('/api/user/auth-check', headers=auth_headers)
+            assert response1.status_code == 200
+            for _ in range(100):
+                if c.get('/api/stats', headers=api_headers).json["bcrypt_pool"]["completed"] == 2:
+                    break
+                time.sleep(0.05)
+            response2 = c.post('/api/user/auth-check', headers=auth_headers)
+            assert response2.status_code == 200
+
+        with app.app_context():
+            user = User.query.filter_by(username="activateduser").first()
+            assert get_hash_rounds(user.password) == 4
+
+    def test_calibrate_bcrypt_command(self, app):
+        result = app.test_cli_runner().invoke(args=["calibrate-bcrypt", "--target-ms", "0"])
+        assert result.exit_code == 0
+        assert "BCRYPT_ROUNDS = 4" in result.output
+
+    def _add_user_with_outbox(self, app, test_client):
+        app.config["MAIL_ENABLED"] = "true"
+        app.config["MAIL_OUTBOX_ENABLED"] = "true"
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        add_params = {"username": "outboxuser@yoda.test", "creator_user": "technicaladmin@yoda.test",
+                      "creator_zone": "testZone"}
+        with test_client as c:
+            response = c.post('/api/user/add', json=add_params, headers=auth_headers)
+            assert response.status_code == 201
+
+    def test_outbox_queue_and_dispatch(self, app, test_client):
+        with patch("yoda_eus.outbox.send_email_template") as mock_send:
+            self._add_user_with_outbox(app, test_client)
+            mock_send.assert_not_called()
+            with app.app_context():
+                assert MailOutbox.query.filter_by(status="pending").count() == 2
+
+            result = app.test_cli_runner().invoke(args=["dispatch-mail", "--once"])
+            assert result.exit_code == 0
+            assert mock_send.call_count == 2
+            assert mock_send.call_args_list[0][0][1] == "outboxuser@yoda.test"
+            assert mock_send.call_args_list[0][0][3] == "invitation"
+            secret_hash = mock_send.call_args_list[0][0][4]["HASH_URL"].split("/")[-1]
+
+        with app.app_context():
+            assert MailOutbox.query.filter_by(status="sent").count() == 2
+            # Activation links are not kept after delivery
+            assert all(secret_hash not in message.template_data for message in MailOutbox.query.all())
+
+    def test_outbox_purge(self, app):
+        now = datetime.now()
+        old_time = now - timedelta(days=30)
+        with app.app_context():
+            for status, created_time in [("sent", old_time), ("dead", old_time), ("pending", old_time), ("sent", now)]:
+                db.session.add(MailOutbox(recipient="user@yoda.test", subject="Test", template_name="invitation",
+                                          template_data="{}", status=status, attempts=0,
+                                          next_attempt_time=now + timedelta(days=1), created_time=created_time))
+            db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["dispatch-mail", "--once", "--batch-size", "1"])
+        assert result.exit_code == 0
+
+        with app.app_context():
+            remaining = [(message.status, message.created_time) for message in MailOutbox.query.order_by(MailOutbox.id)]
+            assert remaining == [("pending", old_time), ("sent", now)]
+
+    def test_outbox_retry_and_dead_letter(self, app, test_client):
+        app.config["MAIL_OUTBOX_MAX_ATTEMPTS"] = 2
+        with patch("yoda_eus.outbox.send_email_template", side_effect=Exception("relay down")):
+            self._add_user_with_outbox(app, test_client)
+            app.test_cli_runner().invoke(args=["dispatch-mail", "--once"])
+            with app.app_context():
+                messages = MailOutbox.query.all()
+                assert all(m.status == "pending" and m.attempts == 1 for m in messages)
+                assert all(m.last_error == "relay down" for m in messages)
+                for message in messages:
+                    message.next_attempt_time = message.created_time
+                db.session.commit()
+
+            app.test_cli_runner().invoke(args=["dispatch-mail", "--once"])
+            with app.app_context():
+                assert MailOutbox.query.filter_by(status="dead").count() == 2
+                assert all("HASH_URL" not in message.template_data for message in MailOutbox.query.all())
+
+    def test_add_user_batch(self, app, test_client):
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        batch = [{"username": "batchuser1", "creator_user": "technicaladmin", "creator_zone": "testZone"},
+                 {"username": "batchuser2", "creator_user": "technicaladmin", "creator_zone": "testZone"},
+                 {"username": "batchuser1", "creator_user": "technicaladmin", "creator_zone": "otherZone"},
+                 {"username": "activateduser", "creator_user": "technicaladmin", "creator_zone": "otherZone"},
+                 {"username": "batchuser3", "creator_user": "technicaladmin"}]
+
+        with test_client as c:
+            response = c.post('/api/user/add-batch', json=batch, headers=auth_headers)
+            assert response.status_code == 200
+            results = response.json["results"]
+            assert [result["status"] for result in results] == ["ok", "ok", "ok", "ok", "error"]
+            assert results[0]["message"] == "User created."
+            assert results[3]["message"] == "User already exists."
+            assert results[4]["message"] == "Missing input field: creator_zone"
+
+        with app.app_context():
+            batchuser1 = User.query.filter_by(username="batchuser1").first()
+            assert len(batchuser1.hash_digest) == 32
+            assert UserZone.query.filter_by(user_id=batchuser1.id).count() == 2
+            activateduser = User.query.filter_by(username="activateduser").first()
+            assert UserZone.query.filter_by(user_id=activateduser.id, inviter_zone="otherZone").count() == 1
+            assert User.query.filter_by(username="batchuser3").first() is None
+
+    def test_add_user_batch_queues_mail(self, app, test_client):
+        app.config["MAIL_ENABLED"] = "true"
+        app.config["MAIL_OUTBOX_ENABLED"] = "true"
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        batch = [{"username": "batchuser{}@yoda.test".format(n), "creator_user": "technicaladmin@yoda.test",
+                  "creator_zone": "testZone"} for n in range(10)]
+
+        with test_client as c:
+            response = c.post('/api/user/add-batch', json=batch, headers=auth_headers)
+            assert response.status_code == 200
+
+        with app.app_context():
+            assert MailOutbox.query.filter_by(template_name="invitation").count() == 10
+            assert MailOutbox.query.filter_by(template_name="invitation-sent").count() == 10
+
+    def test_add_user_batch_sends_mail_after_commit(self, app, test_client):
+        app.config["MAIL_ENABLED"] = "true"
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        batch = [{"username": "batchuser{}@yoda.test".format(n), "creator_user": "technicaladmin@yoda.test",
+                  "creator_zone": "testZone"} for n in range(3)]
+
+        def send_email_template(app, to, subject, template_name, template_data):
+            with app.app_context():
+                # The accounts have been committed before the invitations are sent
+                assert User.query.filter_by(username=batch[0]["username"]).first() is not None
+            if to == "batchuser1@yoda.test":
+                raise Exception("[EMAIL] Could not send mail")
+
+        with patch("yoda_eus.outbox.send_email_template", side_effect=send_email_template):
+            with test_client as c:
+                response = c.post('/api/user/add-batch', json=batch, headers=auth_headers)
+                assert response.status_code == 200
+                results = response.json["results"]
+                assert [result["status"] for result in results] == ["ok", "error", "ok"]
+                assert results[1]["message"] == "User created, but the invitation email could not be sent."
+
+        with app.app_context():
+            assert User.query.filter(User.username.like("batchuser%")).count() == 3
+
+    def test_activate_commits_before_mail(self, app, test_client):
+        app.config["MAIL_ENABLED"] = "true"
+        activate_params = {"username": "unactivateduser1",
+                           "password": "Test1234567!!!",
+                           "password_again": "Test1234567!!!",
+                           "cb-activation-tou": ""}
+
+        def send_email_template(app, to, subject, template_name, template_data):
+            if template_name == "invitation-accepted":
+                raise Exception("[EMAIL] Could not send mail")
+
+        with patch("yoda_eus.outbox.send_email_template", side_effect=send_email_template):
+            with test_client as c:
+                with pytest.raises(Exception, match="Could not send mail"):
+                    c.post('/user/activate/goodhash1', data=activate_params)
+
+        # The activation has been committed before the confirmation emails were sent
+        with app.app_context():
+            user = User.query.filter_by(username="unactivateduser1").first()
+            assert user.password is not None
+            assert user.hash_digest is None
+
+    def test_add_user_batch_invalid(self, test_client):
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        with test_client as c:
+            response = c.post('/api/user/add-batch', json={"username": "notabatch"}, headers=auth_headers)
+            assert response.status_code == 400
+
+    def test_delete_user_persists(self, app, test_client):
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        add_params = {"username": "deleteduser", "creator_user": "technicaladmin", "creator_zone": "testZone"}
+        rm_params = {"username": "deleteduser", "userzone": "testZone"}
+
+        with test_client as c:
+            response1 = c.post('/api/user/add', json=add_params, headers=auth_headers)
+            assert response1.status_code == 201
+            response2 = c.post('/api/user/delete', json=rm_params, headers=auth_headers)
+            assert response2.status_code == 204
+
+        with app.app_context():
+            assert User.query.filter_by(username="deleteduser").first() is None
+
+    def test_delete_user_batch(self, app, test_client):
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        add_batch = [{"username": "batchuser1", "creator_user": "technicaladmin", "creator_zone": "testZone"},
+                     {"username": "batchuser1", "creator_user": "technicaladmin", "creator_zone": "otherZone"},
+                     {"username": "batchuser2", "creator_user": "technicaladmin", "creator_zone": "testZone"}]
+        delete_batch = [{"username": "batchuser1", "userzone": "testZone"},
+                        {"username": "batchuser2", "userzone": "testZone"},
+                        {"username": "doesnotexist", "userzone": "testZone"},
+                        {"username": "batchuser2"}]
+
+        with test_client as c:
+            response1 = c.post('/api/user/add-batch', json=add_batch, headers=auth_headers)
+            assert response1.status_code == 200
+            response2 = c.post('/api/user/delete-batch', json=delete_batch, headers=auth_headers)
+            assert response2.status_code == 200
+            results = response2.json["results"]
+            assert [result["status"] for result in results] == ["ok", "ok", "error", "error"]
+            assert results[2]["message"] == "User not found."
+            assert results[3]["message"] == "Missing input field: userzone"
+
+        with app.app_context():
+            batchuser1 = User.query.filter_by(username="batchuser1").first()
+            assert [user_zone.inviter_zone for user_zone in UserZone.query.filter_by(user_id=batchuser1.id)] == \
+                ["otherZone"]
+            assert User.query.filter_by(username="batchuser2").first() is None
+
+    @pytest.mark.parametrize("returning", [True, False])
+    def test_purge_zone(self, app, test_client, returning):
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        add_batch = [{"username": "batchuser1", "creator_user": "technicaladmin", "creator_zone": "purgedZone"},
+                     {"username": "batchuser1", "creator_user": "technicaladmin", "creator_zone": "otherZone"},
+                     {"username": "batchuser2", "creator_user": "technicaladmin", "creator_zone": "purgedZone"}]
+
+        with test_client as c, patch("yoda_eus.app.supports_returning", return_value=returning):
+            response1 = c.post('/api/user/add-batch', json=add_batch, headers=auth_headers)
+            assert response1.status_code == 200
+            response2 = c.post('/api/zone/purge', json={"zone": "purgedZone"}, headers=auth_headers)
+            assert response2.status_code == 200
+            assert response2.json["registrations_deleted"] == 2
+            assert response2.json["users_deleted"] == 1
+            response3 = c.post('/api/zone/purge', json={}, headers=auth_headers)
+            assert response3.status_code == 401
+
+        with app.app_context():
+            assert User.query.filter_by(username="batchuser1").first() is not None
+            assert User.query.filter_by(username="batchuser2").first() is None
+            assert UserZone.query.filter_by(inviter_zone="purgedZone").count() == 0
+
+    def test_add_user_repeated_invite(self, app, test_client):
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        add_params = {"username": "repeateduser", "creator_user": "technicaladmin", "creator_zone": "testZone"}
+
+        with test_client as c:
+            response1 = c.post('/api/user/add', json=add_params, headers=auth_headers)
+            assert response1.status_code == 201
+            response2 = c.post('/api/user/add', json=add_params, headers=auth_headers)
+            assert response2.status_code == 200
+            assert response2.json["message"] == "User already exists."
+
+        with app.app_context():
+            user = User.query.filter_by(username="repeateduser").first()
+            assert UserZone.query.filter_by(user_id=user.id).count() == 1
+
+    def test_db_pool_stats(self, test_client):
+        api_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        with test_client as c:
+            response = c.get('/api/stats', headers=api_headers)
+            assert response.status_code == 200
+            assert response.json["pid"] > 0
+            assert "checkedout" in response.json["db_pool"]
+
+    def _write_config(self, tmp_path, overrides, db_override=True):
+        config = open("tests/flask.test.cfg").read()
+        if not db_override:
+            config = config.replace("DB_OVERRIDE_URI", "UNUSED_DB_OVERRIDE_URI")
+        config_filename = str(tmp_path / "flask.cfg")
+        with open(config_filename, "w") as f:
+            f.write(config + "\n" + overrides + "\n")
+        return config_filename
+
+    def test_db_pool_config(self, tmp_path):
+        config_filename = self._write_config(tmp_path,
+                                             "DB_STATEMENT_TIMEOUT = 5000\nDB_POOL_SIZE = 3\nLOAD_TEST_DATA = 'false'",
+                                             db_override=False)
+        with patch("yoda_eus.app.db"), patch("yoda_eus.app.migrate"):
+            app = create_app(config_filename=config_filename)
+        engine_options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+        assert engine_options["pool_size"] == 3
+        assert engine_options["pool_pre_ping"]
+        assert engine_options["connect_args"]["options"] == "-c statement_timeout=5000"
+
+    def test_static_assets(self, tmp_path):
+        theme_static = tmp_path / "themes" / "uu" / "static" / "css"
+        theme_static.mkdir(parents=True)
+        (theme_static / "yoda-portal.css").write_text("body { color: red; }")
+        config_filename = self._write_config(tmp_path, "YODA_THEME_PATH = '{}'".format(tmp_path / "themes"))
+        app = create_app(config_filename=config_filename)
+
+        with app.test_client() as c:
+            response1 = c.get('/assets/css/yoda-portal.css')
+            assert response1.status_code == 200
+            assert response1.data == b"body { color: red; }"
+            response1.close()
+            response2 = c.get('/assets/css/missing.css')
+            assert response2.status_code == 404
+
+    def test_static_assets_fingerprint(self, tmp_path):
+        theme_static = tmp_path / "themes" / "uu" / "static" / "css"
+        theme_static.mkdir(parents=True)
+        (theme_static / "yoda-portal.css").write_text("body { color: red; }")
+        config_filename = self._write_config(tmp_path, "YODA_THEME_PATH = '{}'".format(tmp_path / "themes"))
+        app = create_app(config_filename=config_filename)
+
+        with app.test_client() as c:
+            page = c.get('/').data.decode("utf-8")
+            url = page[page.index("/assets/css/yoda-portal.css"):].split('"')[0]
+            assert "?v=" in url
+
+            response1 = c.get(url)
+            assert response1.status_code == 200
+            assert response1.cache_control.immutable
+            assert response1.cache_control.max_age == 31536000
+            etag, weak = response1.get_etag()
+            assert not weak
+            response1.close()
+
+            response2 = c.get(url, headers={"If-None-Match": '"{}"'.format(etag)})
+            assert response2.status_code == 304
+
+            response3 = c.get('/assets/css/yoda-portal.css?v=outdated')
+            assert response3.status_code == 200
+            assert response3.cache_control.no_cache
+            assert not response3.cache_control.immutable
+            response3.close()
+
+    def test_static_assets_precompressed(self, tmp_path):
+        theme_static = tmp_path / "themes" / "uu" / "static" / "css"
+        theme_static.mkdir(parents=True)
+        (theme_static / "yoda-portal.css").write_text("body { color: red; }")
+        (theme_static / "yoda-portal.css.gz").write_bytes(gzip.compress(b"body { color: red; }"))
+        config_filename = self._write_config(tmp_path, "YODA_THEME_PATH = '{}'".format(tmp_path / "themes"))
+        app = create_app(config_filename=config_filename)
+
+        with app.test_client() as c:
+            response1 = c.get('/assets/css/yoda-portal.css', headers={"Accept-Encoding": "gzip"})
+            assert response1.status_code == 200
+            assert response1.headers["Content-Encoding"] == "gzip"
+            assert response1.mimetype == "text/css"
+            assert "Accept-Encoding" in response1.vary
+            assert gzip.decompress(response1.data) == b"body { color: red; }"
+            response1.close()
+
+            response2 = c.get('/assets/css/yoda-portal.css')
+            assert response2.status_code == 200
+            assert "Content-Encoding" not in response2.headers
+            assert "Accept-Encoding" in response2.vary
+            assert response2.data == b"body { color: red; }"
+            response2.close()
+
+    def test_html_compression(self, tmp_path):
+        config_filename = self._write_config(tmp_path, "HTML_COMPRESSION_ENABLED = 'true'\nHTML_COMPRESSION_MIN_SIZE = 0")
+        app = create_app(config_filename=config_filename)
+
+        with app.test_client() as c:
+            response1 = c.get('/', headers={"Accept-Encoding": "gzip"})
+            assert response1.status_code == 200
+            assert response1.headers["Content-Encoding"] == "gzip"
+            assert b"<html" in gzip.decompress(response1.data)
+
+            response2 = c.get('/')
+            assert "Content-Encoding" not in response2.headers
+            assert "Accept-Encoding" in response2.vary
+
+    def test_html_compression_csrf_token(self, tmp_path):
+        config_filename = self._write_config(tmp_path, "HTML_COMPRESSION_ENABLED = 'true'\nHTML_COMPRESSION_MIN_SIZE = 0\n"
+                                                       "CSRF_TOKENS_ENABLED = 'true'\n"
+                                                       "SESSION_TYPE = 'filesystem'\n"
+                                                       "SESSION_FILE_DIR = '{}'".format(tmp_path / "sessions"))
+        app = create_app(config_filename=config_filename)
+
+        with app.test_client() as c:
+            response1 = c.get('/', headers={"Accept-Encoding": "gzip"})
+            assert response1.headers["Content-Encoding"] == "gzip"
+
+            response2 = c.get('/user/forgot-password', headers={"Accept-Encoding": "gzip"})
+            assert response2.status_code == 200
+            assert "Content-Encoding" not in response2.headers
+            assert b'name="csrf_token"' in response2.data
+
+    def test_lazy_sessions(self, tmp_path):
+        session_dir = tmp_path / "sessions"
+        config_filename = self._write_config(tmp_path, "CSRF_TOKENS_ENABLED = 'true'\n"
+                                                       "SESSION_TYPE = 'filesystem'\n"
+                                                       "SESSION_FILE_DIR = '{}'".format(session_dir))
+        app = create_app(config_filename=config_filename)
+
+        with app.test_client() as c:
+            with patch.object(app.session_interface.interface, "fetch_session") as fetch_session:
+                c.set_cookie("session", "existing-session-id")
+                response1 = c.get('/')
+                assert response1.status_code == 200
+                response2 = c.post('/api/user/auth-check', headers={"X-Yoda-External-User-Secret": "dummy_api_secret"})
+                assert response2.status_code == 401
+                response3 = c.get('/assets/img/missing.svg')
+                assert response3.status_code == 404
+                fetch_session.assert_not_called()
+                assert "Set-Cookie" not in response1.headers
+                assert "Set-Cookie" not in response2.headers
+            c.delete_cookie("session")
+
+            response4 = c.get('/user/forgot-password')
+            assert response4.status_code == 200
+            assert "Set-Cookie" in response4.headers
+            assert len(list(session_dir.iterdir())) > 0
+
+    def test_page_cache(self, tmp_path):
+        theme_templates = tmp_path / "themes" / "uu"
+        theme_templates.mkdir(parents=True)
+        (theme_templates / "index.html").write_text("Theme index")
+        config_filename = self._write_config(tmp_path, "YODA_THEME_PATH = '{}'\n"
+                                                       "PAGE_CACHE_CHECK_INTERVAL = 0".format(tmp_path / "themes"))
+        app = create_app(config_filename=config_filename)
+
+        with app.test_client() as c:
+            response1 = c.get('/')
+            response2 = c.get('/')
+            assert response1.data == response2.data == b"Theme index"
+            assert "Content-Security-Policy" in response2.headers
+            assert response2.headers["X-Content-Type-Options"] == "nosniff"
+
+            response3 = c.get('/user/nonexistent-page')
+            response4 = c.get('/user/nonexistent-page')
+            assert response3.status_code == response4.status_code == 404
+            assert response3.data == response4.data
+
+            stats = c.get('/api/stats', headers={"X-Yoda-External-User-Secret": "dummy_api_secret"}).json
+            assert stats["page_cache"]["hits"] == 2
+            assert stats["page_cache"]["misses"] == 2
+
+            index_template = theme_templates / "index.html"
+            index_template.write_text("Updated theme index")
+            os.utime(index_template, ns=(0, os.stat(index_template).st_mtime_ns + 1000000000))
+            response5 = c.get('/')
+            assert response5.data == b"Updated theme index"
+
+    def test_healthz(self, test_client):
+        with test_client as c:
+            response = c.get('/healthz')
+            assert response.status_code == 200
+            assert response.json == {"status": "ok"}
+            assert response.cache_control.no_store
+            assert "Set-Cookie" not in response.headers
+
+    def test_readyz(self, tmp_path):
+        config_filename = self._write_config(tmp_path, "HEALTH_DB_PROBE_TTL = 0")
+        app = create_app(config_filename=config_filename)
+
+        with app.test_client() as c:
+            response1 = c.get('/readyz')
+            assert response1.status_code == 200
+            assert response1.json["status"] == "ok"
+            assert response1.json["checks"]["database"]["status"] == "ok"
+            assert response1.json["checks"]["mail"]["status"] == "disabled"
+            assert response1.json["checks"]["bcrypt_pool"]["status"] == "ok"
+
+            saturated_stats = {"workers": 2, "queue_size": 4, "queue_depth": 4, "active": 2}
+            with patch.object(BcryptPool, "stats", return_value=saturated_stats):
+                response2 = c.get('/readyz')
+                assert response2.status_code == 503
+                assert response2.json["checks"]["bcrypt_pool"]["status"] == "saturated"
+
+            with app.app_context():
+                engine = db.engine
+            with patch.object(engine, "connect", side_effect=Exception("unreachable")):
+                response3 = c.get('/readyz')
+                assert response3.status_code == 503
+                assert response3.json["status"] == "unavailable"
+                assert response3.json["checks"]["database"]["status"] == "error"
+
+    def test_metrics(self, test_client):
+        bad_credentials = base64.b64encode(b"nonexistinguser:Test123456!!!").decode("utf-8")
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret',
+                        'Authorization': 'Basic ' + bad_credentials}
+        with test_client as c:
+            before = REGISTRY.get_sample_value("eus_auth_checks_total", {"outcome": "unknown_user"}) or 0
+            c.post('/api/user/auth-check', headers=auth_headers)
+            assert REGISTRY.get_sample_value("eus_auth_checks_total", {"outcome": "unknown_user"}) == before + 1
+
+            response = c.get('/metrics')
+            assert response.status_code == 200
+            assert response.mimetype == "text/plain"
+            metrics = response.data.decode("utf-8")
+            assert 'eus_request_duration_seconds_count{endpoint="auth_check",method="POST",status="401"}' in metrics
+            assert 'eus_request_db_queries_bucket{endpoint="auth_check",le="1.0"}' in metrics
+            assert "Set-Cookie" not in response.headers
+
+    def test_metrics_api_disabled(self):
+        app = create_app(config_filename="tests/flask.test.cfg", enable_api=False)
+        with app.test_client() as c:
+            response = c.get('/metrics')
+            assert response.status_code == 404
+
+    def test_outdated_schema(self, tmp_path):
+        config_filename = self._write_config(tmp_path, "DB_OVERRIDE_URI = 'sqlite:///{}'\n"
+                                                       "DB_AUTO_MIGRATE = 'false'\n"
+                                                       "LOAD_TEST_DATA = 'false'".format(tmp_path / "eus.db"))
+        app = create_app(config_filename=config_filename)
+
+        with app.test_client() as c:
+            response1 = c.get('/')
+            assert response1.status_code == 503
+            response2 = c.get('/healthz')
+            assert response2.status_code == 200
+
+            result = app.test_cli_runner().invoke(args=["migrate-db"])
+            assert "Created database schema" in result.output
+            result = app.test_cli_runner().invoke(args=["migrate-db"])
+            assert "is up to date" in result.output
+
+            response3 = c.get('/')
+            assert response3.status_code == 200
+
+    def test_expired_links(self, app, test_client):
+        expired_time = datetime.now() - timedelta(days=30)
+        with app.app_context():
+            User.query.filter(User.username.in_(["unactivateduser1", "unactivateduser5", "activateduser"])) \
+                .update({"hash_time": expired_time})
+            expired_user_id = User.query.filter_by(username="unactivateduser5").first().id
+            db.session.add(UserZone(user_id=expired_user_id, inviter_user="creator",
+                                    inviter_zone="testZone", inviter_time=expired_time))
+            db.session.commit()
+
+        with test_client as c:
+            response1 = c.get('/user/activate/goodhash1')
+            assert response1.status_code == 403
+            response2 = c.get('/user/activate/goodhash2')
+            assert response2.status_code == 200
+            response3 = c.get('/user/reset-password/resethash')
+            assert response3.status_code == 403
+
+        result = app.test_cli_runner().invoke(args=["sweep-users", "--batch-size", "1"])
+        assert "Cleared 1 expired password reset links, deleted 2 unactivated users." in result.output
+
+        with app.app_context():
+            assert User.query.filter_by(username="unactivateduser1").first() is None
+            assert User.query.filter_by(username="unactivateduser2").first() is not None
+            assert User.query.filter_by(username="activateduser").first().hash_digest is None
+            assert UserZone.query.filter_by(user_id=expired_user_id).count() == 0
+
+    def test_reinvite_expired_links(self, app, test_client):
+        app.config["MAIL_ENABLED"] = "true"
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret'}
+        expired_time = datetime.now() - timedelta(days=30)
+        with app.app_context():
+            User.query.filter(User.username.in_(["unactivateduser1", "unactivateduser2", "activateduser"])) \
+                .update({"hash_time": expired_time})
+            db.session.commit()
+
+        batch = [{"username": username, "creator_user": "technicaladmin@yoda.test", "creator_zone": "testZone"}
+                 for username in ["unactivateduser2", "unactivateduser3", "activateduser"]]
+        with patch("yoda_eus.outbox.send_email_template") as mock_send:
+            with test_client as c:
+                add_params = {"username": "unactivateduser1", "creator_user": "technicaladmin@yoda.test",
+                              "creator_zone": "testZone"}
+                response1 = c.post('/api/user/add', json=add_params, headers=auth_headers)
+                assert response1.status_code == 200
+                assert response1.json["message"] == "Invitation renewed."
+                response2 = c.post('/api/user/add-batch', json=batch, headers=auth_headers)
+                assert [result["message"] for result in response2.json["results"]] == \
+                    ["Invitation renewed.", "User already exists.", "User already exists."]
+            assert sorted(call.args[1] for call in mock_send.call_args_list
+                          if call.args[3] == "invitation") == ["unactivateduser1", "unactivateduser2"]
+
+        with test_client as c:
+            # The old activation link is replaced
+            response3 = c.get('/user/activate/goodhash1')
+            assert response3.status_code == 403
+            response4 = c.get('/user/activate/goodhash3')
+            assert response4.status_code == 200
+
+        with app.app_context():
+            for username in ["unactivateduser1", "unactivateduser2"]:
+                assert User.query.filter_by(username=username).first().hash_time > expired_time
+            assert User.query.filter_by(username="activateduser").first().hash_time == expired_time
+
+    def test_benchmark(self, tmp_path):
+        output_file = tmp_path / "benchmark.json"
+        assert benchmark.main(["--requests", "4", "--concurrency", "2", "--bcrypt-rounds", "4",
+                               "--output", str(output_file)]) == 0
+        report = json.loads(output_file.read_text())
+        assert report["settings"]["database"] == "sqlite"
+        assert report["emails_sent"] > 0
+        assert set(report["results"]) == set(benchmark.SCENARIOS)
+        for result in report["results"].values():
+            assert result["errors"] == 0
+            assert result["p50"] <= result["p95"] <= result["p99"]
+
+    def test_generate_test_data(self, app):
+        result = app.test_cli_runner().invoke(args=["generate-test-data", "--users", "50", "--zones", "5",
+                                                    "--batch-size", "20", "--seed", "1"])
+        assert result.exit_code == 0
+        assert "Generated 50 users with" in result.output.splitlines()[-1]
+
+        with app.app_context():
+            generated_users = User.query.filter(User.username.like("generated%")).all()
+            assert len(generated_users) == 50
+            assert all(len(user.user_zones) >= 1 for user in generated_users)
+            assert any(user.password is None for user in generated_users)
+            assert all(user.password is not None or user.hash_digest is not None for user in generated_users)
+            assert UserZone.query.filter(UserZone.inviter_zone.notin_(["zone{}".format(n) for n in range(5)]),
+                                         UserZone.inviter_user.like("inviter@%")).count() == 0
+
+    def test_generate_test_data_disabled(self, tmp_path):
+        config_filename = self._write_config(tmp_path, "LOAD_TEST_DATA = 'false'")
+        app = create_app(config_filename=config_filename)
+        result = app.test_cli_runner().invoke(args=["generate-test-data", "--users", "5"])
+        assert result.exit_code != 0
+        assert "Use --yes" in result.output
+
+        result = app.test_cli_runner().invoke(args=["generate-test-data", "--users", "5", "--yes"])
+        assert result.exit_code == 0
+        with app.app_context():
+            assert User.query.filter(User.username.like("generated%")).count() == 5
+
+    def test_throttle_auth_check(self, tmp_path):
+        config_filename = self._write_config(tmp_path, "THROTTLE_AUTH_CHECK_USER_CAPACITY = 2")
+        app = create_app(config_filename=config_filename)
+        credentials = base64.b64encode(b"activateduser:wrongpassword").decode("utf-8")
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret', 'Authorization': 'Basic ' + credentials}
+        other_credentials = base64.b64encode(b"unactivateduser1:wrongpassword").decode("utf-8")
+        other_auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret', 'Authorization': 'Basic ' + other_credentials}
+        before = REGISTRY.get_sample_value("eus_throttle_hits_total", {"endpoint": "auth_check", "key_type": "user"}) or 0
+
+        with app.test_client() as c:
+            assert c.post('/api/user/auth-check', headers=auth_headers).status_code == 401
+            assert c.post('/api/user/auth-check', headers=auth_headers).status_code == 401
+            with patch("yoda_eus.app.get_password_hash") as get_password_hash:
+                response = c.post('/api/user/auth-check', headers=auth_headers)
+                get_password_hash.assert_not_called()
+            assert response.status_code == 429
+            assert int(response.headers["Retry-After"]) > 0
+            assert c.post('/api/user/auth-check', headers=other_auth_headers).status_code == 401
+
+        after = REGISTRY.get_sample_value("eus_throttle_hits_total", {"endpoint": "auth_check", "key_type": "user"})
+        assert after == before + 1
+
+    def test_throttle_auth_check_correct_credentials(self, tmp_path):
+        config_filename = self._write_config(tmp_path, "THROTTLE_AUTH_CHECK_USER_CAPACITY = 2\nBCRYPT_ROUNDS = 4")
+        app = create_app(config_filename=config_filename)
+        credentials = base64.b64encode(b"activateduser:Test123456!!!").decode("utf-8")
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret', 'Authorization': 'Basic ' + credentials}
+
+        with app.test_client() as c:
+            statuses = [c.post('/api/user/auth-check', headers=auth_headers).status_code for _ in range(5)]
+            assert statuses == [200] * 5
+
+    def test_throttle_forgot_password(self, tmp_path):
+        config_filename = self._write_config(tmp_path, "THROTTLE_FORGOT_PASSWORD_ADDRESS_CAPACITY = 1\n"
+                                                       "THROTTLE_BACKEND = 'database'")
+        app = create_app(config_filename=config_filename)
+        with app.test_client() as c:
+            response1 = c.post('/user/forgot-password', data={"username": "doesnotexist"})
+            assert response1.status_code == 404
+            response2 = c.post('/user/forgot-password', data={"username": "activateduser"})
+            assert response2.status_code == 429
+            assert b"Too many requests" in response2.data
+
+    def test_auth_check_coalescing(self, tmp_path):
+        config_filename = self._write_config(tmp_path, "AUTH_CACHE_ENABLED = 'false'\nBCRYPT_POOL_SIZE = 4")
+        app = create_app(config_filename=config_filename)
+        credentials = base64.b64encode(b"activateduser:Test123456!!!").decode("utf-8")
+        auth_headers = {'X-Yoda-External-User-Secret': 'dummy_api_secret', 'Authorization': 'Basic ' + credentials}
+        checkpw = bcrypt.checkpw
+        barrier = threading.Barrier(3)
+        statuses = []
+        checkpw_calls = []
+
+        def slow_checkpw(password, hashed_password):
+            checkpw_calls.append(password)
+            time.sleep(0.5)
+            return checkpw(password, hashed_password)
+
+        def send_auth_check():
+            with app.test_client() as c:
+                barrier.wait()
+                statuses.append(c.post('/api/user/auth-check', headers=auth_headers).status_code)
+
+        with patch("yoda_eus.bcrypt_pool.bcrypt.checkpw", slow_checkpw):
+            threads = [threading.Thread(target=send_auth_check) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert statuses == [200, 200, 200]
+        assert len(checkpw_calls) < 3
+        with app.test_client() as c:
+            stats = c.get('/api/stats', headers={'X-Yoda-External-User-Secret': 'dummy_api_secret'}).json
+            assert stats["auth_coalescing"]["coalesced"] == 3 - len(checkpw_calls)
+
+    def test_get_password_hash(self, app):
+        with app.app_context():
+            assert get_password_hash("activateduser").startswith("$2b$")
+            assert get_password_hash("unactivateduser1") is None
+            assert get_password_hash("doesnotexist") is None
+            assert len(db.session.identity_map) == 0
+
+    def test_prepare_password_hash_query(self):
+        dbapi_connection = MagicMock()
+        connection_record = MagicMock(info={})
+        prepare_password_hash_query(dbapi_connection, connection_record)
+        assert dbapi_connection.cursor().execute.call_args[0][0].startswith("PREPARE eus_password_hash")
+        assert connection_record.info["password_hash_prepared"]
+        dbapi_connection.rollback.assert_called_once()
+
+        dbapi_connection.cursor().execute.side_effect = Exception("relation \"users\" does not exist")
+        prepare_password_hash_query(dbapi_connection, connection_record)
+        assert not connection_record.info["password_hash_prepared"]
@@ -1,12 +1,28 @@
 __copyright__ = 'Copyright (c) 2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import gzip
+import os
+import smtplib
 import string
-from unittest.mock import patch
+import threading
+import time
+from unittest.mock import MagicMock, patch
 
-from yoda_eus.mail import is_email_valid
+import bcrypt
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine, inspect, text
+from yoda_eus.bcrypt_pool import BcryptPool, BcryptPoolFullError, calibrate_rounds, get_hash_rounds
+from yoda_eus.credential_cache import CredentialCache, get_credentials_digest
+from yoda_eus.health import CachedProbe
+from yoda_eus.lazy_session import LazySession, LazySessionInterface
+from yoda_eus.mail import is_email_valid, MailTemplateCache, SMTPConnectionPool
+from yoda_eus.migrations import BASELINE_VERSION, get_schema_version, LATEST_VERSION, migrate
 from yoda_eus.password_complexity import check_password_complexity
-from yoda_eus.util import get_validated_static_path
+from yoda_eus.single_flight import SingleFlight
+from yoda_eus.throttle import DatabaseThrottleBackend, MemoryThrottleBackend, Throttle
+from yoda_eus.util import get_hash_digest, precompress_static_files, StaticAssetIndex
 
 
 class TestMain:
@@ -64,79 +80,412 @@ class TestMain:
     def is_email_valid_no(self):
         assert not is_email_valid("this is not a valid email address")
 
-    def exists_return_value(self, pathname):
-        """ Mock path.exists function. True if path does not contain "theme" and "uu" """
-        return not ("theme" in pathname and "uu" in pathname)
-
-    @patch("os.path.exists")
-    def test_static_loader_valid_path(self, mock_exists):
-        mock_exists.side_effect = self.exists_return_value
-        # uu theme
-        static_dir, asset_name = get_validated_static_path(
-            "/assets/img/logo.svg?wekr",
-            "/assets/img/logo.svg",
-            "/var/www/yoda/themes",
-            "uu",
-        )
-        assert static_dir == "/var/www/yoda/static/img"
-        assert asset_name == "logo.svg"
-        # other theme
-        static_dir, asset_name = get_validated_static_path(
-            "/assets/img/logo.svg?wekr",
-            "/assets/img/logo.svg",
-            "/var/www/yoda/themes",
-            "wur",
-        )
-        assert static_dir == "/var/www/yoda/themes/wur/static/img"
-        assert asset_name == "logo.svg"
+    def test_credential_cache_hit_and_miss(self):
+        cache = CredentialCache(max_size=10, ttl=60)
+        assert not cache.lookup("user", "Test123456!!!", "storedhash")
+        cache.store("user", "Test123456!!!", "storedhash")
+        assert cache.lookup("user", "Test123456!!!", "storedhash")
+        assert not cache.lookup("user", "wrongpassword", "storedhash")
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 2
 
-    @patch("os.path.exists")
-    def test_static_loader_invalid_path(self, mock_exists):
-        mock_exists.side_effect = self.exists_return_value
-        # Too short
-        assert (
-            get_validated_static_path("/?sawerw", "/", "/var/www/yoda/themes", "uu")
-            is None
-        )
-        # Path traversal attack
-        assert (
-            get_validated_static_path(
-                "/assets/../../../../etc/passwd?werwrwr",
-                "/assets/../../../../etc/passwd",
-                "/var/www/yoda/themes",
-                "uu",
-            )
-            is None
-        )
-        # non-printable characters
-        full_path = "/assets/" + chr(13) + "img/logo.svg?werwer"
-        path = "/assets/" + chr(13) + "img/logo.svg"
-        assert (
-            get_validated_static_path(full_path, path, "/var/www/yoda/themes", "uu")
-            is None
-        )
-        assert (
-            get_validated_static_path(full_path, path, "/var/www/yoda/themes", "wur")
-            is None
-        )
-        # non-printable characters in asset name
-        full_path = "/assets/img/l" + chr(13) + "ogo.svg?werwer"
-        path = "/assets/img/l" + chr(13) + "ogo.svg"
-        assert (
-            get_validated_static_path(full_path, path, "/var/www/yoda/themes", "uu")
-            is None
-        )
-        assert (
-            get_validated_static_path(full_path, path, "/var/www/yoda/themes", "wur")
-            is None
-        )
-        # .. in file name
-        assert (
-            get_validated_static_path(
-                "/assets/img/lo..go.svg?sklaerw",
-                "/assets/img/lo..go.svg?sklaerw",
-                "/var/www/yoda/themes",
-                "uu",
-            )
-            is None
-        )
+    def test_credential_cache_no_plaintext(self):
+        cache = CredentialCache(max_size=10, ttl=60)
+        cache.store("user", "Test123456!!!", "storedhash")
+        for username, digest in cache._entries:
+            assert username == "user"
+            assert b"Test123456!!!" not in digest
+
+    def test_credential_cache_changed_hash(self):
+        cache = CredentialCache(max_size=10, ttl=60)
+        cache.store("user", "Test123456!!!", "storedhash")
+        assert not cache.lookup("user", "Test123456!!!", "otherhash")
+        assert cache.stats()["size"] == 0
+
+    def test_credential_cache_expiry(self):
+        cache = CredentialCache(max_size=10, ttl=0)
+        cache.store("user", "Test123456!!!", "storedhash")
+        assert not cache.lookup("user", "Test123456!!!", "storedhash")
+
+    def test_credential_cache_bounded(self):
+        cache = CredentialCache(max_size=2, ttl=60)
+        for n in range(3):
+            cache.store("user" + str(n), "Test123456!!!", "storedhash")
+        assert cache.stats()["size"] == 2
+        assert not cache.lookup("user0", "Test123456!!!", "storedhash")
+        assert cache.lookup("user2", "Test123456!!!", "storedhash")
+
+    def test_credential_cache_invalidate(self):
+        cache = CredentialCache(max_size=10, ttl=60)
+        cache.store("user", "Test123456!!!", "storedhash")
+        cache.store("otheruser", "Test123456!!!", "storedhash")
+        cache.invalidate("user")
+        assert not cache.lookup("user", "Test123456!!!", "storedhash")
+        assert cache.lookup("otheruser", "Test123456!!!", "storedhash")
+
+    def test_bcrypt_pool_checkpw(self):
+        pool = BcryptPool(workers=1, queue_size=1)
+        hashed_password = bcrypt.hashpw(b"Test123456!!!", bcrypt.gensalt(4))
+        assert pool.checkpw(b"Test123456!!!", hashed_password)
+        assert not pool.checkpw(b"wrongpassword", hashed_password)
+        assert pool.stats()["completed"] == 2
+
+    def test_bcrypt_pool_full(self):
+        pool = BcryptPool(workers=1, queue_size=1)
+        release = threading.Event()
+        futures = [pool.submit(release.wait), pool.submit(release.wait)]
+        with pytest.raises(BcryptPoolFullError):
+            pool.submit(release.wait)
+        assert pool.stats()["rejected"] == 1
+        assert pool.stats()["queue_depth"] == 1
+        release.set()
+        for future in futures:
+            future.result()
+        assert pool.stats()["queue_depth"] == 0
+        assert pool.submit(release.wait).result()
+
+    def test_get_hash_rounds(self):
+        assert get_hash_rounds(bcrypt.hashpw(b"Test123456!!!", bcrypt.gensalt(5)).decode("utf-8")) == 5
+        assert get_hash_rounds("notahash") is None
+
+    def test_calibrate_rounds(self):
+        proposal, measurements = calibrate_rounds(0, min_rounds=4, max_rounds=6)
+        assert proposal == 4
+        assert len(measurements) == 1
+        proposal, measurements = calibrate_rounds(60, min_rounds=4, max_rounds=5)
+        assert proposal == 5
+        assert [rounds for rounds, _ in measurements] == [4, 5]
+
+    @patch("smtplib.SMTP")
+    def test_smtp_pool_reuses_connection(self, mock_smtp):
+        mock_smtp.return_value.noop.return_value = (250, b"OK")
+        pool = SMTPConnectionPool("smtp://localhost:25", starttls=True, username="user", password="secret")
+        pool.sendmail("from@yoda.test", ["to@yoda.test"], "message 1")
+        pool.sendmail("from@yoda.test", ["to@yoda.test"], "message 2")
+        mock_smtp.assert_called_once_with("localhost", 25, timeout=30.0)
+        mock_smtp.return_value.starttls.assert_called_once()
+        mock_smtp.return_value.login.assert_called_once_with("user", "secret")
+        assert mock_smtp.return_value.sendmail.call_count == 2
+
+    @patch("smtplib.SMTP")
+    def test_smtp_pool_reconnects_dead_connection(self, mock_smtp):
+        mock_smtp.return_value.noop.side_effect = smtplib.SMTPServerDisconnected()
+        pool = SMTPConnectionPool("smtp://localhost")
+        pool.sendmail("from@yoda.test", ["to@yoda.test"], "message 1")
+        pool.sendmail("from@yoda.test", ["to@yoda.test"], "message 2")
+        assert mock_smtp.call_count == 2
+        mock_smtp.assert_called_with("localhost", 587, timeout=30.0)
+
+    @patch("smtplib.SMTP")
+    def test_smtp_pool_retries_dropped_connection(self, mock_smtp):
+        mock_smtp.return_value.sendmail.side_effect = [smtplib.SMTPServerDisconnected(), {}]
+        pool = SMTPConnectionPool("smtp://localhost:25")
+        pool.sendmail("from@yoda.test", ["to@yoda.test"], "message")
+        assert mock_smtp.call_count == 2
+        assert mock_smtp.return_value.sendmail.call_count == 2
+
+    @patch("smtplib.SMTP")
+    def test_smtp_pool_max_messages(self, mock_smtp):
+        mock_smtp.return_value.noop.return_value = (250, b"OK")
+        pool = SMTPConnectionPool("smtp://localhost:25", max_messages=2)
+        for n in range(3):
+            pool.sendmail("from@yoda.test", ["to@yoda.test"], "message")
+        assert mock_smtp.call_count == 2
+        mock_smtp.return_value.quit.assert_called_once()
+
+    @patch("smtplib.SMTP")
+    def test_smtp_pool_send_error(self, mock_smtp):
+        mock_smtp.return_value.sendmail.side_effect = smtplib.SMTPRecipientsRefused({})
+        pool = SMTPConnectionPool("smtp://localhost:25")
+        with pytest.raises(Exception, match="Could not send mail"):
+            pool.sendmail("from@yoda.test", ["to@yoda.test"], "message")
+
+    @patch("smtplib.SMTP")
+    def test_smtp_pool_slot_timeout(self, mock_smtp):
+        pool = SMTPConnectionPool("smtp://localhost:25", max_connections=1, timeout=0.1)
+        pool._slots.acquire()
+        with pytest.raises(Exception, match="all connections to the mail server are busy"):
+            pool.sendmail("from@yoda.test", ["to@yoda.test"], "message")
+        mock_smtp.assert_not_called()
+        pool._slots.release()
+        pool.sendmail("from@yoda.test", ["to@yoda.test"], "message")
+        mock_smtp.assert_called_once_with("localhost", 25, timeout=0.1)
+
+    def _write_mail_templates(self, template_dir, text):
+        os.makedirs(os.path.join(template_dir, "test"), exist_ok=True)
+        for filename, content in [("invitation.txt.j2", text),
+                                  ("invitation.html.j2", "<p>" + text + "</p>"),
+                                  ("common-start.html.j2", "<html>"),
+                                  ("common-end.html.j2", "</html>")]:
+            with open(os.path.join(template_dir, "test", filename), "w") as f:
+                f.write(content)
+
+    def test_mail_template_cache(self, tmp_path):
+        self._write_mail_templates(str(tmp_path), "Hello {{USERNAME}}")
+        cache = MailTemplateCache(check_interval=0)
+        text_template, html_template = cache.get(str(tmp_path), "test", "invitation")
+        assert text_template.render(USERNAME="piet") == "Hello piet"
+        assert html_template.render(USERNAME="piet") == "<html><p>Hello piet</p></html>"
+        assert cache.get(str(tmp_path), "test", "invitation")[0] is text_template
+
+    def test_mail_template_cache_changed_file(self, tmp_path):
+        self._write_mail_templates(str(tmp_path), "Hello {{USERNAME}}")
+        cache = MailTemplateCache(check_interval=0)
+        cache.get(str(tmp_path), "test", "invitation")
+        self._write_mail_templates(str(tmp_path), "Goodbye {{USERNAME}}")
+        filename = os.path.join(str(tmp_path), "test", "invitation.txt.j2")
+        os.utime(filename, ns=(0, os.stat(filename).st_mtime_ns + 1000000000))
+        text_template, _ = cache.get(str(tmp_path), "test", "invitation")
+        assert text_template.render(USERNAME="piet") == "Goodbye piet"
+
+    def _write_file(self, filename, content="test"):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            f.write(content)
+
+    def test_static_asset_index_theme_override(self, tmp_path):
+        theme_static = str(tmp_path / "themes" / "uu" / "static")
+        default_static = str(tmp_path / "static")
+        self._write_file(os.path.join(theme_static, "img", "logo.svg"))
+        self._write_file(os.path.join(default_static, "img", "logo.svg"))
+        self._write_file(os.path.join(default_static, "css", "yoda-portal.css"))
+        self._write_file(os.path.join(default_static, "css", "not safe.css"))
+        index = StaticAssetIndex([theme_static, default_static])
+        assert index.resolve("img/logo.svg")[:2] == (os.path.join(theme_static, "img"), "logo.svg")
+        assert index.resolve("css/yoda-portal.css")[:2] == (os.path.join(default_static, "css"), "yoda-portal.css")
+        assert index.resolve("css/not safe.css") is None
+        assert index.resolve("../static/css/yoda-portal.css") is None
+        assert index.resolve("img/missing.svg") is None
+
+    def test_static_asset_index_refresh(self, tmp_path):
+        theme_static = str(tmp_path / "themes" / "uu" / "static")
+        default_static = str(tmp_path / "static")
+        self._write_file(os.path.join(default_static, "img", "logo.svg"))
+        index = StaticAssetIndex([theme_static, default_static], refresh_interval=0)
+        assert index.resolve("img/logo.svg")[:2] == (os.path.join(default_static, "img"), "logo.svg")
+        self._write_file(os.path.join(theme_static, "img", "logo.svg"))
+        assert index.resolve("img/logo.svg")[:2] == (os.path.join(theme_static, "img"), "logo.svg")
+
+    def test_static_asset_index_fingerprint(self, tmp_path):
+        default_static = str(tmp_path / "static")
+        self._write_file(os.path.join(default_static, "css", "a.css"), "body { color: red; }")
+        self._write_file(os.path.join(default_static, "css", "b.css"), "body { color: red; }")
+        self._write_file(os.path.join(default_static, "css", "c.css"), "body { color: blue; }")
+        index = StaticAssetIndex([default_static])
+        assert index.resolve("css/a.css").fingerprint == index.resolve("css/b.css").fingerprint
+        assert index.resolve("css/a.css").fingerprint != index.resolve("css/c.css").fingerprint
+
+    def test_static_asset_index_file_overwritten(self, tmp_path):
+        default_static = str(tmp_path / "static")
+        filename = os.path.join(default_static, "css", "a.css")
+        self._write_file(filename, "body { color: red; }")
+        self._write_file(os.path.join(default_static, "css", "b.css"), "body { color: red; }")
+        index = StaticAssetIndex([default_static], refresh_interval=0)
+        fingerprint = index.resolve("css/a.css").fingerprint
+        generation = index.generation
+
+        # Overwrite in place, keeping the directory modification time
+        dir_stat = os.stat(os.path.dirname(filename))
+        self._write_file(filename, "body { color: blue; }")
+        os.utime(os.path.dirname(filename), ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+        assert index.resolve("css/a.css").fingerprint != fingerprint
+        assert index.generation == generation + 1
+        assert index.resolve("css/b.css").fingerprint == fingerprint
+
+    def test_precompress_static_files(self, tmp_path):
+        default_static = str(tmp_path / "static")
+        self._write_file(os.path.join(default_static, "css", "large.css"), "body { color: red; }\n" * 100)
+        self._write_file(os.path.join(default_static, "css", "small.css"), "body { color: red; }")
+        self._write_file(os.path.join(default_static, "img", "logo.png"), "x" * 2000)
+        written, failed = precompress_static_files([default_static], min_size=1024)
+        assert written >= 1 and failed == 0
+        with open(os.path.join(default_static, "css", "large.css.gz"), "rb") as f:
+            assert gzip.decompress(f.read()) == b"body { color: red; }\n" * 100
+        assert not os.path.exists(os.path.join(default_static, "css", "small.css.gz"))
+        assert not os.path.exists(os.path.join(default_static, "img", "logo.png.gz"))
+
+        index = StaticAssetIndex([default_static])
+        assert "gzip" in index.resolve("css/large.css").encodings
+        assert index.resolve("css/small.css").encodings == ()
+
+    def test_lazy_session_interface(self):
+        app = Flask(__name__)
+        inner = MagicMock()
+        inner.open_session.return_value = {"csrf_token": "token"}
+        inner.is_null_session.return_value = False
+        interface = LazySessionInterface(inner, stateless_prefixes=("/api/",))
+
+        with app.test_request_context("/api/user/auth-check") as ctx:
+            assert interface.open_session(app, ctx.request) is None
+
+        with app.test_request_context("/user/forgot-password") as ctx:
+            session = interface.open_session(app, ctx.request)
+            assert isinstance(session, LazySession)
+            interface.save_session(app, session, None)
+            inner.open_session.assert_not_called()
+            inner.save_session.assert_not_called()
+
+            assert session["csrf_token"] == "token"
+            interface.save_session(app, session, None)
+            inner.open_session.assert_called_once()
+            inner.save_session.assert_called_once()
+
+    def test_cached_probe(self):
+        check_results = [True, False]
+        probe = CachedProbe(lambda: check_results.pop(0), ttl=60)
+        assert probe.get()["status"] == "ok"
+        assert probe.get()["status"] == "ok"
+        assert len(check_results) == 1
+
+        probe.ttl = 0
+        assert probe.get()["status"] == "error"
+
+        def failing_check():
+            raise Exception("unreachable")
+
+        assert CachedProbe(failing_check).get()["status"] == "error"
+
+    def test_smtp_pool_check(self):
+        with patch("smtplib.SMTP") as mock_smtp:
+            mock_smtp.return_value.noop.return_value = (250, b"OK")
+            pool = SMTPConnectionPool("smtp://localhost:25")
+            assert pool.check()
+            assert pool.check()
+            assert mock_smtp.call_count == 1
+
+            mock_smtp.return_value.noop.return_value = (421, b"Closing")
+            mock_smtp.side_effect = ConnectionRefusedError()
+            assert not pool.check()
+
+    def test_smtp_pool_check_timeout(self):
+        with patch("smtplib.SMTP") as mock_smtp:
+            mock_smtp.return_value.noop.return_value = (250, b"OK")
+            pool = SMTPConnectionPool("smtp://localhost:25", timeout=30.0)
+            assert pool.check(timeout=2.0)
+            mock_smtp.assert_called_once_with("localhost", 25, timeout=2.0)
+            # The connection is kept for sending mail, with the timeout of the pool
+            assert mock_smtp.return_value.timeout == 30.0
+            mock_smtp.return_value.sock.settimeout.assert_called_with(30.0)
+
+            mock_smtp.return_value.sock.settimeout.reset_mock()
+            assert pool.check(timeout=2.0)
+            assert [call.args for call in mock_smtp.return_value.sock.settimeout.call_args_list] == [(2.0,), (30.0,)]
+
+    def test_migrate_empty_database(self, tmp_path):
+        engine = create_engine("sqlite:///" + str(tmp_path / "eus.db"))
+        assert get_schema_version(engine) is None
+        assert migrate(engine) == (None, LATEST_VERSION)
+        assert get_schema_version(engine) == LATEST_VERSION
+        assert migrate(engine) == (LATEST_VERSION, LATEST_VERSION)
+
+    def test_migrate_legacy_database(self, tmp_path):
+        engine = create_engine("sqlite:///" + str(tmp_path / "eus.db"))
+        with engine.begin() as connection:
+            connection.execute(text('CREATE TABLE "users" ("id" INTEGER NOT NULL PRIMARY KEY, '
+                                    '"username" varchar(64) NOT NULL UNIQUE, "password" char(60) NULL, '
+                                    '"hash" char(64) NULL UNIQUE, "hash_time" timestamp NULL, '
+                                    '"creator_time" timestamp NOT NULL, "creator_user" varchar(255) NOT NULL, '
+                                    '"creator_zone" varchar(255) NOT NULL)'))
+            connection.execute(text('CREATE TABLE "user_zones" ("user_id" INTEGER NOT NULL REFERENCES users(id), '
+                                    '"inviter_user" varchar(255) NOT NULL, "inviter_zone" varchar(255) NOT NULL, '
+                                    '"inviter_time" timestamp NOT NULL, PRIMARY KEY (user_id, inviter_zone))'))
+            connection.execute(text('INSERT INTO "users" VALUES (1, \'piet@example.com\', NULL, \'secrethash\', '
+                                    'CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, \'creator\', \'tempZone\')'))
+        assert migrate(engine) == (BASELINE_VERSION, LATEST_VERSION)
+        inspector = inspect(engine)
+        assert inspector.has_table("mail_outbox")
+        assert "ix_user_zones_inviter_zone" in [index["name"] for index in inspector.get_indexes("user_zones")]
+        assert "ix_users_hash_digest" in [index["name"] for index in inspector.get_indexes("users")]
+        with engine.connect() as connection:
+            row = connection.execute(text('SELECT "hash", "hash_digest" FROM "users"')).one()
+            assert row.hash is None
+            assert row.hash_digest == get_hash_digest("secrethash")
+
+    def test_memory_throttle(self):
+        throttle = Throttle(MemoryThrottleBackend(max_size=1), capacity=2, rate=0.5)
+        assert throttle.consume("user1") == 0
+        assert throttle.peek("user1") == 0
+        assert throttle.consume("user1") == 0
+        assert 0 < throttle.peek("user1") <= 2
+        assert 0 < throttle.consume("user1") <= 2
+        assert throttle.consume("user2") == 0
+        with patch("yoda_eus.throttle.time.monotonic", return_value=time.monotonic() + 2.5):
+            assert throttle.consume("user1") == 0
+
+    def test_memory_throttle_prune(self):
+        backend = MemoryThrottleBackend(max_size=8)
+        throttle = Throttle(backend, capacity=1, rate=0.001)
+        for n in range(8):
+            assert throttle.consume("user{}".format(n)) == 0
+        assert throttle.consume("user0") > 0
+        assert len(backend._buckets) == 8
+        # Least recently used buckets are removed until a quarter of the buckets is free
+        assert throttle.consume("user8") == 0
+        assert len(backend._buckets) == 6
+        assert throttle.peek("user0") > 0
+        assert throttle.peek("user1") == 0
+        assert throttle.peek("user4") > 0
+
+    def test_throttle_rate(self):
+        with pytest.raises(ValueError):
+            Throttle(MemoryThrottleBackend(), capacity=10, rate=0)
+
+    def test_database_throttle(self, tmp_path):
+        engine = create_engine("sqlite:///" + str(tmp_path / "eus.db"))
+        migrate(engine)
+        backend = DatabaseThrottleBackend(lambda: engine, prune_interval=5)
+        throttle = Throttle(backend, capacity=2, rate=0.5)
+        assert throttle.peek("user1") == 0
+        assert throttle.consume("user1") == 0
+        assert throttle.consume("user1") == 0
+        assert 0 < throttle.peek("user1") <= 2
+        assert 0 < throttle.consume("user1") <= 2
+        with patch("yoda_eus.throttle.time.time", return_value=time.time() + 5):
+            assert throttle.consume("user1") == 0
+        with engine.connect() as connection:
+            assert connection.execute(text('SELECT COUNT(*) FROM "throttle_buckets"')).scalar() == 1
+        with patch("yoda_eus.throttle.time.time", return_value=time.time() + 10):
+            # Every fifth call removes buckets that are full
+            assert throttle.consume("user2") == 0
+        with engine.connect() as connection:
+            assert connection.execute(text('SELECT "key" FROM "throttle_buckets"')).scalars().all() == ["user2"]
+
+    def test_single_flight(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def verify():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return True
+
+        threads = [threading.Thread(target=lambda: results.append(flights.run("key", verify))) for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while flights.stats()["coalesced"] < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert results == [True] * 4
+        assert len(calls) == 1
+        assert flights.stats() == {"calls": 1, "coalesced": 3, "in_flight": 0}
+
+        # Results are not kept after the call, and exceptions are passed to the caller
+        assert flights.run("key", lambda: False) is False
+        with pytest.raises(BcryptPoolFullError):
+            flights.run("key", MagicMock(side_effect=BcryptPoolFullError))
+
+    def test_credentials_digest(self):
+        cache = CredentialCache()
+        key = cache._key
+        assert cache.password_digest("user", "password") == get_credentials_digest(key, "user", "password")
+        assert get_credentials_digest(key, "user", "password") != get_credentials_digest(key, "user", "password2")
+        assert get_credentials_digest(key, "user", "password") != get_credentials_digest(bytes(32), "user", "password")
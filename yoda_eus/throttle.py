@@ -0,0 +1,228 @@
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import itertools
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Tuple
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+from yoda_eus.models import ThrottleBucket
+
+
+class ThrottledError(Exception):
+    """Raised when a request exceeds a throttle limit."""
+
+    def __init__(self, retry_after: float) -> None:
+        """
+        :param retry_after: Number of seconds until the request would be allowed
+        """
+        super().__init__("Too many requests, retry after {:.1f} seconds".format(retry_after))
+        self.retry_after = retry_after
+
+
+def get_wait_time(tokens: float, rate: float) -> float:
+    """
+    :param tokens: Number of tokens in the bucket
+    :param rate:   Number of tokens added per second
+
+    :returns: 0 if a token is available, otherwise the number of seconds until a token is available
+    """
+    return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+
+def refill_bucket(tokens: float, updated_time: float, now: float, capacity: float, rate: float) -> float:
+    """
+    :param tokens:       Number of tokens in the bucket at its last update
+    :param updated_time: Time of the last update
+    :param now:          Current time
+    :param capacity:     Maximum number of tokens in the bucket
+    :param rate:         Number of tokens added per second
+
+    :returns: number of tokens in the bucket at the current time
+    """
+    return min(capacity, tokens + max(0.0, now - updated_time) * rate)
+
+
+class ThrottleBackend(ABC):
+    """Storage of token buckets. Each call to consume takes a token from a bucket, if one is available.
+    Buckets that do not exist yet are full. Rates must be positive."""
+
+    @abstractmethod
+    def peek(self, key: str, capacity: float, rate: float) -> float:
+        """Checks whether a bucket has a token, without taking it.
+
+        :param key:      Bucket key
+        :param capacity: Maximum number of tokens in the bucket
+        :param rate:     Number of tokens added per second
+
+        :returns: 0 if a token is available, otherwise the number of seconds until a token is available
+        """
+        ...
+
+    @abstractmethod
+    def consume(self, key: str, capacity: float, rate: float) -> float:
+        """Takes a token from a bucket.
+
+        :param key:      Bucket key
+        :param capacity: Maximum number of tokens in the bucket
+        :param rate:     Number of tokens added per second
+
+        :returns: 0 if a token was taken, otherwise the number of seconds until a token is available
+        """
+        ...
+
+
+class MemoryThrottleBackend(ThrottleBackend):
+    """Token buckets in the memory of the worker process. Limits apply per process.
+
+    Buckets are kept in order of last use. When there are more than the maximum number of buckets,
+    full buckets are removed, as well as the least recently used buckets until a quarter of the
+    maximum size is free again, so that the cost of pruning is spread over many calls.
+    """
+
+    def __init__(self, max_size: int = 100000) -> None:
+        """
+        :param max_size: Maximum number of buckets
+        """
+        self.max_size = max_size
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        """Removes full buckets and the least recently used buckets.
+
+        :param now: Current time
+        """
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+        excess = len(self._buckets) - self.max_size * 3 // 4
+        for key in list(itertools.islice(self._buckets, max(0, excess))):
+            del self._buckets[key]
+
+    def peek(self, key: str, capacity: float, rate: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+        tokens = capacity if bucket is None else refill_bucket(bucket[0], bucket[1], now, capacity, rate)
+        return get_wait_time(tokens, rate)
+
+    def consume(self, key: str, capacity: float, rate: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            tokens = capacity if bucket is None else refill_bucket(bucket[0], bucket[1], now, capacity, rate)
+            wait = get_wait_time(tokens, rate)
+            if wait == 0.0:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            if len(self._buckets) > self.max_size:
+                self._prune(now)
+        return wait
+
+
+class DatabaseThrottleBackend(ThrottleBackend):
+    """Token buckets in the throttle_buckets table, so that limits apply to all worker processes
+    that share the database. Each call takes a short transaction of its own, outside of the
+    transaction of the request."""
+
+    def __init__(self, get_engine: Callable[[], Engine], prune_interval: int = 1000) -> None:
+        """
+        :param get_engine:     Function that returns the database engine
+        :param prune_interval: Number of calls after which full buckets are removed from the table
+        """
+        self.get_engine = get_engine
+        self.prune_interval = prune_interval
+        self._calls = 0
+        self._lock = threading.Lock()
+
+    def _create_bucket_if_missing(self, connection: Connection, key: str, capacity: float, now: float) -> None:
+        values = {"key": key, "tokens": capacity, "updated_time": now, "full_time": now}
+        version = connection.dialect.server_version_info
+        if connection.dialect.name == "postgresql":
+            connection.execute(postgresql.insert(ThrottleBucket.__table__).values(values).on_conflict_do_nothing())
+        elif connection.dialect.name == "sqlite" and version is not None and version >= (3, 24):
+            connection.execute(sqlite.insert(ThrottleBucket.__table__).values(values).on_conflict_do_nothing())
+        else:
+            exists = connection.execute(select(ThrottleBucket.key).where(ThrottleBucket.key == key)).first()
+            if exists is None:
+                with connection.begin_nested():
+                    try:
+                        connection.execute(insert(ThrottleBucket.__table__).values(values))
+                    except IntegrityError:
+                        # Created concurrently by another worker
+                        pass
+
+    def peek(self, key: str, capacity: float, rate: float) -> float:
+        now = time.time()
+        with self.get_engine().connect() as connection:
+            bucket = connection.execute(select(ThrottleBucket.tokens, ThrottleBucket.updated_time)
+                                        .where(ThrottleBucket.key == key)).first()
+        tokens = capacity if bucket is None else refill_bucket(bucket.tokens, bucket.updated_time, now, capacity, rate)
+        return get_wait_time(tokens, rate)
+
+    def consume(self, key: str, capacity: float, rate: float) -> float:
+        now = time.time()
+        with self.get_engine().begin() as connection:
+            # The bucket row is locked until the end of the transaction, so that concurrent
+            # requests for the same key are serialized.
+            self._create_bucket_if_missing(connection, key, capacity, now)
+            bucket = connection.execute(select(ThrottleBucket.tokens, ThrottleBucket.updated_time)
+                                        .where(ThrottleBucket.key == key)
+                                        .with_for_update()).one()
+            tokens = refill_bucket(bucket.tokens, bucket.updated_time, now, capacity, rate)
+            wait = get_wait_time(tokens, rate)
+            if wait == 0.0:
+                tokens -= 1
+            connection.execute(update(ThrottleBucket)
+                               .where(ThrottleBucket.key == key)
+                               .values(tokens=tokens, updated_time=now, full_time=now + (capacity - tokens) / rate))
+
+        with self._lock:
+            self._calls += 1
+            prune = self._calls % self.prune_interval == 0
+        if prune:
+            with self.get_engine().begin() as connection:
+                connection.execute(delete(ThrottleBucket).where(ThrottleBucket.full_time < now))
+        return wait
+
+
+class Throttle:
+    """Token bucket limiter. Each key (e.g. a username or client address) has a bucket of tokens
+    that is refilled at a constant rate. Each attempt takes a token, so that short bursts up to the
+    capacity of the bucket are allowed, but sustained attempts are limited to the refill rate."""
+
+    def __init__(self, backend: ThrottleBackend, capacity: float, rate: float) -> None:
+        """
+        :param backend:  Storage of the token buckets
+        :param capacity: Maximum number of tokens per bucket, i.e. the maximum burst of attempts
+        :param rate:     Number of tokens added per second
+
+        :raises ValueError: If the rate is not positive
+        """
+        if rate <= 0:
+            raise ValueError("Throttle rate must be positive, got {}".format(rate))
+        self.backend = backend
+        self.capacity = capacity
+        self.rate = rate
+
+    def peek(self, key: str) -> float:
+        """Checks whether the bucket of a key has a token, without taking it.
+
+        :param key: Bucket key
+
+        :returns: 0 if an attempt would be allowed, otherwise the number of seconds until it would be allowed
+        """
+        return self.backend.peek(key, self.capacity, self.rate)
+
+    def consume(self, key: str) -> float:
+        """Takes a token from the bucket of a key.
+
+        :param key: Bucket key
+
+        :returns: 0 if the attempt is allowed, otherwise the number of seconds until it would be allowed
+        """
+        return self.backend.consume(key, self.capacity, self.rate)
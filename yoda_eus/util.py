@@ -3,50 +3,231 @@
 __copyright__ = 'Copyright (c) 2021-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import gzip
+import hashlib
+import os
+import threading
+import time
 from os import path
-from re import fullmatch
-from typing import Optional, Tuple
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
 
-from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-def get_validated_static_path(
-    full_path: str, request_path: str, yoda_theme_path: str, yoda_theme: str
-) -> Optional[Tuple[str, str]]:
+
+# Extensions of static files that benefit from compression
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".map", ".json", ".svg", ".html", ".txt", ".xml", ".ico", ".ttf", ".otf", ".eot"}
+
+
+def get_compressors() -> Dict[str, Tuple[str, Callable[[bytes], bytes]]]:
+    """
+    :returns: dictionary that maps supported content encodings to the file suffix of precompressed
+              variants and a compression function. Brotli is only supported if the brotli module
+              is installed.
     """
-    Static files handling - recognisable through '/assets/'
-    Confirms that input path is valid and return corresponding static path
+    compressors: Dict[str, Tuple[str, Callable[[bytes], bytes]]] = {}
+    if brotli is not None:
+        compressors["br"] = (".br", lambda data: brotli.compress(data, quality=11))
+    compressors["gzip"] = (".gz", lambda data: gzip.compress(data, compresslevel=9))
+    return compressors
 
-    :param full_path:       Full path of request
-    :param request_path:    Short path of request
-    :param yoda_theme_path: Path to the yoda themes
-    :param yoda_theme:      Name of the chosen theme
 
-    :returns: Tuple of static directory and filename for correct path, None for incorrect path
+def precompress_static_files(static_dirs: List[str], min_size: int = 1024) -> Tuple[int, int]:
     """
-    parts = full_path.split("/")
+    Writes compressed variants of compressible static files (e.g. "yoda.css.gz" next to "yoda.css"),
+    unless an up to date variant already exists.
+
+    :param static_dirs: Static directories
+    :param min_size:    Minimum size of files to compress, in bytes
+
+    :returns: tuple of number of variants written and number of variants that could not be written
+    """
+    written, failed = 0, 0
+    compressors = get_compressors()
+    for static_dir in static_dirs:
+        for dirpath, _, filenames in os.walk(static_dir):
+            for filename in filenames:
+                if path.splitext(filename)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                    continue
+                source = path.join(dirpath, filename)
+                try:
+                    source_stat = os.stat(source)
+                    if source_stat.st_size < min_size:
+                        continue
+                    data = None
+                    for suffix, compress in compressors.values():
+                        target = source + suffix
+                        if path.exists(target) and os.stat(target).st_mtime_ns >= source_stat.st_mtime_ns:
+                            continue
+                        if data is None:
+                            with open(source, "rb") as f:
+                                data = f.read()
+                        with open(target + ".tmp", "wb") as f:
+                            f.write(compress(data))
+                        os.replace(target + ".tmp", target)
+                        written += 1
+                except OSError:
+                    failed += 1
+    return written, failed
+
+
+class StaticAsset(NamedTuple):
+    """Static asset in the static asset index."""
+    directory: str
+    filename: str
+    fingerprint: str
+    encodings: Tuple[str, ...]
+    size: int
+    mtime: int
+
+
+def get_hash_digest(secret_hash: str) -> bytes:
+    """
+    :param secret_hash: Secret from an account activation or password reset link
+
+    :returns: SHA-256 digest of the secret, which is stored instead of the secret itself
+    """
+    return hashlib.sha256(secret_hash.encode("utf-8")).digest()
+
+
+def get_file_fingerprint(filename: str) -> str:
+    """
+    :param filename: Path of the file
+
+    :returns: fingerprint of the file contents (truncated SHA-256 hex digest)
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()[:20]
+
+
+class StaticAssetIndex:
+    """
+    In-memory index of static asset directories, which resolves an asset path to the directory
+    that provides it with a single dictionary lookup.
+
+    Directories are listed in order of priority, so that assets in the theme's static directory
+    override the default static assets. Only files with safe names are indexed. The index also
+    keeps a fingerprint of the contents of each asset, and the content encodings of its
+    precompressed variants. It is rebuilt when the modification time
+    of any indexed directory, or the size or modification time of any indexed file has changed
+    (e.g. because a file was overwritten in place); this is checked at most once per refresh
+    interval. Files that have not changed keep their fingerprint on a rebuild. The generation of
+    the index is incremented on every rebuild.
+    """
+
+    def __init__(self, static_dirs: List[str], refresh_interval: float = 5.0) -> None:
+        """
+        :param static_dirs:      Static directories, in order of priority
+        :param refresh_interval: Minimum number of seconds between checks for changed directories and files
+        """
+        self.static_dirs = static_dirs
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._assets: Dict[str, StaticAsset] = {}
+        self._dir_mtimes: Dict[str, int] = {}
+        self._last_check = 0.0
+        self.generation = 0
+        self.build()
+
+    def build(self) -> None:
+        """(Re)builds the index by walking all static directories."""
+        assets: Dict[str, StaticAsset] = {}
+        dir_mtimes: Dict[str, int] = {}
+        for static_dir in self.static_dirs:
+            for dirpath, dirnames, filenames in os.walk(static_dir):
+                try:
+                    dir_mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+                except OSError:
+                    continue
+                relative_dir = path.relpath(dirpath, static_dir)
+                filename_set = set(filenames)
+                for filename in filenames:
+                    if filename != secure_filename(filename):
+                        continue
+                    asset_path = filename if relative_dir == "." else relative_dir + "/" + filename
+                    if asset_path in assets:
+                        continue
+                    try:
+                        stat = os.stat(path.join(dirpath, filename))
+                        previous = self._assets.get(asset_path)
+                        if (previous is not None and previous.directory == dirpath
+                                and (previous.size, previous.mtime) == (stat.st_size, stat.st_mtime_ns)):
+                            fingerprint = previous.fingerprint
+                        else:
+                            fingerprint = get_file_fingerprint(path.join(dirpath, filename))
+                        encodings = self._get_encodings(dirpath, filename, filename_set)
+                    except OSError:
+                        continue
+                    assets[asset_path] = StaticAsset(dirpath, filename, fingerprint, encodings,
+                                                     stat.st_size, stat.st_mtime_ns)
+            # Also watch static directories that do not exist (yet)
+            if static_dir not in dir_mtimes:
+                dir_mtimes[static_dir] = -1
+
+        self._assets = assets
+        self._dir_mtimes = dir_mtimes
+        self.generation += 1
+        self._last_check = time.monotonic()
+
+    def _get_encodings(self, dirpath: str, filename: str, filenames: Set[str]) -> Tuple[str, ...]:
+        """
+        :param dirpath:   Directory of the asset
+        :param filename:  Filename of the asset
+        :param filenames: All filenames in the directory
+
+        :returns: content encodings of the up to date precompressed variants of the asset
+        """
+        mtime = os.stat(path.join(dirpath, filename)).st_mtime_ns
+        return tuple(encoding for encoding, (suffix, _) in get_compressors().items()
+                     if filename + suffix in filenames
+                     and os.stat(path.join(dirpath, filename + suffix)).st_mtime_ns >= mtime)
 
-    if (
-        len(parts) > 2
-        and fullmatch("[ -~]*", full_path) is not None
-        and parts[1] == "assets"
-    ):
-        parts = parts[2:-1]
-        user_static_area = path.join(yoda_theme_path, yoda_theme)
-        _, asset_name = path.split(request_path)
-        # Confirm that asset_name is safe
-        if asset_name != secure_filename(asset_name):
-            return None
+    def _is_changed(self) -> bool:
+        """
+        :returns: boolean value that indicates whether any indexed directory or file has been changed
+        """
+        for dirpath, mtime in self._dir_mtimes.items():
+            try:
+                if os.stat(dirpath).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                if mtime != -1:
+                    return True
+        for asset in self._assets.values():
+            try:
+                stat = os.stat(path.join(asset.directory, asset.filename))
+            except OSError:
+                return True
+            if (stat.st_size, stat.st_mtime_ns) != (asset.size, asset.mtime):
+                return True
+        return False
 
-        static_dir = safe_join(user_static_area + "/static", *parts)
-        if not static_dir:
-            return None
-        user_static_filename = path.join(static_dir, asset_name)
+    def refresh_if_needed(self) -> None:
+        """Rebuilds the index if directories or files have changed since the last check."""
+        if time.monotonic() - self._last_check < self.refresh_interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._last_check < self.refresh_interval:
+                return
+            if self._is_changed():
+                self.build()
+            else:
+                self._last_check = time.monotonic()
 
-        if not path.exists(user_static_filename):
-            static_dir = safe_join("/var/www/yoda/static", *parts)
+    def resolve(self, asset_path: str) -> Optional[StaticAsset]:
+        """
+        Looks up an asset in the index.
 
-        return static_dir, asset_name
+        :param asset_path: Path of the asset, relative to the static directories (e.g. "img/logo.svg")
 
-    return None
+        :returns: Static directory, filename and fingerprint of the asset, None if asset is not in the index
+        """
+        self.refresh_if_needed()
+        return self._assets.get(asset_path)